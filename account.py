@@ -18,6 +18,7 @@ class Account:
     started: bool
     flood_wait_timeout: int
     flood_wait_from: dt.datetime
+    session_str: str  # последняя известная строка сессии
     busy: asyncio.Semaphore  # если запущена процедура, занимающая этот аккаунт
 
     def __init__(self, phone, fs: fsspec.spec.AbstractFileSystem):
@@ -28,12 +29,18 @@ class Account:
         self.flood_wait_timeout = 0
         self.flood_wait_from = None
         self.app = None
+        self.session_str = None
 
-    async def start(self):
-        if self.fs.exists(self.filename):
+    async def start(self, session_str: str = None):
+        """Запускает клиент. Строку сессии можно передать заранее,
+        иначе она читается из файловой системы."""
+        if session_str is None and self.fs.exists(self.filename):
             with self.fs.open(self.filename, "r") as f:
                 session_str = f.read()
 
+        self.session_str = session_str
+
+        if session_str is not None:
             self.app = pyrogram.Client(
                 self.phone,
                 session_string=session_str,
@@ -59,11 +66,16 @@ class Account:
         self.flood_wait_from = None
         self.busy = asyncio.Semaphore()
 
-    async def stop(self):
-        session_str = await self.app.export_session_string()
+    async def export_session(self) -> str:
+        self.session_str = await self.app.export_session_string()
+        return self.session_str
+
+    async def stop(self, save=True):
+        if save:
+            session_str = await self.export_session()
 
-        with self.fs.open(self.filename, "w") as f:
-            f.write(session_str)
+            with self.fs.open(self.filename, "w") as f:
+                f.write(session_str)
 
         await self.app.stop()
 
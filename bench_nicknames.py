@@ -0,0 +1,71 @@
+"""Замер скорости извлечения ников: python bench_nicknames.py"""
+
+import random
+import re
+import string
+import timeit
+
+from utils import ensure_ats, find_nicknames, get_nicknames
+
+TEXTS = 10_000  # сколько текстов в выборке
+MENTION_RATE = 0.02  # какая доля слов - упоминания
+REPEAT = 5
+
+
+def old_get_nicknames(text: str) -> set[str]:
+    """Прежняя реализация, для сравнения."""
+    if not text:
+        return set()
+
+    at_signs = re.findall(r"@[A-Za-z\d_]{5,32}", text)
+    links = re.findall(r"https://t\.me/([A-Za-z\d_]{5,32})", text)
+
+    return ensure_ats(at_signs) | ensure_ats(links)
+
+
+def make_texts(count=TEXTS, mention_rate=MENTION_RATE, seed=0) -> list[str]:
+    """Тексты, похожие на посты и комментарии: в основном слова,
+    изредка упоминания и ссылки."""
+    rng = random.Random(seed)
+
+    def name():
+        return "".join(rng.choices(string.ascii_letters + "_", k=rng.randint(5, 15)))
+
+    mentions = [
+        lambda: f"@{name()}",
+        lambda: f"https://t.me/{name()}",
+        lambda: f"{name()}.t.me",
+        lambda: f"https://t.me/+{name()}{name()}",
+    ]
+    words = ["инвестиции", "акции", "рынок", "сегодня", "дивиденды", "индекс"]
+
+    return [
+        " ".join(
+            rng.choice(mentions)() if rng.random() < mention_rate else rng.choice(words)
+            for _ in range(rng.randint(5, 80))
+        )
+        for _ in range(count)
+    ]
+
+
+def main():
+    for mention_rate in (MENTION_RATE, 0):
+        texts = make_texts(mention_rate=mention_rate)
+        print(f"mention rate {mention_rate}:")
+
+        cases = {
+            "old get_nicknames": lambda: [old_get_nicknames(text) for text in texts],
+            "get_nicknames": lambda: [get_nicknames(text) for text in texts],
+            "get_nicknames(invites=True)": lambda: [
+                get_nicknames(text, invites=True) for text in texts
+            ],
+            "find_nicknames": lambda: find_nicknames(texts, invites=True),
+        }
+
+        for title, case in cases.items():
+            best = min(timeit.repeat(case, number=1, repeat=REPEAT))
+            print(f"  {title:30} {best * 1000:8.1f} ms, {TEXTS / best:10,.0f} texts/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,44 +1,340 @@
-import cloudpickle
+import datetime as dt
+from collections import OrderedDict, namedtuple
+
+import orjson
 import pyrogram
 
 from utils import ensure_at_single
 
+CACHE_FILE = ".chat_cache.jsonl"
+CHAT_TTL = dt.timedelta(days=7)  # сколько доверять описанию чата
+MEMBERS_COUNT_TTL = dt.timedelta(hours=6)  # сколько доверять числу подписчиков
+MISSING_TTL = dt.timedelta(days=30)  # сколько помнить несуществующие ники
+MAX_SIZE = 100_000  # сколько чатов держать в памяти
+
+# сохраняем только те поля чата, которыми пользуемся; число подписчиков
+# хранится отдельно, потому что устаревает быстрее описания
+CachedChat = namedtuple("CachedChat", "username type title description bio")
+
 
 class ChatCacheItem:
-    """ "Элемент кэша чатов."""
+    """Элемент кэша чатов."""
 
-    chat: pyrogram.types.Chat
+    chat: CachedChat
     members_count: int
+    fetched_at: dt.datetime
+    members_count_fetched_at: dt.datetime
+
+    def __init__(
+        self, chat, members_count=None, fetched_at=None, members_count_fetched_at=None
+    ):
+        self.chat = CachedChat(
+            username=chat.username,
+            type=chat.type,
+            title=getattr(chat, "title", None),
+            description=getattr(chat, "description", None),
+            bio=getattr(chat, "bio", None),
+        )
+        self.fetched_at = fetched_at or dt.datetime.now(dt.timezone.utc)
+
+        # число подписчиков, пришедшее вместе с только что полученным чатом
+        if members_count is None and fetched_at is None:
+            members_count = getattr(chat, "members_count", None)
+
+        self.members_count = members_count
+        self.members_count_fetched_at = members_count_fetched_at or (
+            self.fetched_at if members_count is not None else None
+        )
+
+    def to_record(self, key) -> dict:
+        return {
+            "key": key,
+            "fetched_at": self.fetched_at,
+            "members_count": self.members_count,
+            "members_count_fetched_at": self.members_count_fetched_at,
+            "chat": {
+                **self.chat._asdict(),
+                "type": self.chat.type.name if self.chat.type else None,
+            },
+        }
 
-    def __init__(self, chat):
-        self.chat = chat
-        self.members_count = None
+    @classmethod
+    def from_record(cls, record: dict) -> "ChatCacheItem":
+        chat = record["chat"]
+        chat.pop("members_count", None)  # записи старого формата
+        chat["type"] = pyrogram.enums.ChatType[chat["type"]] if chat["type"] else None
+
+        return cls(
+            CachedChat(**chat),
+            members_count=record["members_count"],
+            fetched_at=dt.datetime.fromisoformat(record["fetched_at"]),
+            members_count_fetched_at=(
+                dt.datetime.fromisoformat(record["members_count_fetched_at"])
+                if record.get("members_count_fetched_at")
+                else None
+            ),
+        )
 
 
 class ChatCache:
-    cache: dict[str, ChatCacheItem]
+    """Кэш чатов, который хранится в файле построчно в формате JSON Lines.
+
+    Файл читается при первом обращении к кэшу. При сохранении в конец файла
+    дописываются только изменившиеся элементы, а когда устаревших строк
+    накапливается больше, чем актуальных, файл переписывается целиком.
+
+    Описание чата считается свежим `chat_ttl`, а число подписчиков -
+    `members_count_ttl`. В памяти держится не больше `max_size` чатов,
+    давно не запрашивавшиеся вытесняются.
 
-    def __init__(self, fs):
-        self.cache = {}
+    Отдельно кэшируются ники, по которым телеграм ответил ошибкой:
+    название ошибки хранится `missing_ttl`, чтобы не запрашивать их снова."""
+
+    cache: OrderedDict[str, ChatCacheItem]
+
+    def __init__(
+        self,
+        fs,
+        path=CACHE_FILE,
+        chat_ttl=CHAT_TTL,
+        members_count_ttl=MEMBERS_COUNT_TTL,
+        missing_ttl=MISSING_TTL,
+        max_size=MAX_SIZE,
+    ):
+        self.cache = OrderedDict()
+        self.missing: OrderedDict[str, tuple[str, dt.datetime]] = OrderedDict()
         self.fs = fs
+        self.path = path
+        self.chat_ttl = chat_ttl
+        self.members_count_ttl = members_count_ttl
+        self.missing_ttl = missing_ttl
+        self.max_size = max_size
+
+        self.loaded = False
+        self.dirty = set()
+        self.dirty_missing = set()
+        self.evicted = {}  # вытесненные из памяти, но еще не сохраненные
+        self.lines_on_disk = 0
+        self.complete = True  # все ли чаты из файла есть в памяти
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "expired": 0,
+            "evictions": 0,
+            "missing_hits": 0,
+        }
 
     def __getitem__(self, key):
-        return self.cache[ensure_at_single(key)]
+        self.load()
+        key = ensure_at_single(key)
+        self.cache.move_to_end(key)
+        return self.cache[key]
 
     def __setitem__(self, key, value):
-        self.cache[ensure_at_single(key)] = value
+        self.load()
+        self.put(ensure_at_single(key), value)
+        self.evict()
 
     def __contains__(self, key):
-        return ensure_at_single(key) in self.cache
+        self.load()
+        key = ensure_at_single(key)
+
+        item = self.cache.get(key)
+        if not item:
+            self.counters["misses"] += 1
+            return False
+
+        if self.expired(item.fetched_at, self.chat_ttl):
+            self.counters["expired"] += 1
+            del self.cache[key]
+            self.dirty.discard(key)
+            return False
+
+        self.counters["hits"] += 1
+        self.cache.move_to_end(key)
+        return True
+
+    def __len__(self):
+        self.load()
+        return len(self.cache)
+
+    def put(self, key, value):
+        self.cache[key] = value
+        self.cache.move_to_end(key)
+        self.dirty.add(key)
+
+        self.missing.pop(key, None)
+        self.dirty_missing.discard(key)
+
+    def evict(self):
+        while len(self.cache) > self.max_size:
+            key, item = self.cache.popitem(last=False)
+            self.counters["evictions"] += 1
+            self.complete = False
+
+            if key in self.dirty:
+                self.dirty.discard(key)
+                self.evicted[key] = item
+
+        while len(self.missing) > self.max_size:
+            key, _ = self.missing.popitem(last=False)
+            self.dirty_missing.discard(key)
+            self.counters["evictions"] += 1
+            self.complete = False
+
+    def known_missing(self, key) -> str | None:
+        """Название ошибки, которой телеграм ответил на запрос этого ника,
+        если ответ еще не устарел."""
+        self.load()
+        key = ensure_at_single(key)
+
+        if key not in self.missing:
+            return None
+
+        error, fetched_at = self.missing[key]
+        if self.expired(fetched_at, self.missing_ttl):
+            self.counters["expired"] += 1
+            del self.missing[key]
+            self.dirty_missing.discard(key)
+            return None
+
+        self.counters["missing_hits"] += 1
+        self.missing.move_to_end(key)
+        return error
+
+    def set_missing(self, key, error: str):
+        self.load()
+        key = ensure_at_single(key)
+
+        self.cache.pop(key, None)
+        self.dirty.discard(key)
+
+        self.missing[key] = (error, dt.datetime.now(dt.timezone.utc))
+        self.missing.move_to_end(key)
+        self.dirty_missing.add(key)
+        self.evict()
+
+    @staticmethod
+    def expired(fetched_at: dt.datetime, ttl: dt.timedelta) -> bool:
+        return not fetched_at or dt.datetime.now(dt.timezone.utc) - fetched_at > ttl
+
+    def get_members_count(self, key) -> int | None:
+        """Число подписчиков чата, если оно известно и не устарело."""
+        self.load()
+        key = ensure_at_single(key)
+
+        item = self.cache.get(key)
+        if (
+            not item
+            or item.members_count is None
+            or self.expired(item.fetched_at, self.chat_ttl)
+        ):
+            self.counters["misses"] += 1
+            return None
+
+        if self.expired(item.members_count_fetched_at, self.members_count_ttl):
+            self.counters["expired"] += 1
+            return None
+
+        self.counters["hits"] += 1
+        self.cache.move_to_end(key)
+        return item.members_count
+
+    def set_members_count(self, key, members_count: int):
+        item = self[key]
+        item.members_count = members_count
+        item.members_count_fetched_at = dt.datetime.now(dt.timezone.utc)
+        self.dirty.add(ensure_at_single(key))
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "size": len(self.cache),
+            "missing_size": len(self.missing),
+        }
 
     def load(self):
-        if self.fs.exists(".chat_cache"):
-            with self.fs.open(".chat_cache", "rb") as f:
-                self.chat_cache = cloudpickle.load(f)
+        if self.loaded:
+            return
+
+        self.loaded = True
 
-        # нормализуем все названия чатов при загрузке
-        self.cache = {ensure_at_single(key): value for key, value in self.cache.items()}
+        if not self.fs.exists(self.path):
+            return
+
+        with self.fs.open(self.path, "rb") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+
+                record = orjson.loads(line)
+                self.lines_on_disk += 1
+
+                # нормализуем все названия чатов при загрузке
+                key = ensure_at_single(record["key"])
+
+                if "error" in record:
+                    fetched_at = dt.datetime.fromisoformat(record["fetched_at"])
+                    if not self.expired(fetched_at, self.missing_ttl):
+                        self.cache.pop(key, None)
+                        self.missing[key] = (record["error"], fetched_at)
+                        self.missing.move_to_end(key)
+                    continue
+
+                item = ChatCacheItem.from_record(record)
+                if self.expired(item.fetched_at, self.chat_ttl):
+                    continue
+
+                self.missing.pop(key, None)
+                self.cache[key] = item
+                self.cache.move_to_end(key)
+
+        # в файле строки идут от старых к новым, так что вытесняются старые
+        self.complete = (
+            len(self.cache) <= self.max_size and len(self.missing) <= self.max_size
+        )
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+        while len(self.missing) > self.max_size:
+            self.missing.popitem(last=False)
 
     def save(self):
-        with self.fs.open(".chat_cache", "wb") as f:
-            cloudpickle.dump(self.chat_cache, f)
+        if not self.loaded or not (self.dirty or self.dirty_missing or self.evicted):
+            return
+
+        # пишем в порядке давности обращения, чтобы при загрузке
+        # вытеснялись те же чаты, что и в памяти
+        items = {
+            **self.evicted,
+            **{key: item for key, item in self.cache.items() if key in self.dirty},
+        }
+        missing = {
+            key: value
+            for key, value in self.missing.items()
+            if key in self.dirty_missing
+        }
+
+        # переписать файл целиком можно, только если ничего не вытеснялось,
+        # иначе потеряются чаты, которых уже нет в памяти
+        if self.complete and self.lines_on_disk + len(items) + len(missing) > 2 * (
+            len(self.cache) + len(self.missing)
+        ):
+            items = {**self.evicted, **self.cache}
+            missing = self.missing
+            mode = "wb"
+            self.lines_on_disk = 0
+        else:
+            mode = "ab"
+
+        records = [item.to_record(key) for key, item in items.items()] + [
+            {"key": key, "error": error, "fetched_at": fetched_at}
+            for key, (error, fetched_at) in missing.items()
+        ]
+
+        with self.fs.open(self.path, mode) as f:
+            f.write(b"".join(orjson.dumps(record) + b"\n" for record in records))
+
+        self.lines_on_disk += len(records)
+        self.dirty = set()
+        self.dirty_missing = set()
+        self.evicted = {}
@@ -0,0 +1,101 @@
+import datetime as dt
+
+import orjson
+
+from utils import ensure_at_single
+
+PARTIAL, DONE = "partial", "done"
+RUN_ID_FORMAT = "%Y-%m-%dT%H%M%S"  # run_id нового запуска: время его начала в UTC
+RESUME_WINDOW = dt.timedelta(hours=6)  # сколько можно продолжать незаконченный запуск
+
+
+class RunCheckpoint:
+    """Промежуточные результаты сбора статистики, чтобы упавший сбор
+    можно было перезапустить с того же места.
+
+    Для каждого канала в отдельный файл пишутся уже собранные посты
+    и статус: `partial`, если история пролистана не до конца, или `done`
+    вместе со статистикой канала. Файлы относятся к запуску `run_id`,
+    повторный запуск с тем же `run_id` пропускает готовые каналы
+    и продолжает недолистанные с последнего сохраненного поста.
+
+    `run_id` упорядочены как строки (например, даты в ISO), и `prune`
+    удаляет файлы запусков старше текущего."""
+
+    def __init__(self, fs, run_id, prefix=".run_"):
+        self.fs = fs
+        self.run_id = run_id
+        self.prefix = prefix
+
+    @classmethod
+    def resume(cls, fs, prefix=".run_", window=RESUME_WINDOW) -> "RunCheckpoint":
+        """Продолжает последний незаконченный запуск, то есть запуск,
+        от которого остались файлы, если он начался не раньше `window`
+        назад. Иначе начинает новый запуск со своим `run_id`.
+
+        Запуск без ошибок свои файлы удаляет, так что повторный сбор
+        после успешного начинается заново, а из упавшего берет готовые
+        каналы, только пока они не устарели."""
+        now = dt.datetime.now(dt.timezone.utc)
+        checkpoint = cls(fs, now.strftime(RUN_ID_FORMAT), prefix)
+
+        run_ids = {checkpoint.run_id_of(path) for path in fs.glob(f"{prefix}*")}
+        if run_ids:
+            try:
+                started = dt.datetime.strptime(max(run_ids), RUN_ID_FORMAT)
+            except ValueError:
+                # run_id старого формата, продолжать такой запуск не будем
+                return checkpoint
+
+            if now - started.replace(tzinfo=dt.timezone.utc) <= window:
+                checkpoint.run_id = max(run_ids)
+
+        return checkpoint
+
+    def path(self, channel) -> str:
+        return f"{self.prefix}{self.run_id}_{ensure_at_single(channel)}.json"
+
+    def load(self, channel) -> dict | None:
+        if not self.fs.exists(self.path(channel)):
+            return None
+
+        with self.fs.open(self.path(channel), "rb") as f:
+            checkpoint = orjson.loads(f.read())
+
+        for record in checkpoint["msgs"]:
+            record["datetime"] = dt.datetime.fromisoformat(record["datetime"])
+
+        return checkpoint
+
+    def save(self, channel, status, msgs: list[dict], channel_stat: dict = None):
+        """Сохраняет посты канала в порядке выдачи истории, от новых
+        к старым, так что последний пост - место, откуда продолжать."""
+        with self.fs.open(self.path(channel), "wb") as f:
+            f.write(
+                orjson.dumps(
+                    {"status": status, "msgs": msgs, "channel": channel_stat}
+                )
+            )
+
+    def clear(self):
+        """Удаляет все файлы запуска."""
+        paths = self.fs.glob(f"{self.prefix}{self.run_id}_*")
+        if paths:
+            self.fs.rm(paths)
+
+    def prune(self):
+        """Удаляет файлы прежних запусков: сбор, закончившийся с ошибками,
+        свои файлы не удаляет, а продолжать его уже не будут."""
+        paths = [
+            path
+            for path in self.fs.glob(f"{self.prefix}*")
+            if self.run_id_of(path) < str(self.run_id)
+        ]
+        if paths:
+            self.fs.rm(paths)
+
+    def run_id_of(self, path: str) -> str:
+        # имя файла - префикс, run_id и ник канала, начинающийся с "@";
+        # префикс может включать каталог, а glob возвращает полные пути
+        prefix = self.prefix.rsplit("/", 1)[-1]
+        return path.rsplit("/", 1)[-1][len(prefix) :].split("_@")[0]
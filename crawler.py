@@ -0,0 +1,321 @@
+import asyncio
+import re
+import time
+
+import pyrogram
+from tqdm import tqdm
+
+from chat_cache import ChatCacheItem
+from progress import CHANNEL, USER, ProgressKeeper
+from scanner import MISSING_ERRORS, Scanner
+from utils import ensure_ats, find_nicknames, get_nicknames, is_invite
+
+LIMIT_HISTORY = 200  # насколько лезть вглубь чата
+LIMIT_DISCUSSION = 30  # насколько лезть вглубь ветки комментариев
+LIMIT_BATCH = 1000  # сколько пользователей и каналов обрабатывать за запуск
+MAX_ATTEMPTS = 3  # после стольких ошибок элемент откладывается до следующего запуска
+PIPELINE_SIZE = 20  # сколько постов держать в очереди между стадиями обработки канала
+DISCUSSION_WORKERS = 4  # сколько веток комментариев одного канала читать одновременно
+
+MIN_SUBSCRIBERS = 500  # сколько должно быть подписчиков, чтобы сканировать посты канала
+TARGET_WORDS = ["инвест"]  # что ищем в названии или описании канала
+
+
+class Crawler:
+    """Обход похожих каналов: из био пользователей и каналов, из постов
+    и комментариев берутся ники, найденные каналы и пользователи ставятся
+    в очередь `ProgressKeeper` на следующий круг.
+
+    Работают `workers` воркеров одновременно (по умолчанию половина
+    рабочих аккаунтов, `Scanner.usable_accs`), каждый берет из очереди свой
+    элемент, так что запросы расходятся по всем аккаунтам сканера. Воркеров
+    всегда меньше, чем рабочих аккаунтов: воркер, читающий историю канала, ждет
+    вложенных запросов, и им нужен свободный аккаунт. Элемент,
+    на котором случилась ошибка, возвращается в очередь, а после
+    `max_attempts` ошибок откладывается до следующего запуска. Элемент,
+    ника которого не существует, сразу считается обработанным."""
+
+    scanner: Scanner
+    progress: ProgressKeeper
+
+    def __init__(
+        self,
+        scanner,
+        progress,
+        workers=None,
+        limit_batch=LIMIT_BATCH,
+        limit_history=LIMIT_HISTORY,
+        limit_discussion=LIMIT_DISCUSSION,
+        min_subscribers=MIN_SUBSCRIBERS,
+        target_words=TARGET_WORDS,
+        max_attempts=MAX_ATTEMPTS,
+        pipeline_size=PIPELINE_SIZE,
+        discussion_workers=DISCUSSION_WORKERS,
+    ):
+        self.scanner = scanner
+        self.progress = progress
+        self.workers = workers
+        self.limit_batch = limit_batch
+        self.limit_history = limit_history
+        self.limit_discussion = limit_discussion
+        self.min_subscribers = min_subscribers
+        self.target_words = [re.compile(word, re.IGNORECASE) for word in target_words]
+        self.max_attempts = max_attempts
+        self.pipeline_size = pipeline_size
+        self.discussion_workers = discussion_workers
+
+    async def run(self, pbar: tqdm = None):
+        """Обходит очередь, пока не обработано `limit_batch` элементов
+        или пока очередь не опустела."""
+        self.pbar = pbar
+        self.processed = 0
+        self.active = 0
+        self.attempts = {}
+        self.errors = {}
+        self.seen_invites = set()
+        self.counters = {
+            "users": 0,
+            "channels": 0,
+            "replies": 0,
+            "missing": 0,
+            "failed": 0,
+        }
+        self.changed = asyncio.Event()
+        self.started_at = time.monotonic()
+
+        async with self.scanner.session(pbar), self.progress.session(pbar):
+            usable = len(self.scanner.usable_accs())
+            # хотя бы один аккаунт остается для вложенных запросов
+            workers = min(self.workers or usable // 2, usable - 1)
+            await asyncio.gather(*(self.worker() for _ in range(max(1, workers))))
+
+        return self.stats()
+
+    async def worker(self):
+        while self.processed < self.limit_batch:
+            # пользователей обрабатываем в первую очередь: это дешевле
+            kind, item = USER, self.progress.lease(USER)
+            if item is None:
+                kind, item = CHANNEL, self.progress.lease(CHANNEL)
+
+            if item is None:
+                if not self.active:
+                    return
+
+                # очередь пуста, но другие воркеры еще могут в нее что-то добавить
+                self.changed.clear()
+                await self.changed.wait()
+                continue
+
+            self.processed += 1
+            self.active += 1
+
+            try:
+                await self.process(kind, item)
+
+            except MISSING_ERRORS:
+                # ника нет, и повторять запрос бессмысленно
+                self.progress.complete(kind, item)
+                self.counters["missing"] += 1
+
+            except Exception as e:
+                self.counters["failed"] += 1
+                self.errors[kind, item] = e
+                self.attempts[kind, item] = self.attempts.get((kind, item), 0) + 1
+
+                # элемент остается взятым до конца запуска, а при следующей
+                # загрузке снова попадет в очередь
+                if self.attempts[kind, item] < self.max_attempts:
+                    self.progress.requeue(kind, item)
+
+            else:
+                self.progress.complete(kind, item)
+                self.counters[f"{kind}s"] += 1
+
+            finally:
+                self.active -= 1
+                self.changed.set()
+
+                if self.pbar:
+                    self.pbar.update()
+                    self.pbar.set_postfix_str(
+                        f"{self.throughput():.1f}/s, {kind}: {item}"
+                    )
+
+    async def process(self, kind, item):
+        depth = self.progress.depth(kind, item) + 1
+
+        if kind == USER:
+            self.progress.schedule(*(await self.extract_from_bio(item)), depth=depth)
+            return
+
+        if not await self.channel_eligible(item):
+            return
+
+        self.progress.schedule(*(await self.extract_from_bio(item)), depth=depth)
+        await self.extract_from_posts(item, depth)
+
+    def throughput(self) -> float:
+        """Обработанных элементов в секунду."""
+        return self.processed / max(time.monotonic() - self.started_at, 1e-9)
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "processed": self.processed,
+            "seconds": round(time.monotonic() - self.started_at, 1),
+            "per_second": round(self.throughput(), 2),
+        }
+
+    async def extract_from_bio(self, chat_id: str) -> tuple[set[str], set[str]]:
+        try:
+            chat = await self.scanner.get_chat(chat_id)
+        except pyrogram.errors.PeerIdInvalid:
+            return set(), set()
+
+        nicknames = get_nicknames(
+            " ".join([el for el in [chat.bio, chat.description] if el]), invites=True
+        )
+        return await self.tell_channels_from_users(nicknames)
+
+    async def tell_channels_from_users(self, nicknames: set[str]):
+        invites = {nickname for nickname in nicknames if is_invite(nickname)}
+        nicknames = (set(nicknames) - invites) | await self.resolve_invites(invites)
+
+        channels, users = set(), set()
+        for nickname, chat in (await self.scanner.get_chats(nicknames)).items():
+            if isinstance(chat, Exception):
+                continue
+
+            if chat.type == pyrogram.enums.ChatType.CHANNEL:
+                channels |= {nickname}
+            elif chat.type == pyrogram.enums.ChatType.PRIVATE:
+                users |= {nickname}
+
+        return ensure_ats(channels), ensure_ats(users)
+
+    async def resolve_invites(self, invites: set[str]) -> set[str]:
+        """Ники чатов, на которые ведут пригласительные ссылки. По ссылке
+        в закрытый чат телеграм отдает только превью без ника."""
+        invites = invites - self.seen_invites
+        self.seen_invites |= invites
+
+        async def resolve(link):
+            try:
+                chat = await self.scanner.process_command("get_chat", link)
+            except pyrogram.errors.RPCError:
+                return None
+
+            return getattr(chat, "username", None)
+
+        usernames = await asyncio.gather(*(resolve(link) for link in invites))
+        return ensure_ats({username for username in usernames if username})
+
+    async def extract_from_posts(self, chat_id: str, depth=1):
+        """Ставит в очередь каналы и пользователей, найденных в постах канала
+        и комментариях к ним.
+
+        Обработка идет конвейером: история канала читается в ограниченную
+        очередь, а ветки комментариев и ники из текстов постов разбираются
+        параллельно с ней. Если следующая стадия не успевает, чтение
+        истории ждет, так что в памяти не больше `pipeline_size` постов.
+        Найденное сразу попадает в `ProgressKeeper`."""
+        posts = asyncio.Queue(self.pipeline_size)
+        texts = asyncio.Queue(self.pipeline_size)
+
+        async def read_history():
+            async for msg in self.scanner.get_chat_history(
+                chat_id, self.limit_history
+            ):
+                await posts.put(msg.id)
+                if msg.text:
+                    await texts.put(msg.text)
+
+            for _ in range(self.discussion_workers):
+                await posts.put(None)
+            await texts.put(None)
+
+        async def read_discussions():
+            while (msg_id := await posts.get()) is not None:
+                channels, users = await self.extract_from_discussions(chat_id, msg_id)
+                self.progress.schedule(channels, users, depth=depth)
+
+        async def resolve_nicknames():
+            finished = False
+
+            while not finished:
+                # забираем все накопившиеся тексты, чтобы резолвить ники пачкой
+                batch = [await texts.get()]
+                while not texts.empty():
+                    batch.append(texts.get_nowait())
+
+                finished = None in batch
+                nicknames = {
+                    nickname
+                    for nickname in find_nicknames(
+                        [text for text in batch if text is not None], invites=True
+                    )
+                    if self.progress.state(CHANNEL, nickname) is None
+                    and self.progress.state(USER, nickname) is None
+                }
+
+                if nicknames:
+                    self.progress.schedule(
+                        *(await self.tell_channels_from_users(nicknames)), depth=depth
+                    )
+
+        tasks = [
+            asyncio.create_task(read_history()),
+            asyncio.create_task(resolve_nicknames()),
+            *(
+                asyncio.create_task(read_discussions())
+                for _ in range(self.discussion_workers)
+            ),
+        ]
+
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+    async def extract_from_discussions(self, chat_id: str, msg_id: int):
+        channels, users = set(), set()
+
+        async for reply in self.scanner.get_discussion_replies(
+            chat_id, msg_id, self.limit_discussion
+        ):
+            self.counters["replies"] += 1
+
+            reply: pyrogram.types.Message
+
+            if (
+                reply.sender_chat
+                and reply.sender_chat.type == pyrogram.enums.ChatType.CHANNEL
+            ):
+                channels |= {reply.sender_chat.username}
+                if self.scanner.chat_cache is not None:
+                    self.scanner.chat_cache[reply.sender_chat.username] = (
+                        ChatCacheItem(reply.sender_chat)
+                    )
+
+            elif reply.from_user:
+                # внутри объекта from_user: User нет bio,
+                # поэтому нет смысла хранить его в кэше
+                users |= {reply.from_user.username or reply.from_user.id}
+
+        return ensure_ats(channels), ensure_ats(users)
+
+    async def channel_eligible(self, chat_id: str) -> bool:
+        chat: pyrogram.types.Chat = await self.scanner.get_chat(chat_id)
+        count = await self.scanner.get_chat_members_count(chat_id)
+
+        found = any(
+            word.search(text)
+            for word in self.target_words
+            for text in (chat.title, chat.description)
+            if text
+        )
+
+        return count > self.min_subscribers and found
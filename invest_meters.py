@@ -6,10 +6,12 @@ import pandas as pd
 import plotly.express as px
 import streamlit as st
 import supabase
+from fsspec.implementations.local import LocalFileSystem
 from stqdm import stqdm as tqdm
 
 import load_env
 import supabasefs
+from posts_index import BY_CHANNEL, BY_POPULARITY, PostsIndex
 
 HISTORY_LIMIT_DAYS = 30
 MIN_DATE = (
@@ -19,9 +21,9 @@ MIN_DATE = (
 async def main():
     st.title("Подборка статистики для Инвеcт-мэтров")
 
-    global scanner, client, db
+    global service, client, db
 
-    scanner, client = prepare_resources()
+    service, client = prepare_resources()
     db = load_data()
 
     st.subheader("Каналы")
@@ -38,14 +40,18 @@ async def main():
 @st.cache_resource(show_spinner="Подготовка...")
 def prepare_resources():
     from scanner import Scanner
+    from scanner_service import ScannerService
 
     client = supabase.create_client(
         os.environ["SUPABASE_URL"], os.environ["SUPABASE_KEY"]
     )
     fs = supabasefs.SupabaseTableFileSystem(client, "sessions")
-    scanner = Scanner(fs=fs, chat_cache=False)
 
-    return [scanner, client]
+    # аккаунты подключаются один раз и остаются подключенными между обновлениями
+    service = ScannerService(Scanner(fs=fs, chat_cache=False))
+    service.start()
+
+    return [service, client]
 
 
 @st.cache_resource(show_spinner="Загружаем историческую статистику", ttl=60)
@@ -76,7 +82,7 @@ def display_historical_stats():
 
 def display_historical_chart():
     chart_df = (
-        db.stats_df.set_index(["created_at", "username"])
+        db.stats_df.set_index(["created_at", "username"])[["reach", "subscribers"]]
         .stack()
         .reset_index()
         .rename(columns={"level_2": "metric", 0: "value"})
@@ -137,39 +143,70 @@ async def display_fresh_stats_and_posts():
     needs_updating = db.delta > dt.timedelta(hours=12)
 
     if "stats" in st.session_state:
-        msgs_df = st.session_state["msgs_df"]
+        posts = st.session_state["posts_index"]
         stats = st.session_state["stats"]
 
     elif st.button("Собрать свежую статистику", type="primary") or needs_updating:
-        msgs_df, stats = await collect_fresh_stats_and_posts()
+        posts, stats = await collect_fresh_stats_and_posts()
 
     else:
         st.stop()
 
     display_stats(stats)
-    display_popular_posts(msgs_df)
+    display_popular_posts(posts)
 
 
 async def collect_fresh_stats_and_posts():
+    from checkpoint import RunCheckpoint
+    from msg_store import MessageStore
+    from scanner_service import ProgressRelay
     from stats_collector import StatsCollector
 
-    collector = StatsCollector(scanner, MIN_DATE)
+    # упавший сбор при повторном запуске продолжится с того же места,
+    # если он был недавно
+    checkpoint = RunCheckpoint.resume(LocalFileSystem())
+    collector = StatsCollector(
+        service.scanner,
+        MIN_DATE,
+        msg_store=MessageStore(LocalFileSystem()),
+        checkpoint=checkpoint,
+        spill_fs=LocalFileSystem(),
+    )
 
     with st.spinner("Собираем статистику, можно пойти покурить..."):
         with tqdm(total=len(db.channels)) as pbar:
-            await collector.collect_all_stats(db.channels, pbar)
+            # сбор идет в потоке сервиса, а прогресс-бар обновляется отсюда,
+            # из потока сессии браузера
+            progress = ProgressRelay(pbar)
+            await service.run(
+                collector.collect_all_stats(db.channels, progress), progress
+            )
+
+    if collector.errors:
+        st.warning(
+            "Не удалось собрать статистику по каналам: "
+            + ", ".join(collector.errors)
+        )
 
-    db.save_new_stats_to_db(collector.stats)
+    # запись в базу идет в фоне и не задерживает показ статистики
+    # продолжение упавшего сбора перезапишет его строки, а не добавит новые
+    db.save_new_stats_to_db(
+        collector.stats, run_id=checkpoint.run_id, background=True
+    )
 
     stats = calc_reach_percent_and_votes(collector.stats)
 
-    st.session_state["msgs_df"] = collector.msgs_df
+    # индекс строится один раз и переживает перезапуски скрипта
+    # при каждом изменении виджетов
+    posts = PostsIndex(collector.msgs_df)
+
+    st.session_state["posts_index"] = posts
     st.session_state["stats"] = stats
 
-    return [collector.msgs_df, stats]
+    return [posts, stats]
 
 
-def display_popular_posts(msgs):
+def display_popular_posts(posts: PostsIndex):
     st.subheader("Популярные посты")
 
     col1, col2, col3, col4 = st.columns(4)
@@ -183,36 +220,17 @@ def display_popular_posts(msgs):
             "Не старше скольки дней", min_value=1, max_value=HISTORY_LIMIT_DAYS, value=8
         )
     with col4:
-        sort_by = st.radio("Сортировать по", ["популярности", "каналу"])
+        sort_by = st.radio("Сортировать по", [BY_POPULARITY, BY_CHANNEL])
 
     if min_days >= max_days:
         st.error("Минимальная дата должна быть меньше максимальной")
         return
 
-    now = pd.Timestamp("now", tz="UTC")
-    filtered_by_date = msgs[
-        (pd.to_datetime(msgs.datetime, utc=True) > now - pd.DateOffset(days=max_days))
-        & (pd.to_datetime(msgs.datetime, utc=True) < now - pd.DateOffset(days=min_days))
-    ]
-
-    sorted_posts = (
-        filtered_by_date.sort_values("popularity", ascending=False)
-        if sort_by == "популярности"
-        else filtered_by_date.sort_values("username")
+    st.write(
+        posts.html(how_many_per_channel, min_days, max_days, sort_by),
+        unsafe_allow_html=True,
     )
 
-    popular_posts = sorted_posts.groupby("username")[
-        ["username", "text", "link", "popularity"]
-    ].head(how_many_per_channel)
-
-    popular_posts["link"] = popular_posts["link"].apply(make_clickable)
-
-    st.write(popular_posts.to_html(escape=False), unsafe_allow_html=True)
-
-
-def make_clickable(url):
-    return f'<a target="_blank" href="{url}">ссылка</a>'
-
 
 try:
     asyncio.run(main())
@@ -0,0 +1,159 @@
+import os
+import socket
+import time
+import uuid
+
+import orjson
+from fsspec import AbstractFileSystem
+from fsspec.implementations.local import LocalFileSystem
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+LEASE_TTL = 60  # сколько секунд аренда действует без продления
+
+
+def make_owner_id() -> str:
+    """Идентификатор процесса, который держит аренды."""
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+def read_value(fs: AbstractFileSystem, path: str) -> str | None:
+    # значение могло поменяться в другом процессе, поэтому кэшу не верим
+    fs.invalidate_cache(path)
+
+    try:
+        return fs.cat_file(path).decode()
+    except FileNotFoundError:
+        return None
+
+
+def compare_and_swap(
+    fs: AbstractFileSystem, path: str, expected: str | None, value: str | None
+) -> bool:
+    """Записывает `value` в `path`, только если там сейчас `expected`.
+    `None` означает отсутствие файла.
+
+    Если файловая система умеет делать это атомарно (как
+    `SupabaseTableFileSystem`), используется ее реализация, а на локальном
+    диске чтение и запись идут под блокировкой `flock`. Для остальных
+    файловых систем файл создается в режиме "x", заменяется переименованием,
+    а результат перечитывается для проверки. Это не атомарно: два процесса
+    могут оба увидеть свою запись, так что аренды надежны только
+    в первых двух случаях."""
+    if hasattr(fs, "compare_and_swap"):
+        return fs.compare_and_swap(path, expected, value)
+
+    if isinstance(fs, LocalFileSystem) and fcntl:
+        return locked_compare_and_swap(fs._strip_protocol(path), expected, value)
+
+    if read_value(fs, path) != expected:
+        return False
+
+    if value is None:
+        fs.rm(path)
+        return True
+
+    if expected is None:
+        try:
+            with fs.open(path, "xb") as f:
+                f.write(value.encode())
+        except FileExistsError:
+            return False
+    else:
+        tmp_path = f"{path}.{uuid.uuid4().hex}"
+        fs.pipe_file(tmp_path, value.encode())
+        fs.mv(tmp_path, path)
+
+    return read_value(fs, path) == value
+
+
+def locked_compare_and_swap(path: str, expected: str | None, value: str | None):
+    """`compare_and_swap` для локального диска: пока держится эксклюзивная
+    блокировка соседнего файла, другие процессы не могут ни прочитать,
+    ни записать значение."""
+    lock = os.open(f"{path}.lock", os.O_CREAT | os.O_RDWR, 0o644)
+
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        try:
+            with open(path, encoding="utf-8") as f:
+                current = f.read()
+        except FileNotFoundError:
+            current = None
+
+        if current != expected:
+            return False
+
+        if value is None:
+            os.remove(path)
+        else:
+            tmp_path = f"{path}.{uuid.uuid4().hex}"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(value)
+            os.replace(tmp_path, path)
+
+        return True
+
+    finally:
+        # закрытие дескриптора снимает блокировку
+        os.close(lock)
+
+
+class Lease:
+    """Аренда ресурса с истечением срока, хранящаяся в файловой системе.
+
+    В файле лежит владелец и время окончания аренды. Чужую аренду можно
+    перехватить только после того, как она истекла, так что упавший
+    процесс не блокирует ресурс навсегда. Держатель должен продлевать
+    аренду через `renew` чаще, чем раз в `ttl` секунд."""
+
+    def __init__(self, fs: AbstractFileSystem, name: str, owner: str, ttl=LEASE_TTL):
+        self.fs = fs
+        self.path = f".lease_{name}"
+        self.owner = owner
+        self.ttl = ttl
+
+    def read(self) -> tuple[str | None, dict | None]:
+        raw = read_value(self.fs, self.path)
+        return raw, orjson.loads(raw) if raw else None
+
+    def acquire(self) -> bool:
+        raw, current = self.read()
+
+        if current and current["owner"] != self.owner and not self.expired(current):
+            return False
+
+        return compare_and_swap(self.fs, self.path, raw, self.dump())
+
+    def renew(self) -> bool:
+        """Продлевает аренду. Возвращает `False`, если аренду перехватили."""
+        raw, current = self.read()
+
+        if not current or current["owner"] != self.owner:
+            return False
+
+        return compare_and_swap(self.fs, self.path, raw, self.dump())
+
+    def release(self):
+        raw, current = self.read()
+
+        if current and current["owner"] == self.owner:
+            compare_and_swap(self.fs, self.path, raw, None)
+
+    def holder(self) -> dict | None:
+        """Текущий держатель аренды, если она действует."""
+        _, current = self.read()
+        return current if current and not self.expired(current) else None
+
+    def dump(self) -> str:
+        return orjson.dumps(
+            {"owner": self.owner, "expires_at": time.time() + self.ttl}
+        ).decode()
+
+    @staticmethod
+    def expired(lease: dict) -> bool:
+        return lease["expires_at"] < time.time()
@@ -5,9 +5,13 @@ import streamlit as st
 
 """Load environment variables from .streamlit/secrets.toml to os.environ"""
 def load_secrets():
-    if st.secrets:
-        os.environ.update(st.secrets)
-        return
+    # новые версии streamlit бросают исключение, если секретов нет вовсе
+    try:
+        if st.secrets:
+            os.environ.update(st.secrets)
+            return
+    except FileNotFoundError:
+        pass
 
     try:
         with open(".streamlit/secrets.toml") as f:
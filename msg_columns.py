@@ -0,0 +1,143 @@
+import calendar
+import datetime as dt
+import uuid
+from array import array
+from typing import Iterable
+
+import numpy as np
+import pandas as pd
+from fsspec import AbstractFileSystem
+
+SPILL_ROWS = 200_000  # сколько постов держать в памяти, прежде чем сбросить на диск
+
+
+def to_ns(value: dt.datetime) -> int:
+    """Наносекунды от начала эпохи. Время без часового пояса сохраняется
+    как есть, с поясом - переводится в UTC."""
+    return calendar.timegm(value.utctimetuple()) * 10**9 + value.microsecond * 1000
+
+
+class MsgColumns:
+    """Посты, собранные по колонкам, а не списком кортежей.
+
+    Числа и время хранятся в типизированных массивах, каналы - кодами
+    категорий, а тексты и ссылки - ссылками на уже существующие строки.
+    Строки добавляются в порядке полей `Msg`. DataFrame собирается из
+    массивов без разбора питоновских объектов: pandas копирует их
+    в свои блоки целиком, одной операцией на колонку.
+
+    Если задана `spill_fs`, каждые `spill_rows` постов сбрасываются
+    в parquet и освобождают память, а `to_frame` читает их обратно.
+    Имена файлов уникальны для каждого экземпляра, так что одновременные
+    сборы не перезаписывают чужие файлы."""
+
+    def __init__(
+        self,
+        channels: Iterable[str] = (),
+        spill_fs: AbstractFileSystem = None,
+        spill_rows=SPILL_ROWS,
+        spill_prefix: str = None,
+    ):
+        # категории заводятся заранее, чтобы посты шли в порядке каналов
+        self.categories: dict[str, int] = {}
+        for channel in channels:
+            self.categories.setdefault(channel, len(self.categories))
+
+        self.spill_fs = spill_fs
+        self.spill_rows = spill_rows
+        self.spill_prefix = spill_prefix or f".msgs_spill_{uuid.uuid4().hex}_"
+        self.spilled: list[str] = []
+        self.spilled_rows = 0
+
+        self.reset()
+
+    def reset(self):
+        self.codes = array("i")
+        self.links: list[str] = []
+        self.reach = array("q")
+        self.reactions = array("q")
+        self.datetimes = array("q")
+        self.texts: list[str] = []
+
+    def __len__(self):
+        return self.spilled_rows + len(self.codes)
+
+    def extend(self, msgs: Iterable[tuple]):
+        for username, link, reach, reactions, datetime, text in msgs:
+            code = self.categories.get(username)
+            if code is None:
+                code = self.categories[username] = len(self.categories)
+
+            self.codes.append(code)
+            self.links.append(link)
+            self.reach.append(reach)
+            self.reactions.append(reactions)
+            self.datetimes.append(to_ns(datetime))
+            self.texts.append(text)
+
+        if self.spill_fs and len(self.codes) >= self.spill_rows:
+            self.spill()
+
+    def spill(self):
+        path = f"{self.spill_prefix}{len(self.spilled)}.parquet"
+
+        with self.spill_fs.open(path, "wb") as f:
+            self.memory_frame().to_parquet(f, index=False)
+
+        self.spilled.append(path)
+        self.spilled_rows += len(self.codes)
+        self.reset()
+
+    def memory_frame(self) -> pd.DataFrame:
+        # np.frombuffer не копирует данные, копию делает только сам DataFrame
+        codes = np.frombuffer(self.codes, dtype=np.int32)
+
+        return pd.DataFrame(
+            {
+                "username": pd.Categorical.from_codes(
+                    codes, categories=list(self.categories)
+                ),
+                "link": self.links,
+                "reach": np.frombuffer(self.reach, dtype=np.int64),
+                "reactions": np.frombuffer(self.reactions, dtype=np.int64),
+                "datetime": np.frombuffer(self.datetimes, dtype=np.int64).view(
+                    "datetime64[ns]"
+                ),
+                "text": self.texts,
+            }
+        )
+
+    def to_frame(self) -> pd.DataFrame:
+        """Все посты одним DataFrame, сгруппированные в порядке каналов."""
+        if not self.spilled:
+            df = self.memory_frame()
+        else:
+            frames = []
+            for path in self.spilled:
+                with self.spill_fs.open(path, "rb") as f:
+                    frames.append(pd.read_parquet(f))
+
+            # пустой остаток в памяти испортил бы типы строковых колонок
+            if self.codes:
+                frames.append(self.memory_frame())
+
+            df = pd.concat(frames, ignore_index=True)
+            df["username"] = pd.Categorical(
+                df.username, categories=list(self.categories)
+            )
+
+        # каналы досчитываются в разном порядке, а порядок постов
+        # внутри канала сохраняет устойчивая сортировка
+        codes = df.username.cat.codes.to_numpy()
+        if len(codes) and (np.diff(codes) < 0).any():
+            df = df.iloc[np.argsort(codes, kind="stable")].reset_index(drop=True)
+
+        return df
+
+    def cleanup(self):
+        """Удаляет сброшенные на диск части."""
+        if self.spilled:
+            self.spill_fs.rm(self.spilled)
+
+        self.spilled = []
+        self.spilled_rows = 0
@@ -0,0 +1,89 @@
+import datetime as dt
+
+import orjson
+
+from utils import ensure_at_single
+
+# посты моложе этого срока еще набирают просмотры и реакции,
+# поэтому при каждом сборе их статистика запрашивается заново
+REFRESH_WINDOW = dt.timedelta(days=3)
+
+
+class MessageStore:
+    """Хранит собранные посты каналов между запусками, чтобы при следующем
+    сборе запрашивать у телеграма только новые и еще "живые" посты.
+
+    Посты каждого канала лежат в отдельном файле и загружаются при первом
+    обращении к каналу, а после выдачи через `messages` выгружаются, так что
+    в памяти не копятся посты всех обработанных каналов."""
+
+    channels: dict[str, dict[int, dict]]
+
+    def __init__(self, fs, prefix=".msgs_"):
+        self.fs = fs
+        self.prefix = prefix
+        self.channels = {}
+
+    def path(self, channel) -> str:
+        return f"{self.prefix}{ensure_at_single(channel)}.json"
+
+    def get(self, channel) -> dict[int, dict]:
+        """Посты канала по их id."""
+        key = ensure_at_single(channel)
+
+        if key not in self.channels:
+            self.channels[key] = {}
+
+            if self.fs.exists(self.path(channel)):
+                with self.fs.open(self.path(channel), "rb") as f:
+                    records = orjson.loads(f.read())
+
+                for record in records:
+                    record["datetime"] = dt.datetime.fromisoformat(record["datetime"])
+                    self.channels[key][record["id"]] = record
+
+        return self.channels[key]
+
+    def max_id(self, channel) -> int:
+        return max(self.get(channel), default=0)
+
+    def settled_id(self, channel, refresh_from: dt.datetime) -> int:
+        """Наибольший id среди постов старше `refresh_from`.
+        Посты с id не больше этого заново запрашивать не нужно."""
+        return max(
+            (
+                msg_id
+                for msg_id, record in self.get(channel).items()
+                if record["datetime"] < refresh_from
+            ),
+            default=0,
+        )
+
+    def update(self, channel, records: dict[int, dict], min_date=None):
+        """Добавляет или обновляет посты канала, выбрасывает посты старше
+        `min_date` и сохраняет файл канала."""
+        msgs = self.get(channel)
+        msgs.update(records)
+
+        if min_date:
+            for msg_id in [
+                msg_id
+                for msg_id, record in msgs.items()
+                if record["datetime"] < min_date
+            ]:
+                del msgs[msg_id]
+
+        with self.fs.open(self.path(channel), "wb") as f:
+            f.write(orjson.dumps(sorted(msgs.values(), key=lambda r: -r["id"])))
+
+    def messages(self, channel, min_date=None) -> list[dict]:
+        """Посты канала от новых к старым, как их отдает `get_chat_history`.
+        После этого посты канала выгружаются из памяти."""
+        records = [
+            record
+            for _, record in sorted(self.get(channel).items(), reverse=True)
+            if not min_date or record["datetime"] >= min_date
+        ]
+        self.channels.pop(ensure_at_single(channel), None)
+
+        return records
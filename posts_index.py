@@ -0,0 +1,99 @@
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+BY_POPULARITY, BY_CHANNEL = "популярности", "каналу"
+COLUMNS = ["username", "text", "link", "popularity"]
+HTML_CACHE_SIZE = 64  # сколько отрисованных таблиц помнить
+
+
+def make_clickable(url):
+    return f'<a target="_blank" href="{url}">ссылка</a>'
+
+
+class PostsIndex:
+    """Подготовленные для выборки популярных постов данные.
+
+    Время постов разбирается один раз, посты сортируются по каналу
+    и времени, а для каждого канала заранее считается порядок по
+    популярности. Выборка "не больше N постов с канала за период" сводится
+    к маске по времени и срезу первых N постов каждого канала в готовом
+    порядке, без сортировок и группировок. Отрисованный HTML запоминается
+    для каждого набора параметров."""
+
+    def __init__(self, msgs: pd.DataFrame):
+        timestamps = (
+            pd.to_datetime(msgs.datetime, utc=True)
+            .dt.tz_convert(None)
+            .to_numpy("datetime64[ns]")
+        )
+        # коды в алфавитном порядке ников, как при сортировке по каналу
+        usernames, codes = np.unique(msgs.username.astype(str), return_inverse=True)
+        popularity = msgs.popularity.to_numpy(dtype=float)
+
+        by_time = np.lexsort((timestamps, codes))
+        self.posts = msgs[COLUMNS].iloc[by_time].copy()
+        self.posts["username"] = usernames[codes[by_time]]
+        self.posts["link"] = [make_clickable(link) for link in self.posts.link]
+
+        self.timestamps = timestamps[by_time]
+        self.codes = codes[by_time]
+        # ключ сортировки от популярных к непопулярным, посты без
+        # популярности (с пустым охватом) идут последними
+        self.unpopularity = -np.nan_to_num(popularity[by_time], nan=-np.inf)
+
+        # позиции постов каждого канала от популярных к непопулярным
+        self.by_popularity = np.lexsort((self.unpopularity, self.codes))
+        # от свежих к старым внутри канала
+        self.by_recency = np.lexsort((-self.timestamps.view(np.int64), self.codes))
+
+        self.html_cache: OrderedDict[tuple, str] = OrderedDict()
+
+    def __len__(self):
+        return len(self.posts)
+
+    def top(self, how_many, min_days, max_days, sort_by=BY_POPULARITY, now=None):
+        """Не больше `how_many` постов с канала, опубликованных от `max_days`
+        до `min_days` дней назад: самые популярные или, при сортировке
+        по каналу, самые свежие."""
+        now = (now or pd.Timestamp("now", tz="UTC")).tz_convert(None)
+        since = (now - pd.DateOffset(days=max_days)).to_datetime64()
+        until = (now - pd.DateOffset(days=min_days)).to_datetime64()
+
+        in_range = (self.timestamps > since) & (self.timestamps < until)
+
+        order = self.by_popularity if sort_by == BY_POPULARITY else self.by_recency
+        positions = order[in_range[order]]
+
+        # номер поста внутри своего канала: позиция минус начало группы
+        codes = self.codes[positions]
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+        sizes = np.diff(np.r_[starts, len(positions)])
+        ranks = np.arange(len(positions)) - np.repeat(starts, sizes)
+        positions = positions[ranks < how_many]
+
+        if sort_by == BY_POPULARITY:
+            # популярные посты всех каналов вперемешку, как при sort_values
+            positions = positions[
+                np.argsort(self.unpopularity[positions], kind="stable")
+            ]
+
+        return self.posts.iloc[positions]
+
+    def html(self, how_many, min_days, max_days, sort_by=BY_POPULARITY):
+        """HTML-таблица для `top`. Запоминается до смены минуты, чтобы
+        границы периода не устаревали."""
+        now = pd.Timestamp("now", tz="UTC").floor("min")
+        key = (how_many, min_days, max_days, sort_by, now)
+
+        if key not in self.html_cache:
+            self.html_cache[key] = self.top(
+                how_many, min_days, max_days, sort_by, now
+            ).to_html(escape=False)
+
+            while len(self.html_cache) > HTML_CACHE_SIZE:
+                self.html_cache.popitem(last=False)
+
+        self.html_cache.move_to_end(key)
+        return self.html_cache[key]
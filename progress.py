@@ -1,43 +1,216 @@
-import orjson
 import contextlib
+import heapq
+import itertools
+import time
+from collections.abc import Set
+
+import orjson
 from tqdm import tqdm
 
+JOURNAL_FILE = ".crawl_frontier.jsonl"
+LEGACY_FILE = ".chat_lists.json"  # старый формат, переносится при первой загрузке
+FLUSH_RECORDS = 500  # сколько изменений копить, прежде чем дописать их в журнал
+FLUSH_INTERVAL = 30  # и не дольше скольких секунд
+
+USER, CHANNEL = "user", "channel"
+NEW, LEASED, SCANNED = "new", "leased", "scanned"
+
+
+def normalize(name):
+    return name.lower() if isinstance(name, str) else name
+
+
+class StateView(Set):
+    """Множество имен в одном состоянии. Только для чтения, зато не копирует
+    данные, так что `in` и `len` работают за O(1)."""
+
+    def __init__(self, names: set):
+        self.names = names
+
+    def __contains__(self, name):
+        return normalize(name) in self.names
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        return set(iterable)
+
 
 class ProgressKeeper:
-    def __init__(self, fs):
-        (
-            self.scanned_users,
-            self.scanned_channels,
-            self.new_users,
-            self.scanned_users,
-        ) = (set(), set(), set(), set())
+    """Фронтир обхода: пользователи и каналы, которые предстоит просканировать
+    или уже просканированы.
+
+    Состояние хранится в журнале JSON Lines: изменения дописываются в конец
+    файла пачками по `flush_records` штук, но не реже раза
+    в `flush_interval` секунд, а при сохранении файл переписывается
+    целиком, только когда устаревших строк накопилось больше, чем актуальных.
+    Пачки нужны потому, что дописывание в `SupabaseTableFileSystem` стоит
+    столько же, сколько перезапись всего файла. При падении теряется
+    только последняя пачка: найденное заново найдется, а просканированное
+    будет просканировано еще раз. Взятые в работу элементы в журнал
+    не пишутся: если процесс упал, при загрузке они снова окажутся в очереди.
+
+    Элементы выдаются по убыванию приоритета, при равном приоритете -
+    по возрастанию глубины, на которой они найдены. Несколько воркеров
+    могут брать элементы одновременно: взятый элемент другим не выдается,
+    пока не будет просканирован или возвращен в очередь."""
+
+    def __init__(
+        self,
+        fs,
+        path=JOURNAL_FILE,
+        flush_records=FLUSH_RECORDS,
+        flush_interval=FLUSH_INTERVAL,
+    ):
         self.fs = fs
+        self.path = path
+        self.flush_records = flush_records
+        self.flush_interval = flush_interval
         self.pbar = None
 
+        self.states = {
+            (kind, state): set()
+            for kind in (USER, CHANNEL)
+            for state in (NEW, LEASED, SCANNED)
+        }
+        self.meta: dict[tuple[str, str], tuple[int, int]] = {}  # приоритет, глубина
+        self.queues = {USER: [], CHANNEL: []}
+        self.seq = itertools.count()
+        self.lines_on_disk = 0
+        self.unsaved: list[dict] = []  # изменения, еще не дописанные в журнал
+        self.flushed_at = time.monotonic()
+        self.loaded = False
+
+        self.scanned_users = StateView(self.states[USER, SCANNED])
+        self.scanned_channels = StateView(self.states[CHANNEL, SCANNED])
+        self.new_users = StateView(self.states[USER, NEW])
+        self.new_channels = StateView(self.states[CHANNEL, NEW])
+
+    def state(self, kind, name) -> str | None:
+        name = normalize(name)
+        return next(
+            (
+                state
+                for state in (NEW, LEASED, SCANNED)
+                if name in self.states[kind, state]
+            ),
+            None,
+        )
+
+    def depth(self, kind, name) -> int:
+        return self.meta.get((kind, normalize(name)), (0, 0))[1]
+
     def load(self):
-        lowering_func = lambda x: x.lower() if isinstance(x, str) else x
+        if self.loaded:
+            return
+
+        self.loaded = True
+
+        if self.fs.exists(self.path):
+            with self.fs.open(self.path, "rb") as f:
+                for line in f:
+                    if line.strip():
+                        self.apply(orjson.loads(line))
+                        self.lines_on_disk += 1
+
+            # взятые в работу, но не законченные элементы возвращаем в очередь
+            for kind in (USER, CHANNEL):
+                for name in list(self.states[kind, LEASED]):
+                    self.move(kind, name, NEW)
 
-        with self.fs.open(".chat_lists.json", "rb") as f:
+        elif self.fs.exists(LEGACY_FILE):
+            self.migrate()
+
+    def migrate(self):
+        with self.fs.open(LEGACY_FILE, "rb") as f:
             lists = orjson.loads(f.read())
-            self.scanned_channels = {
-                lowering_func(x) for x in lists["scanned_channels"]
-            }
-            self.scanned_users = {lowering_func(x) for x in lists["scanned_users"]}
-            self.new_channels = {lowering_func(x) for x in lists["new_channels"]}
-            self.new_users = {lowering_func(x) for x in lists["new_users"]}
-
-    def save(self):
-        sorting_func = lambda x: x.lower() if isinstance(x, str) else ""
-
-        lists = {
-            "scanned_channels": sorted(list(self.scanned_channels), key=sorting_func),
-            "new_channels": sorted(list(self.new_channels), key=sorting_func),
-            "scanned_users": sorted(list(self.scanned_users), key=sorting_func),
-            "new_users": sorted(list(self.new_users), key=sorting_func),
-        }
 
-        with self.fs.open(".chat_lists.json", "wb") as f:
-            f.write(orjson.dumps(lists))
+        for kind, prefix in ((USER, "users"), (CHANNEL, "channels")):
+            # просканированные идут последними, чтобы перекрыть новые
+            for state in (NEW, SCANNED):
+                for name in lists.get(f"{state}_{prefix}", []):
+                    self.apply({"kind": kind, "name": name, "state": state})
+
+        self.save(compact=True)
+
+    def apply(self, record: dict):
+        kind, name = record["kind"], normalize(record["name"])
+
+        if "priority" in record or "depth" in record:
+            self.meta[kind, name] = (record.get("priority", 0), record.get("depth", 0))
+
+        self.move(kind, name, record["state"])
+
+    def move(self, kind, name, state):
+        for other in (NEW, LEASED, SCANNED):
+            self.states[kind, other].discard(name)
+
+        self.states[kind, state].add(name)
+
+        if state == NEW:
+            priority, depth = self.meta.get((kind, name), (0, 0))
+            heapq.heappush(self.queues[kind], (-priority, depth, next(self.seq), name))
+
+    def append(self, records: list[dict]):
+        """Копит изменения и дописывает их в журнал, когда накопилась пачка
+        или прошло `flush_interval` секунд с прошлой записи."""
+        self.unsaved.extend(records)
+
+        if (
+            len(self.unsaved) >= self.flush_records
+            or time.monotonic() - self.flushed_at >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        """Дописывает накопленные изменения в журнал."""
+        if self.unsaved:
+            with self.fs.open(self.path, "ab") as f:
+                f.write(
+                    b"".join(orjson.dumps(record) + b"\n" for record in self.unsaved)
+                )
+
+            self.lines_on_disk += len(self.unsaved)
+            self.unsaved = []
+
+        self.flushed_at = time.monotonic()
+
+    def save(self, compact=False):
+        """Дописывает накопленные изменения, а если в журнале накопилось
+        много устаревших строк, переписывает его целиком."""
+        live = sum(len(names) for names in self.states.values())
+
+        if not compact and self.lines_on_disk + len(self.unsaved) <= 2 * live:
+            self.flush()
+            return
+
+        records = [
+            self.record(kind, name, SCANNED if state == SCANNED else NEW)
+            for (kind, state), names in self.states.items()
+            for name in names
+        ]
+
+        with self.fs.open(self.path, "wb") as f:
+            f.write(b"".join(orjson.dumps(record) + b"\n" for record in records))
+
+        self.lines_on_disk = len(records)
+        self.unsaved = []
+        self.flushed_at = time.monotonic()
+
+    def record(self, kind, name, state) -> dict:
+        priority, depth = self.meta.get((kind, name), (0, 0))
+        return {
+            "kind": kind,
+            "name": name,
+            "state": state,
+            "priority": priority,
+            "depth": depth,
+        }
 
     @contextlib.asynccontextmanager
     async def session(self, pbar: tqdm = None):
@@ -49,53 +222,81 @@ class ProgressKeeper:
             self.save()
             self.pbar = None
 
-    def schedule(self, channels, users):
-        lowering_func = lambda x: x.lower() if isinstance(x, str) else x
+    def schedule(self, channels, users, depth=0, priority=0):
+        """Ставит в очередь новые каналы и пользователей. Уже известные
+        пропускаются."""
+        records = []
 
-        self.new_channels |= {
-            lowering_func(x) for x in channels
-        } - self.scanned_channels
-        self.new_users |= {lowering_func(x) for x in users} - self.scanned_users
+        for kind, names in ((CHANNEL, channels), (USER, users)):
+            for name in {normalize(name) for name in names}:
+                if self.state(kind, name) is not None:
+                    continue
 
-    @contextlib.contextmanager
-    def pop_user(self):
-        try:
-            user_to_scan = self.new_users.pop()
+                self.meta[kind, name] = (priority, depth)
+                self.move(kind, name, NEW)
+                records.append(self.record(kind, name, NEW))
 
-            if self.pbar:
-                old_postfix = self.pbar.postfix or ""
-                self.pbar.set_postfix_str(", ".join([old_postfix, f"user: {user_to_scan}"]))
+        self.append(records)
 
-            yield user_to_scan
+    def prioritize(self, kind, name, priority):
+        """Меняет приоритет элемента, который еще ждет в очереди,
+        например когда стало известно число подписчиков канала."""
+        name = normalize(name)
+        if name not in self.states[kind, NEW]:
+            return
 
-            self.scanned_users |= {user_to_scan}
+        self.meta[kind, name] = (priority, self.depth(kind, name))
+        self.move(kind, name, NEW)
+        self.append([self.record(kind, name, NEW)])
 
-        except Exception:
-            self.new_users.add(user_to_scan)
-            raise
+    def lease(self, kind) -> str | None:
+        """Берет в работу самый приоритетный элемент очереди."""
+        queue = self.queues[kind]
 
-        finally:
-            if self.pbar:
-                self.pbar.set_postfix_str(old_postfix)
+        while queue:
+            minus_priority, depth, _, name = heapq.heappop(queue)
 
+            # в куче остаются устаревшие записи, их пропускаем
+            if name in self.states[kind, NEW] and self.meta.get(
+                (kind, name), (0, 0)
+            ) == (-minus_priority, depth):
+                self.move(kind, name, LEASED)
+                return name
 
-    @contextlib.contextmanager
-    def pop_channel(self):
-        try:
-            channel_to_scan = self.new_channels.pop()
+        return None
 
-            if self.pbar:
-                old_postfix = self.pbar.postfix or ""
-                self.pbar.set_postfix_str(", ".join([old_postfix, f"user: {channel_to_scan}"]))
+    def complete(self, kind, name):
+        self.move(kind, name, SCANNED)
+        self.append([self.record(kind, name, SCANNED)])
 
-            yield channel_to_scan
+    def requeue(self, kind, name):
+        self.move(kind, name, NEW)
 
-            self.scanned_channels |= {channel_to_scan}
+    @contextlib.contextmanager
+    def pop(self, kind):
+        """Выдает элемент очереди. Если блок завершился без ошибок, элемент
+        считается просканированным, иначе возвращается в очередь."""
+        item = self.lease(kind)
+        if item is None:
+            raise KeyError(f"No new {kind}s to scan")
 
-        except Exception:
-            self.new_channels.add(channel_to_scan)
-            raise
+        if self.pbar:
+            old_postfix = self.pbar.postfix or ""
+            self.pbar.set_postfix_str(", ".join([old_postfix, f"{kind}: {item}"]))
 
+        try:
+            yield item
+        except BaseException:
+            self.requeue(kind, item)
+            raise
+        else:
+            self.complete(kind, item)
         finally:
             if self.pbar:
                 self.pbar.set_postfix_str(old_postfix)
+
+    def pop_user(self):
+        return self.pop(USER)
+
+    def pop_channel(self):
+        return self.pop(CHANNEL)
@@ -1,97 +1,400 @@
 import asyncio
 import contextlib
-import datetime as dt
+import contextvars
+import logging
+import random
 from typing import AsyncIterable
 
 import pyrogram
-from icontract import ensure, require
+from icontract import ensure
 from tqdm import tqdm
 from fsspec import AbstractFileSystem
 
 from account import Account
 from chat_cache import ChatCache, ChatCacheItem
+from lease import LEASE_TTL, Lease, make_owner_id
+from scheduler import AccountScheduler, RateLimit
+from utils import ensure_at_single
+
+ACC_RETRY_DELAY = 60  # через сколько секунд повторять запуск упавшего аккаунта
+ACC_RETRIES = 5  # сколько раз пытаться запустить аккаунт
+HISTORY_PAGE = 100  # сколько сообщений истории читать, заняв аккаунт (максимум API)
+
+# ошибки, означающие, что такого ника нет, и спрашивать снова бессмысленно;
+# PeerIdInvalid сюда не входит: он зависит от аккаунта и его кэша пиров
+MISSING_ERRORS = (
+    pyrogram.errors.UsernameNotOccupied,
+    pyrogram.errors.UsernameInvalid,
+)
 
 
 class Scanner:
     """Выполняет запросы к телеграму, используя коллекцию аккаунтов."""
 
     def __init__(
-        self, /, fs: AbstractFileSystem, phones: list[str] = None, chat_cache=True
+        self,
+        /,
+        fs: AbstractFileSystem,
+        phones: list[str] = None,
+        chat_cache=True,
+        rate_limits: dict[str, RateLimit] = None,
+        min_ready: int = 1,
     ):
         self.fs = fs
+        self.rate_limits = rate_limits
+        self.min_ready = min_ready
         self.phones = phones or [
             item.split(".session")[0] for item in fs.glob("*.session")
         ]
 
         if chat_cache:
             self.chat_cache = ChatCache(fs)
-            self.chat_cache.load()
         else:
             self.chat_cache = None
 
-        self.pbar = None
+        # у каждого вызова `session` свой прогресс-бар, даже если сканер
+        # одновременно обслуживает несколько сборов
+        self.pbar_var = contextvars.ContextVar(f"pbar_{id(self)}", default=None)
+        # прежний текст прогресс-бара и идущие флуд-вейты, по прогресс-барам
+        self.flood_waits: dict[tqdm, tuple[str, dict[object, int]]] = {}
+        self.in_flight: dict[tuple, asyncio.Task] = {}
+        self.accs: list[Account] = []
+        self.quarantined: dict[str, Exception] = {}
+        self.startup_tasks: list[asyncio.Task] = []
+        self.running = False
+
+        self.owner = make_owner_id()
+        self.leases: dict[str, Lease] = {}
+        self.heartbeat_task: asyncio.Task = None
+
+    @property
+    def pbar(self) -> tqdm | None:
+        return self.pbar_var.get()
+
+    @ensure(lambda self: all(acc.app.is_connected for acc in self.ready_accs()))
+    async def start_sessions(self, min_ready: int = None):
+        """Запускает аккаунты параллельно. Каждый аккаунт начинает принимать
+        запросы, как только подключится, а упавший уходит на карантин
+        и перезапускается позже. Возвращает управление, когда подключилось
+        `min_ready` аккаунтов. Запускаются только арендованные аккаунты."""
+        self.accs = [Account(phone, self.fs) for phone in self.leases]
+        self.scheduler = AccountScheduler(rate_limits=self.rate_limits)
+        self.quarantined: dict[str, Exception] = {}
+        self.startup_progress = asyncio.Event()
+        attempted = set()
+
+        # все строки сессий читаем одним запросом; файловые системы отдают
+        # их по нормализованным путям (LocalFileSystem - по абсолютным)
+        sessions = self.fs.cat([acc.filename for acc in self.accs], on_error="omit")
+        paths = {acc: self.fs._strip_protocol(acc.filename) for acc in self.accs}
+
+        self.startup_tasks = [
+            asyncio.create_task(
+                self.start_account(
+                    acc,
+                    sessions[paths[acc]].decode() if paths[acc] in sessions else None,
+                    attempted,
+                )
+            )
+            for acc in self.accs
+        ]
+
+        min_ready = min(min_ready or self.min_ready, len(self.accs))
+
+        while len(self.ready_accs()) < min_ready:
+            if len(attempted) == len(self.accs):
+                raise RuntimeError(
+                    f"Only {len(self.ready_accs())} of {len(self.accs)} accounts "
+                    f"started, {min_ready} needed: {self.quarantined}"
+                )
+
+            await self.startup_progress.wait()
+            self.startup_progress.clear()
+
+    async def start_account(self, acc: Account, session_str: str, attempted: set):
+        # после close_sessions у сканера уже другой планировщик
+        scheduler = self.scheduler
+        scheduler.pending += 1
+        delay = ACC_RETRY_DELAY
+
+        try:
+            for attempt in range(ACC_RETRIES):
+                try:
+                    await acc.start(session_str)
+
+                except Exception as e:
+                    self.quarantined[acc.phone] = e
+
+                else:
+                    self.quarantined.pop(acc.phone, None)
+                    scheduler.add(acc)
+                    return
+
+                finally:
+                    attempted.add(acc.phone)
+                    self.startup_progress.set()
+
+                if attempt == ACC_RETRIES - 1:
+                    break
+
+                await asyncio.sleep(delay)
+                delay *= 2
 
-    @ensure(lambda self: all(acc.app.is_connected for acc in self.accs))
-    @ensure(lambda self: all(acc.app for acc in self.accs))
-    async def start_sessions(self):
-        self.available_accs = asyncio.Queue()
-        self.accs = [Account(phone, self.fs) for phone in self.phones]
+        finally:
+            scheduler.pending -= 1
+            # ожидающие аккаунт должны узнать, что запускать больше нечего
+            scheduler.notify()
 
-        await asyncio.gather(*(acc.start() for acc in self.accs))
+    def ready_accs(self) -> list[Account]:
+        return [acc for acc in self.accs if acc.started]
 
-        for acc in self.accs:
-            self.available_accs.put_nowait(acc)
+    def usable_accs(self) -> list[Account]:
+        """Подключенные и еще запускающиеся аккаунты, кроме ушедших
+        на карантин. `start_sessions` возвращает управление, когда
+        подключилось лишь `min_ready` аккаунтов, поэтому пулы воркеров
+        считаются от этого списка, а не от `ready_accs`."""
+        return [acc for acc in self.accs if acc.phone not in self.quarantined]
 
     async def close_sessions(self):
-        await asyncio.gather(*[acc.stop() for acc in self.accs])
+        for task in self.startup_tasks:
+            task.cancel()
+        await asyncio.gather(*self.startup_tasks, return_exceptions=True)
+
+        # аккаунты останавливаются, даже если сохранить сессии не удалось
+        try:
+            await self.checkpoint_sessions()
+        except Exception:
+            logging.getLogger(__name__).exception("Saving sessions failed")
+
+        await asyncio.gather(
+            *(acc.stop(save=False) for acc in self.ready_accs()),
+            return_exceptions=True,
+        )
+
         self.accs = []
-        self.available_accs = asyncio.Queue()
+        self.startup_tasks = []
+        self.scheduler = AccountScheduler()
+
+    async def checkpoint_sessions(self):
+        """Записывает строки сессий всех подключенных аккаунтов одним запросом."""
+        accs = self.ready_accs()
+        session_strs = await asyncio.gather(*(acc.export_session() for acc in accs))
+
+        self.fs.pipe(
+            {
+                acc.filename: session_str.encode()
+                for acc, session_str in zip(accs, session_strs)
+            }
+        )
+
+    async def keep_alive(self):
+        """Пингует подключенные аккаунты, а отвалившиеся перезапускает
+        с последней сохраненной строкой сессии."""
+
+        async def ping(acc: Account):
+            try:
+                await acc.app.invoke(
+                    pyrogram.raw.functions.Ping(ping_id=random.getrandbits(63))
+                )
+            except Exception:
+                self.scheduler.remove(acc)
+                acc.started = False
+
+                # перезапускаем новым объектом: старый может быть еще занят
+                # запросом, и его возврат в планировщик будет проигнорирован
+                restarted = Account(acc.phone, self.fs)
+                self.accs[self.accs.index(acc)] = restarted
+                self.startup_tasks.append(
+                    asyncio.create_task(
+                        self.start_account(restarted, acc.session_str, set())
+                    )
+                )
+
+        await asyncio.gather(*(ping(acc) for acc in self.ready_accs()))
 
     @contextlib.asynccontextmanager
     async def session(self, pbar: tqdm = None):
-        SESSION_LOCK = ".session_lock"
-        if self.fs.exists(SESSION_LOCK):
-            raise RuntimeError("Sessions are already in use")
-
-        self.pbar = pbar
+        """Открывает сессии аккаунтов на время блока. Если сессии уже открыты
+        (например, их держит `ScannerService`), блок пользуется ими
+        и ничего не закрывает."""
+        pbar_token = self.pbar_var.set(pbar)
+
+        if self.running:
+            try:
+                yield
+            finally:
+                self.pbar_var.reset(pbar_token)
+            return
 
         try:
-            await self.start_sessions()
+            self.acquire_leases()
+            self.heartbeat_task = asyncio.create_task(self.heartbeat())
 
-            self.fs.touch(SESSION_LOCK)
+            await self.start_sessions()
+            self.running = True
 
             yield
 
         finally:
-            self.pbar = None
+            self.pbar_var.reset(pbar_token)
+            self.running = False
+
+            if self.heartbeat_task:
+                self.heartbeat_task.cancel()
+                self.heartbeat_task = None
+
+            try:
+                await self.close_sessions()
+            finally:
+                self.release_leases()
+
+                if self.chat_cache is not None:
+                    self.chat_cache.save()
+
+    def acquire_leases(self):
+        """Арендует все свободные аккаунты. Аккаунты, занятые другими
+        процессами, пропускаются, так что несколько процессов могут
+        работать одновременно на непересекающихся наборах аккаунтов."""
+        self.leases = {}
+
+        for phone in self.phones:
+            lease = Lease(self.fs, phone, self.owner)
+            if lease.acquire():
+                self.leases[phone] = lease
+
+        if not self.leases:
+            raise RuntimeError("Sessions are already in use")
+
+    def release_leases(self):
+        for lease in self.leases.values():
+            lease.release()
+        self.leases = {}
+
+    async def heartbeat(self):
+        """Продлевает аренды. Если аренду перехватили, аккаунт отключается,
+        потому что им уже пользуется другой процесс. Занятый в этот момент
+        аккаунт планировщик после запроса обратно в раздачу не вернет.
+
+        Хранилище аренд отвечает синхронно, поэтому запросы к нему идут
+        в отдельном потоке и не останавливают цикл событий."""
+        while True:
+            await asyncio.sleep(LEASE_TTL / 3)
+
+            for phone, lease in list(self.leases.items()):
+                try:
+                    renewed = await asyncio.to_thread(lease.renew)
+                except Exception:
+                    # временный сбой хранилища: попробуем в следующий раз
+                    continue
+
+                if renewed:
+                    continue
 
-            self.fs.rm(SESSION_LOCK)
+                del self.leases[phone]
 
-            await self.close_sessions()
+                for acc in self.accs:
+                    if acc.phone == phone and acc.started:
+                        self.scheduler.remove(acc)
+                        await acc.stop(save=False)
 
-            if self.chat_cache:
-                self.chat_cache.save()
+    async def single_flight(self, key: tuple, func, *args):
+        """Одновременные вызовы с одинаковым ключом выполняют `func` один раз
+        и получают один и тот же результат или одно и то же исключение."""
+        task = self.in_flight.get(key)
+
+        if not task:
+            task = asyncio.ensure_future(func(*args))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+
+        # отмена одного из ожидающих не должна отменять запрос для остальных
+        return await asyncio.shield(task)
 
     async def get_chat(self, chat_id) -> pyrogram.types.Chat:
-        if not self.chat_cache:
+        return await self.single_flight(
+            ("get_chat", ensure_at_single(chat_id)), self.fetch_chat, chat_id
+        )
+
+    async def fetch_chat(self, chat_id) -> pyrogram.types.Chat:
+        if self.chat_cache is None:
             return await self.process_command("get_chat", chat_id)
 
         if chat_id not in self.chat_cache:
-            chat = await self.process_command("get_chat", chat_id)
+            error = self.chat_cache.known_missing(chat_id)
+            if error:
+                raise getattr(pyrogram.errors, error)()
+
+            try:
+                chat = await self.process_command("get_chat", chat_id)
+            except MISSING_ERRORS as e:
+                self.chat_cache.set_missing(chat_id, type(e).__name__)
+                raise
+
             self.chat_cache[chat_id] = ChatCacheItem(chat)
 
         return self.chat_cache[chat_id].chat
 
+    async def get_chats(
+        self, chat_ids, concurrency: int = None
+    ) -> dict[str, pyrogram.types.Chat | pyrogram.errors.RPCError]:
+        """Получает сразу много чатов: сначала из кэша, а остальные
+        параллельно, не больше `concurrency` запросов одновременно
+        (по умолчанию по одному на аккаунт).
+
+        Ошибка по отдельному чату не прерывает остальные, а попадает
+        в результат вместо чата. Разрешение ников в телеграме не пакетное
+        (contacts.ResolveUsername принимает один ник), поэтому экономия
+        достигается кэшем и параллельностью."""
+        results = {}
+        misses = []
+
+        for chat_id in set(chat_ids):
+            if self.chat_cache is not None and chat_id in self.chat_cache:
+                results[chat_id] = self.chat_cache[chat_id].chat
+            else:
+                misses.append(chat_id)
+
+        semaphore = asyncio.Semaphore(concurrency or max(1, len(self.usable_accs())))
+
+        async def resolve(chat_id):
+            async with semaphore:
+                try:
+                    return await self.get_chat(chat_id)
+                except pyrogram.errors.RPCError as e:
+                    return e
+
+        results.update(
+            zip(misses, await asyncio.gather(*(resolve(chat_id) for chat_id in misses)))
+        )
+
+        return results
+
     async def get_chat_members_count(self, chat_id) -> int:
-        if not self.chat_cache:
+        return await self.single_flight(
+            ("get_chat_members_count", ensure_at_single(chat_id)),
+            self.fetch_chat_members_count,
+            chat_id,
+        )
+
+    async def fetch_chat_members_count(self, chat_id) -> int:
+        if self.chat_cache is None:
             return await self.process_command("get_chat_members_count", chat_id)
 
-        chat_cache_item = self.chat_cache[chat_id]
-        if not chat_cache_item.members_count:
-            chat_cache_item.members_count = await self.process_command(
-                "get_chat_members_count", chat_id
-            )
-        return chat_cache_item.members_count
+        members_count = self.chat_cache.get_members_count(chat_id)
+        if members_count is not None:
+            return members_count
+
+        # чата нет в кэше: get_chat заодно принесет и число подписчиков
+        if chat_id not in self.chat_cache:
+            await self.get_chat(chat_id)
+            members_count = self.chat_cache[chat_id].members_count
+            if members_count is not None:
+                return members_count
+
+        members_count = await self.process_command("get_chat_members_count", chat_id)
+        self.chat_cache.set_members_count(chat_id, members_count)
+
+        return members_count
 
     async def get_discussion_replies_count(self, chat_id, msg_id) -> int:
         try:
@@ -102,15 +405,37 @@ class Scanner:
             return 0
 
     async def get_chat_history(
-        self, chat_id, limit=None, min_date=None
+        self, chat_id, limit=None, min_date=None, min_id=None, offset_id=None
     ) -> AsyncIterable[pyrogram.types.Message]:
-        async for msg in self.process_iterator(
-            "get_chat_history",
-            chat_id,
-            limit,
-            breaking_trigger=lambda msg: msg.date < min_date if min_date else False,
-        ):
-            yield msg
+        """Сообщения чата от новых к старым, не старше `min_date`
+        и с id больше `min_id`. Если задан `offset_id`, выдача начинается
+        с сообщения, предшествующего ему.
+
+        История читается страницами по `HISTORY_PAGE` сообщений, и аккаунт
+        занят только на время чтения страницы. Пока вызывающий обрабатывает
+        сообщения или ждет места в своей очереди, аккаунт выполняет другие
+        запросы, в том числе вложенные запросы того же вызывающего."""
+        remaining = limit or None
+        offset_id = offset_id or 0
+
+        while True:
+            page_size = min(HISTORY_PAGE, remaining or HISTORY_PAGE)
+            page = await self.process_page(
+                "get_chat_history", chat_id, page_size, 0, offset_id
+            )
+
+            for msg in page:
+                if (min_date and msg.date < min_date) or (min_id and msg.id <= min_id):
+                    return
+                yield msg
+
+            if remaining:
+                remaining -= len(page)
+
+            if len(page) < page_size or remaining == 0:
+                return
+
+            offset_id = page[-1].id
 
     async def get_discussion_replies(
         self, chat_id, msg_id, limit=None
@@ -123,14 +448,20 @@ class Scanner:
 
     async def process_command(self, method: str, *args: list):
         while True:
-            async with self.get_acc() as acc:
+            async with self.get_acc(method) as acc:
                 return await getattr(acc.app, method)(*args)
 
+    async def process_page(self, method: str, *args: list) -> list:
+        """Читает выдачу итератора целиком и сразу возвращает аккаунт."""
+        while True:
+            async with self.get_acc(method) as acc:
+                return [result async for result in getattr(acc.app, method)(*args)]
+
     async def process_iterator(
         self, method: str, *args: list, breaking_trigger=lambda x: False
     ):
         while True:
-            async with self.get_acc() as acc:
+            async with self.get_acc(method) as acc:
                 async for result in getattr(acc.app, method)(*args):
                     if breaking_trigger(result):
                         break
@@ -138,57 +469,56 @@ class Scanner:
                 break
 
     @contextlib.asynccontextmanager
-    async def get_acc(self):
-        min_wait = self.min_wait()
-        if min_wait and min_wait > 1000:
-            available_at = dt.datetime.now() + dt.timedelta(seconds=min_wait)
-            raise RuntimeError(
-                f"All accounts unavailable. First available at {available_at}."
-            )
-
-        acc: Account = await self.available_accs.get()
-        acc.busy = True
+    async def get_acc(self, method: str = None):
+        """Выдает аккаунт, который раньше всех сможет выполнить `method`.
+        При флуд-вейте аккаунт откладывается планировщиком, а исключение
+        гасится, чтобы вызывающий повторил запрос с другим аккаунтом."""
+        acc: Account = await self.scheduler.acquire(method)
 
         try:
             yield acc
-            self.available_accs.put_nowait(acc)
-            acc.busy = False
 
         except pyrogram.errors.FloodWait as e:
-            asyncio.create_task(self.flood_wait(acc, e.value))
+            self.scheduler.release(acc, method, flood_wait=e.value)
+            self.report_flood_wait(e.value)
 
-        except Exception as e:
-            self.available_accs.put_nowait(acc)
-            acc.busy = False
+        except BaseException:
+            self.scheduler.release(acc, method)
             raise
 
-    def min_wait(self):
-        return min(
-            (
-                acc.flood_wait_timeout
-                - (dt.datetime.now() - acc.flood_wait_from).seconds
-                for acc in self.accs
-                if acc.flood_wait_from
-            ),
-            default=None,
-        )
-
-    async def flood_wait(self, acc: Account, timeout: int):
-        acc.flood_wait_from = dt.datetime.now()
-        acc.flood_wait_timeout = timeout
-
-        if self.pbar:
-            old_postfix = self.pbar.postfix or ""
-            self.pbar.set_postfix_str(
-                ", ".join([old_postfix, f"flood_wait {timeout} secs"])
+        else:
+            self.scheduler.release(acc, method)
+
+    def report_flood_wait(self, timeout: int):
+        """Показывает флуд-вейт в прогресс-баре на время его действия,
+        а после окончания последнего из них возвращает прежний текст."""
+        pbar = self.pbar
+        if not pbar:
+            return
+
+        if pbar not in self.flood_waits:
+            self.flood_waits[pbar] = (pbar.postfix or "", {})
+        _, waits = self.flood_waits[pbar]
+
+        token = object()
+        waits[token] = timeout
+        self.show_flood_waits(pbar)
+
+        def finish():
+            waits.pop(token, None)
+            self.show_flood_waits(pbar)
+            if not waits:
+                del self.flood_waits[pbar]
+
+        asyncio.get_running_loop().call_later(timeout, finish)
+
+    def show_flood_waits(self, pbar: tqdm):
+        old_postfix, waits = self.flood_waits[pbar]
+        pbar.set_postfix_str(
+            ", ".join(
+                [
+                    *filter(None, [old_postfix]),
+                    *(f"flood_wait {timeout} secs" for timeout in waits.values()),
+                ]
             )
-
-        await asyncio.sleep(timeout)
-
-        if self.pbar:
-            self.pbar.set_postfix_str(old_postfix)
-
-        self.available_accs.put_nowait(acc)
-
-        acc.flood_wait_from = None
-        acc.flood_wait_timeout = 0
+        )
@@ -0,0 +1,142 @@
+import asyncio
+import atexit
+import concurrent.futures
+import contextlib
+import logging
+import queue
+import threading
+import time
+
+from scanner import Scanner
+
+KEEPALIVE_INTERVAL = 60  # как часто пинговать аккаунты, секунд
+CHECKPOINT_INTERVAL = 600  # как часто сохранять строки сессий, секунд
+PROGRESS_INTERVAL = 0.2  # как часто переносить прогресс в вызывающий поток, секунд
+
+
+class ProgressRelay:
+    """Прогресс-бар для корутин, выполняющихся в потоке сервиса.
+
+    Вызовы `update` и `set_postfix_str` складываются в потокобезопасную
+    очередь, а к настоящему `pbar` их применяет `drain` в потоке, который
+    ждет результата. Так прогресс каждого сбора попадает в его собственный
+    прогресс-бар, а не в тот, что создан в чужом потоке."""
+
+    def __init__(self, pbar):
+        self.pbar = pbar
+        self.postfix = pbar.postfix
+        self.calls = queue.SimpleQueue()
+
+    def update(self, n=1):
+        self.calls.put(("update", n))
+
+    def set_postfix_str(self, s="", refresh=True):
+        self.postfix = s
+        self.calls.put(("set_postfix_str", s))
+
+    def drain(self):
+        while True:
+            try:
+                method, arg = self.calls.get_nowait()
+            except queue.Empty:
+                return
+            getattr(self.pbar, method)(arg)
+
+
+class ScannerService:
+    """Держит сессии сканера открытыми в фоновом потоке с собственным циклом
+    событий, чтобы не подключать аккаунты заново при каждом сборе.
+
+    Пока сервис работает, `Scanner.session` внутри запущенных через него
+    корутин пользуется уже подключенными аккаунтами. Сервис периодически
+    пингует аккаунты и сохраняет строки сессий."""
+
+    def __init__(
+        self,
+        scanner: Scanner,
+        keepalive_interval=KEEPALIVE_INTERVAL,
+        checkpoint_interval=CHECKPOINT_INTERVAL,
+    ):
+        self.scanner = scanner
+        self.keepalive_interval = keepalive_interval
+        self.checkpoint_interval = checkpoint_interval
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="scanner-service", daemon=True
+        )
+        self.ready = concurrent.futures.Future()
+        self.serving: concurrent.futures.Future = None
+        self.stopping: asyncio.Event = None
+
+    def start(self, timeout=None):
+        """Запускает поток и ждет, пока подключатся аккаунты."""
+        self.thread.start()
+        self.serving = asyncio.run_coroutine_threadsafe(self.serve(), self.loop)
+        self.ready.result(timeout)
+
+        atexit.register(self.stop)
+
+    def stop(self):
+        if not self.thread.is_alive():
+            return
+
+        self.loop.call_soon_threadsafe(self.stopping.set)
+        with contextlib.suppress(Exception):
+            self.serving.result()
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def submit(self, coro) -> concurrent.futures.Future:
+        """Запускает корутину в цикле сервиса из любого потока."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def run(self, coro, progress: ProgressRelay = None):
+        """Выполняет корутину в цикле сервиса и ждет результата
+        из цикла вызывающего. Если передан `progress`, накопленный
+        корутиной прогресс по ходу дела переносится в его прогресс-бар."""
+        future = asyncio.wrap_future(self.submit(coro))
+
+        if not progress:
+            return await future
+
+        while True:
+            done, _ = await asyncio.wait({future}, timeout=PROGRESS_INTERVAL)
+            progress.drain()
+            if done:
+                return future.result()
+
+    async def serve(self):
+        self.stopping = asyncio.Event()
+
+        try:
+            async with self.scanner.session():
+                self.ready.set_result(None)
+                await self.maintain()
+
+        except BaseException as e:
+            if not self.ready.done():
+                self.ready.set_exception(e)
+            raise
+
+    async def maintain(self):
+        last_checkpoint = time.monotonic()
+
+        while True:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.stopping.wait(), self.keepalive_interval)
+
+            if self.stopping.is_set():
+                return
+
+            # сбой обслуживания не должен останавливать сервис
+            try:
+                await self.scanner.keep_alive()
+
+                if time.monotonic() - last_checkpoint > self.checkpoint_interval:
+                    await self.scanner.checkpoint_sessions()
+                    last_checkpoint = time.monotonic()
+
+            except Exception:
+                logging.getLogger(__name__).exception("Scanner maintenance failed")
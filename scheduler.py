@@ -0,0 +1,306 @@
+import asyncio
+import heapq
+import itertools
+import random
+import time
+from collections import deque, namedtuple
+
+from account import Account
+
+RATE_WINDOW = 60  # за сколько секунд считать недавнюю частоту запросов аккаунта
+MAX_WAIT = 1000  # если ждать аккаунт дольше, считаем, что аккаунтов нет
+JITTER = 0.2  # на какую долю случайно удлинять паузы между запросами
+RECOVERY = 0.05  # какую долю отставания от лимита темп отыгрывает за успешный запрос
+FLOOD_MEMORY = 0.3  # вес последнего флуд-вейта в скользящем среднем по методу
+
+RateLimit = namedtuple("RateLimit", "rate burst")
+
+# сколько запросов в секунду и сколько подряд можно делать с одного аккаунта
+DEFAULT_RATE_LIMITS = {
+    "get_chat": RateLimit(rate=0.5, burst=5),
+    "get_chat_members_count": RateLimit(rate=0.5, burst=5),
+    "get_chat_history": RateLimit(rate=0.3, burst=3),
+    "get_discussion_replies": RateLimit(rate=0.3, burst=3),
+    "get_discussion_replies_count": RateLimit(rate=1, burst=10),
+}
+# с какого лимита начинать метод, которого нет в `rate_limits`, после первого
+# флуд-вейта по нему: к этому темпу он и будет восстанавливаться
+FALLBACK_RATE_LIMIT = RateLimit(rate=1, burst=10)
+
+
+class TokenBucket:
+    """Ограничивает частоту запросов одного метода с одного аккаунта:
+    `rate` запросов в секунду, не больше `capacity` подряд."""
+
+    def __init__(self, rate: float, capacity: float = 1, ceiling: float = None):
+        self.rate = rate
+        self.ceiling = ceiling or rate  # до какого темпа восстанавливаться
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Через сколько секунд можно будет сделать запрос."""
+        self.refill(now)
+        return max(0, (1 - self.tokens) / self.rate)
+
+    def consume(self, now: float):
+        self.refill(now)
+        self.tokens -= 1
+
+    def slow_down(self, flood_wait: int):
+        """Телеграм попросил подождать `flood_wait` секунд: текущий темп
+        слишком высок. Уменьшаем его вдвое, но не больше, чем до
+        `capacity` запросов за время ожидания."""
+        self.rate = min(self.rate / 2, self.capacity / max(flood_wait, 1))
+        self.tokens = 0
+        self.updated = time.monotonic()
+
+    def speed_up(self):
+        """Запрос прошел без флуд-вейта: понемногу возвращаем темп к лимиту."""
+        self.rate += (self.ceiling - self.rate) * RECOVERY
+
+
+class AccountScheduler:
+    """Раздает аккаунты под запросы.
+
+    Свободные аккаунты лежат в куче по времени, когда они освободятся от
+    флуд-вейта, и по частоте недавних запросов. Для каждого метода каждого
+    аккаунта заводится ведро токенов, темп которого подстраивается под
+    полученные флуд-вейты, так что запрос получает аккаунт, который сможет
+    выполнить именно этот метод раньше всех.
+
+    Для методов из `rate_limits` ведра заводятся сразу, и темп запросов
+    ограничивается заранее, а не только после флуд-вейта. Паузы случайно
+    удлиняются на долю `jitter`, чтобы аккаунты не срывались в запросы
+    одновременно."""
+
+    def __init__(
+        self,
+        accs: list[Account] = (),
+        max_wait=MAX_WAIT,
+        rate_limits: dict[str, RateLimit] = None,
+        jitter=JITTER,
+    ):
+        self.max_wait = max_wait
+        self.rate_limits = DEFAULT_RATE_LIMITS if rate_limits is None else rate_limits
+        self.jitter = jitter
+        self.typical_flood_wait: dict[str, float] = {}
+
+        self.idle = []  # куча (available_at, recent_rate, seq, acc)
+        self.busy: set[Account] = set()
+        self.registered: set[Account] = set()  # аккаунты, которые раздаются
+        self.pending = 0  # сколько аккаунтов еще запускается
+        self.buckets: dict[tuple[str, str], TokenBucket] = {}
+        self.requests: dict[str, deque[float]] = {}
+        self.seq = itertools.count()
+        self.wakeups: set[asyncio.Future] = set()
+
+        self.waiters = 0
+        self.acquired = 0
+        self.total_wait = 0.0
+        self.max_observed_wait = 0.0
+
+        for acc in accs:
+            self.add(acc)
+
+    def add(self, acc: Account, available_at: float = None):
+        self.registered.add(acc)
+        self.requests.setdefault(acc.phone, deque())
+        heapq.heappush(
+            self.idle,
+            (
+                available_at or time.monotonic(),
+                self.recent_rate(acc),
+                next(self.seq),
+                acc,
+            ),
+        )
+        self.notify()
+
+    def notify(self):
+        """Будит ожидающих аккаунт, чтобы они заново оценили ситуацию."""
+        for wakeup in self.wakeups:
+            if not wakeup.done():
+                wakeup.set_result(None)
+
+    def recent_rate(self, acc: Account) -> float:
+        """Запросов в секунду за последние `RATE_WINDOW` секунд."""
+        requests = self.requests[acc.phone]
+        now = time.monotonic()
+        while requests and requests[0] < now - RATE_WINDOW:
+            requests.popleft()
+        return len(requests) / RATE_WINDOW
+
+    def bucket(self, acc: Account, method: str) -> TokenBucket | None:
+        key = (acc.phone, method)
+        if key not in self.buckets and method in self.rate_limits:
+            limit = self.rate_limits[method]
+            self.buckets[key] = TokenBucket(limit.rate, limit.burst)
+        return self.buckets.get(key)
+
+    def ready_at(self, available_at: float, acc: Account, method: str) -> float:
+        bucket = self.bucket(acc, method)
+        if not bucket:
+            return available_at
+        now = time.monotonic()
+        return max(available_at, now + bucket.wait_time(now))
+
+    def pick(self, method: str) -> tuple[float, tuple]:
+        """Находит свободный аккаунт, который раньше всех выполнит `method`.
+        Возвращает время его готовности и его элемент кучи.
+
+        Ведра могут только отодвинуть время готовности, поэтому, как только
+        в куче остались аккаунты, освобождающиеся позже лучшего найденного
+        времени, дальше можно не смотреть."""
+        best_ready, best_item = None, None
+        popped = []
+
+        while self.idle and (best_ready is None or self.idle[0][0] < best_ready):
+            item = heapq.heappop(self.idle)
+            popped.append(item)
+
+            ready = self.ready_at(item[0], item[3], method)
+            if best_ready is None or ready < best_ready:
+                best_ready, best_item = ready, item
+
+        for item in popped:
+            heapq.heappush(self.idle, item)
+
+        return best_ready, best_item
+
+    def take(self, item: tuple, method: str) -> Account:
+        self.idle.remove(item)
+        heapq.heapify(self.idle)
+
+        acc = item[3]
+        now = time.monotonic()
+        bucket = self.bucket(acc, method)
+        if bucket:
+            bucket.consume(now)
+        self.requests[acc.phone].append(now)
+        self.busy.add(acc)
+
+        return acc
+
+    def min_wait(self) -> float | None:
+        """Через сколько секунд освободится хотя бы один аккаунт."""
+        if not self.idle:
+            return None
+        return max(0, self.idle[0][0] - time.monotonic())
+
+    async def acquire(self, method: str = None) -> Account:
+        started = time.monotonic()
+        self.waiters += 1
+
+        try:
+            while True:
+                ready, item = self.pick(method)
+                now = time.monotonic()
+
+                if ready is not None and ready <= now:
+                    acc = self.take(item, method)
+                    break
+
+                # занятые и запускающиеся аккаунты скоро вернутся, а если
+                # их нет, а свободные освободятся нескоро, ждать бессмысленно
+                if (
+                    not self.busy
+                    and not self.pending
+                    and (ready is None or ready - now > self.max_wait)
+                ):
+                    raise RuntimeError(
+                        "All accounts unavailable."
+                        + (
+                            f" First available in {ready - now:.0f} seconds."
+                            if ready is not None
+                            else ""
+                        )
+                    )
+
+                # ждем, пока аккаунт вернут или подойдет его время
+                wakeup = asyncio.get_running_loop().create_future()
+                self.wakeups.add(wakeup)
+                try:
+                    await asyncio.wait_for(
+                        wakeup,
+                        None
+                        if ready is None
+                        else (ready - now) * random.uniform(1, 1 + self.jitter),
+                    )
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    self.wakeups.discard(wakeup)
+
+        finally:
+            self.waiters -= 1
+
+        waited = time.monotonic() - started
+        self.acquired += 1
+        self.total_wait += waited
+        self.max_observed_wait = max(self.max_observed_wait, waited)
+
+        return acc
+
+    def release(self, acc: Account, method: str = None, flood_wait: int = None):
+        """Возвращает аккаунт. Если запрос закончился флуд-вейтом, аккаунт
+        не выдается до его окончания, а темп запросов метода снижается
+        относительно того, с которым аккаунт работал до флуд-вейта,
+        и тем сильнее, чем дольше бывали флуд-вейты по этому методу."""
+        self.busy.discard(acc)
+
+        # аккаунт убрали из раздачи, пока он был занят: обратно его не кладем
+        if acc not in self.registered:
+            self.notify()
+            return
+
+        available_at = time.monotonic()
+        bucket = self.bucket(acc, method)
+
+        if flood_wait:
+            available_at += flood_wait
+
+            typical = self.typical_flood_wait.get(method, flood_wait)
+            typical += (flood_wait - typical) * FLOOD_MEMORY
+            self.typical_flood_wait[method] = typical
+
+            if not bucket:
+                bucket = self.buckets[(acc.phone, method)] = TokenBucket(
+                    rate=max(self.recent_rate(acc), FALLBACK_RATE_LIMIT.rate),
+                    capacity=FALLBACK_RATE_LIMIT.burst,
+                )
+            bucket.slow_down(max(flood_wait, typical))
+
+        elif bucket:
+            bucket.speed_up()
+
+        self.add(acc, available_at)
+
+    def remove(self, acc: Account):
+        """Убирает аккаунт из раздачи, например, когда он отключился.
+        Если аккаунт сейчас занят, `release` его уже не вернет."""
+        self.registered.discard(acc)
+        self.busy.discard(acc)
+        self.idle = [item for item in self.idle if item[3] is not acc]
+        heapq.heapify(self.idle)
+        self.notify()
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "idle": sum(1 for item in self.idle if item[0] <= now),
+            "busy": len(self.busy),
+            "flood_waiting": sum(1 for item in self.idle if item[0] > now),
+            "waiters": self.waiters,
+            "acquired": self.acquired,
+            "mean_wait": self.total_wait / self.acquired if self.acquired else 0,
+            "max_wait": self.max_observed_wait,
+            "typical_flood_wait": dict(self.typical_flood_wait),
+        }
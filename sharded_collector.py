@@ -0,0 +1,237 @@
+import asyncio
+import multiprocessing as mp
+import os
+import queue as queue_module
+from typing import Callable
+
+from fsspec import AbstractFileSystem
+
+from msg_columns import MsgColumns
+from msg_store import REFRESH_WINDOW, MessageStore
+from scanner import Scanner
+from stats_collector import REPLIES_WINDOW, Channel, StatsCollector
+
+ACCS_PER_SHARD = 4  # меньше аккаунтов на процесс не дают выигрыша
+POLL_INTERVAL = 1  # как часто проверять, живы ли процессы
+JOIN_TIMEOUT = 30  # сколько ждать завершения процесса после сбора
+
+# типы сообщений от процессов
+RESULT, ERROR, FAILED, DONE = "result", "error", "failed", "done"
+
+
+class ShardedStatsCollector(StatsCollector):
+    """Собирает статистику в нескольких процессах.
+
+    Каналы и аккаунты делятся между `shards` процессами, каждый запускает
+    свой `Scanner` на своей части аккаунтов, так что расшифровка и разбор
+    сообщений не упираются в одно ядро. Результаты по каналам приходят
+    через очередь по мере готовности и собираются в те же `msgs_df`
+    и `stats`, что и у `StatsCollector`.
+
+    Процессы запускаются заново (spawn), поэтому файловая система
+    передается фабрикой, которую можно распиклить, например функцией
+    уровня модуля или `functools.partial`. Хранилище постов подключается
+    так же, через `msg_store_fs_factory`."""
+
+    def __init__(
+        self,
+        fs_factory: Callable[[], AbstractFileSystem],
+        phones: list[str] = None,
+        shards: int = None,
+        min_date=None,
+        replies_window=REPLIES_WINDOW,
+        msg_store_fs_factory: Callable[[], AbstractFileSystem] = None,
+        refresh_window=REFRESH_WINDOW,
+        spill_fs=None,
+    ):
+        super().__init__(
+            None,
+            min_date=min_date,
+            replies_window=replies_window,
+            refresh_window=refresh_window,
+            spill_fs=spill_fs,
+        )
+        self.fs_factory = fs_factory
+        self.phones = phones
+        self.shards = shards
+        self.msg_store_fs_factory = msg_store_fs_factory
+
+    async def collect_all_stats(self, channels, pbar=None, workers=None):
+        """Собирает статистику по каналам в нескольких процессах.
+
+        `workers` - сколько каналов каждый процесс обрабатывает одновременно,
+        по умолчанию половина его аккаунтов. Каналы упавших процессов
+        попадают в `self.errors`."""
+        channels = list(channels)
+        self.errors = {}
+        self.msgs = MsgColumns(channels, spill_fs=self.spill_fs)
+
+        phones = self.phones or [
+            item.split(".session")[0] for item in self.fs_factory().glob("*.session")
+        ]
+        shards = self.shards or max(
+            1, min(os.cpu_count() or 1, len(phones) // ACCS_PER_SHARD)
+        )
+        shards = max(1, min(shards, len(phones), len(channels)))
+
+        # раскладываем по кругу, чтобы доли были примерно равными
+        shard_phones = [phones[i::shards] for i in range(shards)]
+        shard_channels = [channels[i::shards] for i in range(shards)]
+
+        options = {
+            "min_date": self.min_date,
+            "replies_window": self.replies_window,
+            "refresh_window": self.refresh_window,
+        }
+
+        ctx = mp.get_context("spawn")
+        queue = ctx.Queue()
+        processes = [
+            ctx.Process(
+                target=run_shard,
+                args=(
+                    shard,
+                    self.fs_factory,
+                    self.msg_store_fs_factory,
+                    shard_phones[shard],
+                    shard_channels[shard],
+                    options,
+                    workers,
+                    queue,
+                ),
+                daemon=True,
+            )
+            for shard in range(shards)
+        ]
+
+        for process in processes:
+            process.start()
+
+        results = {}
+
+        try:
+            async for kind, *payload in self.receive(queue, processes):
+                if kind == RESULT:
+                    channel, msgs, channel_stat = payload
+                    self.msgs.extend(msgs)
+                    results[channel] = Channel(*channel_stat)
+
+                elif kind == ERROR:
+                    channel, error = payload
+                    self.errors[channel] = RuntimeError(error)
+
+                elif kind == FAILED:
+                    shard, error = payload
+                    for channel in shard_channels[shard]:
+                        if channel not in results:
+                            self.errors.setdefault(channel, RuntimeError(error))
+                    continue
+
+                else:
+                    continue
+
+                if pbar:
+                    pbar.set_postfix_str(channel)
+                    pbar.update()
+
+        except BaseException:
+            for process in processes:
+                process.terminate()
+            raise
+
+        finally:
+            for process in processes:
+                process.join(JOIN_TIMEOUT)
+                if process.is_alive():
+                    process.terminate()
+
+        # каналы процессов, упавших без сообщения
+        for channel in channels:
+            if channel not in results and channel not in self.errors:
+                self.errors[channel] = RuntimeError("Worker process exited")
+
+        self.merge_results([results.get(channel) for channel in channels])
+
+    @staticmethod
+    async def receive(queue, processes: list[mp.Process]):
+        """Сообщения процессов, пока все не закончат работу или не упадут.
+        Очередь читается в отдельном потоке, чтобы не блокировать цикл."""
+        loop = asyncio.get_running_loop()
+        done = 0
+
+        while done < len(processes):
+            try:
+                message = await loop.run_in_executor(
+                    None, queue.get, True, POLL_INTERVAL
+                )
+            except queue_module.Empty:
+                # очередь пуста, а писать в нее уже некому
+                if not any(process.is_alive() for process in processes):
+                    return
+                continue
+
+            if message[0] == DONE:
+                done += 1
+            else:
+                yield message
+
+
+def run_shard(
+    shard,
+    fs_factory,
+    msg_store_fs_factory,
+    phones,
+    channels,
+    options,
+    workers,
+    queue,
+):
+    """Точка входа процесса: собирает статистику своей доли каналов."""
+    try:
+        asyncio.run(
+            collect_shard(
+                fs_factory,
+                msg_store_fs_factory,
+                phones,
+                channels,
+                options,
+                workers,
+                queue,
+            )
+        )
+    except Exception as e:
+        queue.put((FAILED, shard, repr(e)))
+    finally:
+        queue.put((DONE, shard))
+
+
+async def collect_shard(
+    fs_factory, msg_store_fs_factory, phones, channels, options, workers, queue
+):
+    # кэш чатов общий для всех процессов, поэтому здесь он не ведется
+    scanner = Scanner(fs=fs_factory(), phones=phones, chat_cache=False)
+    collector = StatsCollector(
+        scanner,
+        msg_store=(
+            MessageStore(msg_store_fs_factory()) if msg_store_fs_factory else None
+        ),
+        **options,
+    )
+    collector.errors = {}
+
+    async def collect(channel, semaphore):
+        result = await collector.collect_single_channel(channel, semaphore)
+
+        # Msg не пиклится из-за несовпадения имени, поэтому шлем кортежи
+        if result:
+            msgs, channel_stat = result
+            queue.put(
+                (RESULT, channel, [tuple(msg) for msg in msgs], tuple(channel_stat))
+            )
+        else:
+            queue.put((ERROR, channel, repr(collector.errors[channel])))
+
+    async with scanner.session():
+        workers = workers or max(1, len(scanner.usable_accs()) // 2)
+        semaphore = asyncio.Semaphore(workers)
+        await asyncio.gather(*(collect(channel, semaphore) for channel in channels))
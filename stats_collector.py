@@ -1,11 +1,17 @@
+import asyncio
 import datetime as dt
 from collections import namedtuple
 
 import pandas as pd
 
+from checkpoint import DONE, PARTIAL, RunCheckpoint
+from msg_columns import MsgColumns
+from msg_store import REFRESH_WINDOW, MessageStore
 from scanner import Scanner
 
 LIMIT_HISTORY = dt.timedelta(days=30)  # насколько лезть вглубь чата
+REPLIES_WINDOW = 20  # сколько запросов числа комментариев держать в полете
+CHECKPOINT_EVERY = 100  # через сколько постов сохранять промежуточный результат
 
 
 Msg = namedtuple("Message", "username link reach reactions datetime text")
@@ -14,47 +20,196 @@ Channel = namedtuple("Channel", "username subscribers")
 
 class StatsCollector:
     scanner: Scanner
+    msg_store: MessageStore
+    checkpoint: RunCheckpoint
 
-    def __init__(self, scanner, min_date=None):
+    def __init__(
+        self,
+        scanner,
+        min_date=None,
+        replies_window=REPLIES_WINDOW,
+        msg_store: MessageStore = None,
+        refresh_window=REFRESH_WINDOW,
+        checkpoint: RunCheckpoint = None,
+        spill_fs=None,
+    ):
         self.scanner = scanner
         self.min_date = min_date
+        self.replies_window = replies_window
+        self.msg_store = msg_store
+        self.refresh_window = refresh_window
+        self.checkpoint = checkpoint
+        self.spill_fs = spill_fs
 
-    async def collect_all_stats(self, channels, pbar=None):
-        msg_stats = []
-        channel_stats = []
+    async def collect_all_stats(self, channels, pbar=None, workers=None):
+        """Собирает статистику по каналам параллельно.
+
+        `workers` - сколько каналов обрабатывать одновременно. По умолчанию
+        половина рабочих аккаунтов сканера (`Scanner.usable_accs`): каждая
+        страница истории канала занимает аккаунт, а остальные нужны для
+        подсчета комментариев к постам.
+        Упавшие каналы не прерывают сбор и попадают в `self.errors`.
+
+        Если подключен `checkpoint`, собранное по каждому каналу сохраняется
+        по ходу сбора, а после сбора без ошибок файлы запуска удаляются.
+
+        Посты каждого канала сразу перекладываются в `MsgColumns`, так что
+        в памяти не копятся списки кортежей. С `spill_fs` большие сборы
+        сбрасываются на диск.
+        """
+        channels = list(channels)
+        self.errors = {}
+        self.msgs = MsgColumns(channels, spill_fs=self.spill_fs)
+
+        if self.checkpoint:
+            self.checkpoint.prune()
+
+        async def collect(channel, semaphore):
+            result = await self.collect_single_channel(channel, semaphore, pbar)
+            if result:
+                msgs, channel_stat = result
+                self.msgs.extend(msgs)
+                return channel_stat
 
         async with self.scanner.session(pbar):
-            for channel in channels:
-                if pbar:
-                    pbar.set_postfix_str(channel)
+            workers = workers or max(1, len(self.scanner.usable_accs()) // 2)
+            semaphore = asyncio.Semaphore(workers)
 
-                msg_stats.extend(await self.collect_msg_stats(channel))
-                channel_stats.append(await self.collect_channel_stats(channel))
+            channel_stats = await asyncio.gather(
+                *(collect(channel, semaphore) for channel in channels)
+            )
 
-                if pbar:
-                    pbar.update()
+        self.merge_results(channel_stats)
 
-        self.msgs_df = pd.DataFrame(msg_stats)
-        self.channels_df = pd.DataFrame(channel_stats)
+        if self.checkpoint and not self.errors:
+            self.checkpoint.clear()
+
+    def merge_results(self, channel_stats: list[Channel | None]):
+        """Собирает посты из `self.msgs` и статистику каналов в `msgs_df`,
+        `channels_df` и `stats`. Пропуски на месте упавших каналов
+        игнорируются. Посты каждого канала остаются в порядке выдачи истории,
+        а каналы идут в порядке `channels`."""
+        self.msgs_df = self.msgs.to_frame()
+        self.msgs.cleanup()
+
+        self.channels_df = pd.DataFrame(
+            [channel_stat for channel_stat in channel_stats if channel_stat],
+            columns=Channel._fields,
+        )
 
         self.calc_msg_popularity()
         self.collect_stats_to_single_df()
 
-    async def collect_msg_stats(self, channel) -> list[Msg]:
-        msgs = []
+    async def collect_single_channel(
+        self, channel, semaphore: asyncio.Semaphore, pbar=None
+    ) -> tuple[list[Msg], Channel] | None:
+        async with semaphore:
+            if pbar:
+                pbar.set_postfix_str(channel)
+
+            try:
+                saved = self.checkpoint.load(channel) if self.checkpoint else None
+                if saved and saved["status"] == DONE:
+                    return (
+                        [to_msg(record) for record in saved["msgs"]],
+                        Channel(**saved["channel"]),
+                    )
+
+                msgs = await self.collect_msg_stats(channel, saved)
+                channel_stat = await self.collect_channel_stats(channel)
+
+                if self.checkpoint:
+                    self.checkpoint.save(
+                        channel,
+                        DONE,
+                        [msg._asdict() for msg in msgs],
+                        channel_stat._asdict(),
+                    )
+
+            except Exception as e:
+                self.errors[channel] = e
+                return None
+
+            finally:
+                if pbar:
+                    pbar.update()
+
+        return msgs, channel_stat
+
+    async def collect_msg_stats(self, channel, saved: dict = None) -> list[Msg]:
+        """Собирает статистику постов канала.
+
+        Если подключено хранилище постов, у телеграма запрашиваются только
+        посты новее последнего сбора и посты моложе `refresh_window`,
+        остальные берутся из хранилища. `saved` - недособранные посты
+        из `checkpoint`, сбор продолжается с последнего из них."""
+        resumed = (
+            [(record["id"], to_msg(record)) for record in saved["msgs"]]
+            if saved
+            else []
+        )
+
+        if not self.msg_store:
+            fetched = await self.fetch_msg_stats(channel, resumed=resumed)
+            return [msg for _, msg in fetched]
+
+        min_id = self.msg_store.settled_id(
+            channel, dt.datetime.now() - self.refresh_window
+        )
+        fetched = await self.fetch_msg_stats(channel, min_id, resumed)
+
+        self.msg_store.update(
+            channel,
+            {msg_id: to_record(msg_id, msg) for msg_id, msg in fetched},
+            self.min_date,
+        )
 
-        async for msg in self.scanner.get_chat_history(channel, min_date=self.min_date):
-            reactions = (
-                (
+        return [
+            to_msg(record)
+            for record in self.msg_store.messages(channel, self.min_date)
+        ]
+
+    async def fetch_msg_stats(
+        self, channel, min_id=None, resumed: list[tuple[int, Msg]] = ()
+    ) -> list[tuple[int, Msg]]:
+        """Листает историю канала, а количество комментариев к постам
+        запрашивает параллельно, не более `replies_window` запросов за раз.
+        Запросы расходятся по свободным аккаунтам через `Scanner.get_acc`.
+
+        Если переданы уже собранные посты `resumed`, история листается
+        начиная с поста старше последнего из них. С подключенным
+        `checkpoint` готовые посты сохраняются каждые `CHECKPOINT_EVERY`
+        постов и при ошибке."""
+        resumed = list(resumed)
+        window = asyncio.Semaphore(self.replies_window)
+        pending: list[tuple[int, Msg, asyncio.Task]] = []
+
+        async def count_replies(msg_id):
+            try:
+                return await self.scanner.get_discussion_replies_count(
+                    channel, msg_id
+                )
+            finally:
+                window.release()
+
+        try:
+            async for msg in self.scanner.get_chat_history(
+                channel,
+                min_date=self.min_date,
+                min_id=min_id,
+                offset_id=resumed[-1][0] if resumed else None,
+            ):
+                # если окно заполнено, ждем, пока освободится место
+                await window.acquire()
+                replies = asyncio.create_task(count_replies(msg.id))
+
+                reactions = (
                     sum(reaction.count for reaction in msg.reactions.reactions)
                     if msg.reactions
                     else 0
-                )
-                + (msg.forwards or 0)
-                + await self.scanner.get_discussion_replies_count(channel, msg.id)
-            )
-            msgs.append(
-                Msg(
+                ) + (msg.forwards or 0)
+
+                msg_stats = Msg(
                     username=channel,
                     link=msg.link,
                     reach=msg.views or 0,
@@ -62,26 +217,73 @@ class StatsCollector:
                     datetime=msg.date,
                     text=shorten(msg.text or msg.caption),
                 )
-            )
+                pending.append((msg.id, msg_stats, replies))
+
+                if self.checkpoint and len(pending) % CHECKPOINT_EVERY == 0:
+                    self.save_partial(channel, resumed, pending)
 
-        return msgs
+            replies_counts = await asyncio.gather(*(task for *_, task in pending))
+
+        except BaseException:
+            # сохраняем готовое до отмены: отмененные задачи уже не готовы
+            if self.checkpoint:
+                self.save_partial(channel, resumed, pending)
+
+            for *_, task in pending:
+                task.cancel()
+            raise
+
+        return resumed + [
+            (msg_id, msg._replace(reactions=msg.reactions + replies_count))
+            for (msg_id, msg, _), replies_count in zip(pending, replies_counts)
+        ]
+
+    def save_partial(self, channel, resumed, pending):
+        """Сохраняет посты, для которых уже посчитаны комментарии,
+        до первого недосчитанного, чтобы продолжить сбор с него."""
+        done = []
+
+        for msg_id, msg, task in pending:
+            if not task.done() or task.cancelled() or task.exception():
+                break
+            done.append((msg_id, msg._replace(reactions=msg.reactions + task.result())))
+
+        self.checkpoint.save(
+            channel,
+            PARTIAL,
+            [to_record(msg_id, msg) for msg_id, msg in resumed + done],
+        )
 
     async def collect_channel_stats(self, channel) -> Channel:
-        chat = await self.scanner.get_chat(channel)
+        # число подписчиков кэшируется на меньший срок, чем сам чат
+        subscribers = await self.scanner.get_chat_members_count(channel)
 
-        return Channel(username=channel, subscribers=chat.members_count)
+        return Channel(username=channel, subscribers=subscribers)
 
     def calc_msg_popularity(self):
         self.msgs_df["popularity"] = self.msgs_df.reactions / self.msgs_df.reach
 
     def collect_stats_to_single_df(self):
-        self.stats = self.msgs_df.groupby("username").agg({"reach": "mean"}).astype(int)
+        self.stats = (
+            self.msgs_df.groupby("username", observed=True)
+            .agg({"reach": "mean"})
+            .astype(int)
+        )
+        self.stats.index = self.stats.index.astype(str)
         self.stats["subscribers"] = self.channels_df.set_index("username")[
             "subscribers"
         ]
         self.stats.reset_index(inplace=True)
 
 
+def to_record(msg_id, msg: Msg) -> dict:
+    return {"id": msg_id, **msg._asdict()}
+
+
+def to_msg(record: dict) -> Msg:
+    return Msg(**{field: record[field] for field in Msg._fields})
+
+
 def shorten(text: str, max_length=200):
     return (
         text.encode("utf-8").decode("utf-8")[:max_length] + "..."
@@ -1,16 +1,56 @@
 import datetime as dt
+import logging
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import pandas as pd
 import supabase
+from fsspec import AbstractFileSystem
+from fsspec.implementations.local import LocalFileSystem
+
+STATS_COLUMNS = ["run_id", "created_at", "username", "reach", "subscribers"]
+STATS_SNAPSHOT = ".stats_snapshot.parquet"
+PAGE_SIZE = 1000  # PostgREST returns at most this many rows per request
+TIMEZONE = "Europe/Moscow"
+
+STATS_WRITE_COLUMNS = ["username", "reach", "subscribers"]
+POSTS_WRITE_COLUMNS = [
+    "username",
+    "link",
+    "reach",
+    "reactions",
+    "popularity",
+    "datetime",
+    "text",
+]
+CHUNK_SIZE = 500  # rows per upsert request
+WRITE_RETRIES = 5
+RETRY_DELAY = 1  # seconds before the first retry, doubled after each attempt
+
+logger = logging.getLogger(__name__)
 
 
 class StatsDatabase:
     """Loads the channel list and the full statistics dataframe from the Supabase database.
     Calculates the last statictics dataframe and timedelta since the last statictics update.
-    Saves new statictics to the database."""
+    Saves new statictics to the database.
 
-    def __init__(self, client: supabase.Client):
+    The statistics history is kept in a local parquet snapshot, so each load
+    fetches only the rows added since the snapshot was taken."""
+
+    def __init__(
+        self,
+        client: supabase.Client,
+        fs: AbstractFileSystem = None,
+        snapshot_path=STATS_SNAPSHOT,
+        page_size=PAGE_SIZE,
+    ):
         self.client = client
+        self.fs = fs or LocalFileSystem()
+        self.snapshot_path = snapshot_path
+        self.page_size = page_size
+        self.writer = ThreadPoolExecutor(max_workers=1)
 
     def load_data(self) -> None:
         """Loads the channel list and the full statistics dataframe from the Supabase database."""
@@ -25,13 +65,75 @@ class StatsDatabase:
         self.channels = {item["username"] for item in list_of_dicts}
 
     def load_stats_dataframe(self):
-        """Returns the full statistics dataframe from the database."""
-        self.stats_df = pd.DataFrame(
-            self.client.table("stats").select("*").execute().data
+        """Loads the full statistics dataframe: the local snapshot plus the rows
+        added to the database since then."""
+        cached = self.load_snapshot()
+
+        # rows of the latest cached collection are fetched again in case it was
+        # still being written when the snapshot was taken
+        since = cached.created_at.max() if not cached.empty else None
+        new_rows = self.fetch_stats(since)
+
+        # a resumed collection upserts its rows again with a newer `created_at`,
+        # so rows are deduplicated on the run, not on the timestamp
+        self.stats_df = (
+            pd.concat([cached, new_rows], ignore_index=True)
+            .drop_duplicates(["run_id", "username"], keep="last")
+            .reset_index(drop=True)
         )
-        self.stats_df["created_at"] = pd.to_datetime(
-            self.stats_df["created_at"], utc=True
-        ).dt.tz_convert("Europe/Moscow")
+
+        if not new_rows.empty:
+            self.save_snapshot()
+
+    def fetch_stats(self, since: pd.Timestamp = None) -> pd.DataFrame:
+        """Fetches the statistics rows created at or after `since`, page by page."""
+        rows = []
+
+        while True:
+            query = self.client.table("stats").select(*STATS_COLUMNS)
+            if since is not None:
+                query = query.gte("created_at", since.tz_convert("UTC").isoformat())
+
+            page = (
+                query.order("created_at")
+                .order("username")
+                .range(len(rows), len(rows) + self.page_size - 1)
+                .execute()
+                .data
+            )
+            rows.extend(page)
+
+            if len(page) < self.page_size:
+                break
+
+        return self.to_dataframe(rows)
+
+    @staticmethod
+    def to_dataframe(rows: list[dict]) -> pd.DataFrame:
+        df = pd.DataFrame(rows, columns=STATS_COLUMNS)
+        # rows written before run ids were introduced are one run per timestamp
+        df["run_id"] = df["run_id"].fillna(df["created_at"]).astype(str)
+        df["created_at"] = pd.to_datetime(df["created_at"], utc=True).dt.tz_convert(
+            TIMEZONE
+        )
+        return df
+
+    def load_snapshot(self) -> pd.DataFrame:
+        if not self.fs.exists(self.snapshot_path):
+            return self.to_dataframe([])
+
+        with self.fs.open(self.snapshot_path, "rb") as f:
+            snapshot = pd.read_parquet(f)
+
+        if "run_id" not in snapshot:
+            # the snapshot predates run ids: rebuild it from the database
+            return self.to_dataframe([])
+
+        return snapshot
+
+    def save_snapshot(self):
+        with self.fs.open(self.snapshot_path, "wb") as f:
+            self.stats_df.to_parquet(f, index=False)
 
     def calc_last_stats_dataframe(self):
         """Calculates the last statictics dataframe from the database."""
@@ -44,7 +146,91 @@ class StatsDatabase:
         """Calculates the timedelta since the last statictics update."""
         self.delta = dt.datetime.now(dt.timezone.utc) - self.max_datetime
 
-    def save_new_stats_to_db(self, stats_df: pd.DataFrame):
-        """Saves the new statictics dataframe to the database."""
-        data = stats_df[["username", "reach", "subscribers"]].to_dict("records")
-        self.client.table("stats").insert(data).execute()
+    def save_new_stats_to_db(
+        self,
+        stats_df: pd.DataFrame,
+        msgs_df: pd.DataFrame = None,
+        run_id: str = None,
+        background=False,
+    ) -> Future | None:
+        """Saves the new statictics dataframe to the database, and the posts
+        dataframe to the `posts` table if it is given.
+
+        Every row is tagged with the run id and a single `created_at`, and is
+        upserted on `(run_id, username)` for stats or `(run_id, link)` for posts.
+        So a retried or repeated write of the same run never duplicates rows.
+        Rows are sent in chunks of `CHUNK_SIZE`, and each chunk is retried
+        with exponential backoff.
+
+        With `background=True` the write runs in a worker thread and a future
+        is returned instead of blocking the caller. The records are built
+        before that, so the caller may keep modifying the dataframes."""
+        run_id = str(run_id or uuid.uuid4().hex)
+        created_at = dt.datetime.now(dt.timezone.utc).isoformat()
+
+        stats_records = to_records(stats_df[STATS_WRITE_COLUMNS], run_id, created_at)
+        msgs_records = (
+            to_records(msgs_df[POSTS_WRITE_COLUMNS], run_id, created_at)
+            if msgs_df is not None
+            else None
+        )
+
+        def write():
+            self.upsert("stats", stats_records, "run_id,username")
+
+            if msgs_records is not None:
+                self.upsert("posts", msgs_records, "run_id,link")
+
+        if not background:
+            write()
+            return None
+
+        future = self.writer.submit(write)
+        future.add_done_callback(log_write_error)
+        return future
+
+    def upsert(self, table: str, records: list[dict], on_conflict: str):
+        for start in range(0, len(records), CHUNK_SIZE):
+            chunk = records[start : start + CHUNK_SIZE]
+
+            for attempt in range(WRITE_RETRIES):
+                try:
+                    self.client.table(table).upsert(
+                        chunk, on_conflict=on_conflict
+                    ).execute()
+                    break
+
+                except Exception:
+                    if attempt == WRITE_RETRIES - 1:
+                        raise
+
+                    delay = RETRY_DELAY * 2**attempt
+                    logger.warning(
+                        "Writing to %s failed, retrying in %s s",
+                        table,
+                        delay,
+                        exc_info=True,
+                    )
+                    time.sleep(delay)
+
+
+def to_records(df: pd.DataFrame, run_id: str, created_at: str) -> list[dict]:
+    """Converts a dataframe to JSON-ready records: timestamps become ISO strings
+    and NaN or infinite values become None."""
+    df = df.copy()
+
+    for column in df.select_dtypes(include=["datetime", "datetimetz"]):
+        df[column] = pd.to_datetime(df[column], utc=True).map(pd.Timestamp.isoformat)
+
+    df = df.replace([float("inf"), float("-inf")], float("nan"))
+    df = df.astype(object).where(df.notna(), None)
+
+    return [
+        {"run_id": run_id, "created_at": created_at, **record}
+        for record in df.to_dict("records")
+    ]
+
+
+def log_write_error(future: Future):
+    if future.exception():
+        logger.error("Writing statistics failed", exc_info=future.exception())
@@ -1,62 +1,259 @@
-import contextlib
-import os
-import tempfile
+import base64
+import io
 
 import supabase
+from fsspec import AbstractFileSystem
+from postgrest.exceptions import APIError
 
+# значения, которые нельзя хранить как текст, пишутся в base64 с этим префиксом
+BINARY_PREFIX = "base64:"
 
-class SupabaseTableFileSystem:
-    def __init__(self, supabase: supabase.Client, table_name):
+
+def encode_value(data: bytes) -> str:
+    try:
+        text = data.decode("utf-8")
+    except UnicodeDecodeError:
+        text = None
+
+    if text is None or text.startswith(BINARY_PREFIX) or "\x00" in text:
+        return BINARY_PREFIX + base64.b64encode(data).decode("ascii")
+
+    return text
+
+
+def decode_value(value: str) -> bytes:
+    if value.startswith(BINARY_PREFIX):
+        return base64.b64decode(value[len(BINARY_PREFIX) :])
+
+    return value.encode("utf-8")
+
+
+class SupabaseTableFile(io.BytesIO):
+    """Файл в памяти. При закрытии записывается в таблицу, если был открыт
+    на запись, а открытый на чтение ничего не пишет."""
+
+    def __init__(self, fs: "SupabaseTableFileSystem", path: str, mode: str, data=b""):
+        super().__init__(data)
+        self.fs = fs
+        self.path = path
+        self.mode = mode
+
+        if "a" in mode:
+            self.seek(0, io.SEEK_END)
+
+    def writable(self):
+        return any(char in self.mode for char in "wax+")
+
+    def write(self, data):
+        if not self.writable():
+            raise io.UnsupportedOperation("File is opened for reading only")
+        return super().write(data)
+
+    def close(self):
+        if not self.closed and self.writable():
+            self.fs.pipe_file(self.path, self.getvalue())
+        super().close()
+
+
+class SupabaseTableFileSystem(AbstractFileSystem):
+    """Файловая система поверх таблицы Supabase с колонками `key` и `value`.
+
+    Прочитанные и записанные значения кэшируются в памяти, список ключей
+    запрашивается один раз и дальше поддерживается локально. `exists`
+    всегда спрашивает базу: по нему проверяется блокировка, которую мог
+    поставить другой процесс."""
+
+    protocol = "supabase-table"
+    root_marker = ""
+    cachable = False
+
+    def __init__(self, supabase: supabase.Client, table_name, **kwargs):
+        super().__init__(**kwargs)
         self.table = supabase.table(table_name)
+        self.cache: dict[str, str] = {}
+        self.keys_cache: set[str] = None
 
     def __getitem__(self, path):
-        return self.table.select("value").eq("key", path).execute().data[0]["value"]
+        if path not in self.cache:
+            data = self.table.select("value").eq("key", path).execute().data
+            if not data:
+                raise FileNotFoundError(path)
+            self.cache[path] = data[0]["value"]
+
+        return self.cache[path]
 
     def __setitem__(self, path, value):
-        self.table.upsert({"key": path, "value": value}).execute()
+        self.put_many({path: value})
 
     def __delitem__(self, path):
         self.table.delete().eq("key", path).execute()
+        self.invalidate(path)
 
     def keys(self):
-        return [
-            next(iter(item.values()))
-            for item in self.table.select("key").execute().data
-        ]
+        if self.keys_cache is None:
+            self.keys_cache = {
+                item["key"] for item in self.table.select("key").execute().data
+            }
+
+        return sorted(self.keys_cache)
 
     def __contains__(self, path):
-        return path in self.keys()
+        return self.exists(path)
+
+    def ls(self, path="", detail=True, **kwargs):
+        keys = self.keys()
+
+        if not detail:
+            return keys
+
+        return [{"name": key, "size": None, "type": "file"} for key in keys]
 
-    def ls(self, *args):
-        return self.keys()
+    def info(self, path, **kwargs):
+        path = self._strip_protocol(path)
 
-    def exists(self, path):
-        return path in self
+        if not self.exists(path):
+            raise FileNotFoundError(path)
 
-    def rm(self, path):
-        del self[path]
+        return {"name": path, "size": None, "type": "file"}
+
+    def exists(self, path, **kwargs):
+        path = self._strip_protocol(path)
+        return bool(self.table.select("key").eq("key", path).limit(1).execute().data)
+
+    def rm_file(self, path):
+        del self[self._strip_protocol(path)]
+
+    def rm(self, path, recursive=False, maxdepth=None):
+        for p in [path] if isinstance(path, str) else path:
+            self.rm_file(p)
+
+    def glob(self, path, **kwargs):
+        # PostgREST сам понимает * в шаблонах like
+        pattern = self._strip_protocol(path).replace("?", "_")
 
-    def glob(self, path):
         return [
-            next(iter(item.values()))
+            item["key"]
             for item in self.table.select("key")
-            .filter("key", "like", path)
+            .filter("key", "like", pattern)
             .execute()
             .data
         ]
 
-    def touch(self, path):
-        self[path] = ""
+    def touch(self, path, truncate=True, **kwargs):
+        if truncate or not self.exists(path):
+            self.pipe_file(path, b"")
+
+    def invalidate(self, path=None):
+        """Забывает закэшированное значение `path` или весь кэш."""
+        if path is None:
+            self.cache = {}
+            self.keys_cache = None
+            return
+
+        self.cache.pop(path, None)
+        if self.keys_cache is not None:
+            self.keys_cache.discard(path)
+
+    def invalidate_cache(self, path=None):
+        self.invalidate(self._strip_protocol(path) if path else None)
+
+    def cat_many(self, paths: list[str]) -> dict[str, str]:
+        """Значения нескольких ключей одним запросом. Отсутствующих ключей
+        в результате нет."""
+        misses = [path for path in paths if path not in self.cache]
+
+        if misses:
+            for item in (
+                self.table.select("key", "value").in_("key", misses).execute().data
+            ):
+                self.cache[item["key"]] = item["value"]
+
+        return {path: self.cache[path] for path in paths if path in self.cache}
+
+    def put_many(self, values: dict[str, str]):
+        """Записывает несколько ключей одним запросом."""
+        if not values:
+            return
+
+        self.table.upsert(
+            [{"key": path, "value": value} for path, value in values.items()]
+        ).execute()
+
+        self.cache.update(values)
+        if self.keys_cache is not None:
+            self.keys_cache.update(values)
+
+    def compare_and_swap(self, path, expected: str | None, value: str | None) -> bool:
+        """Атомарно записывает `value`, только если сейчас в `path` лежит
+        `expected`. `None` означает отсутствие ключа."""
+        path = self._strip_protocol(path)
+
+        if expected is None:
+            # вставка падает, если ключ уже есть
+            try:
+                self.table.insert({"key": path, "value": value}).execute()
+            except APIError:
+                return False
+
+        else:
+            query = (
+                self.table.delete()
+                if value is None
+                else self.table.update({"value": value})
+            )
+            if not query.eq("key", path).eq("value", expected).execute().data:
+                return False
+
+        self.invalidate(path)
+        return True
+
+    def cat_file(self, path, start=None, end=None, **kwargs):
+        return decode_value(self[self._strip_protocol(path)])[start:end]
+
+    def pipe_file(self, path, value, **kwargs):
+        self.put_many({self._strip_protocol(path): encode_value(value)})
+
+    def cat(self, path, recursive=False, on_error="raise", **kwargs):
+        """Для списка путей возвращает словарь, читая все пути одним запросом
+        и пропуская отсутствующие при `on_error="omit"`."""
+        if isinstance(path, str):
+            return self.cat_file(path)
+
+        paths = [self._strip_protocol(p) for p in path]
+        values = self.cat_many(paths)
+        if on_error == "raise" and len(values) < len(paths):
+            raise FileNotFoundError(next(p for p in paths if p not in values))
+
+        return {p: decode_value(value) for p, value in values.items()}
+
+    def pipe(self, path, value=None, **kwargs):
+        """Принимает путь и значение или словарь путей и значений, который
+        записывается одним запросом."""
+        values = path if isinstance(path, dict) else {path: value}
+        self.put_many(
+            {
+                self._strip_protocol(p): encode_value(
+                    v.encode("utf-8") if isinstance(v, str) else v
+                )
+                for p, v in values.items()
+            }
+        )
+
+    def _open(self, path, mode="rb", **kwargs):
+        path = self._strip_protocol(path)
 
-    @contextlib.contextmanager
-    def open(self, path, mode=None):
-        with tempfile.TemporaryDirectory() as td:
-            with open(os.path.join(td, path), "x+") as f:
-                if self.exists(path):
-                    f.write(self[path])
-                    f.seek(0)
+        if "x" in mode and self.exists(path):
+            raise FileExistsError(path)
 
-                yield f
+        if "r" in mode or "a" in mode:
+            values = self.cat_many([path])
+            if path not in values:
+                if "r" in mode:
+                    raise FileNotFoundError(path)
+                data = b""
+            else:
+                data = decode_value(values[path])
+        else:
+            data = b""
 
-            with open(os.path.join(td, path), "r") as f:
-                self[path] = f.read()
+        return SupabaseTableFile(self, path, mode, data)
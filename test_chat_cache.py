@@ -0,0 +1,124 @@
+import datetime as dt
+from types import SimpleNamespace
+
+import orjson
+import pyrogram
+from fsspec.implementations.local import LocalFileSystem
+
+from chat_cache import ChatCache, ChatCacheItem
+
+NOW = dt.datetime.now(dt.timezone.utc)
+
+
+def make_chat(username, members_count=None):
+    return SimpleNamespace(
+        username=username,
+        type=pyrogram.enums.ChatType.CHANNEL,
+        title="Инвестиции",
+        description="Про рынок",
+        members_count=members_count,
+    )
+
+
+def make_cache(tmp_path, **kwargs) -> ChatCache:
+    return ChatCache(LocalFileSystem(), path=str(tmp_path / "cache.jsonl"), **kwargs)
+
+
+def test_chat_ttl(tmp_path):
+    cache = make_cache(tmp_path, chat_ttl=dt.timedelta(days=7))
+
+    cache["fresh"] = ChatCacheItem(make_chat("fresh"))
+    cache["stale"] = ChatCacheItem(
+        make_chat("stale"), fetched_at=NOW - dt.timedelta(days=8)
+    )
+
+    assert "@fresh" in cache
+    assert "stale" not in cache
+    assert cache.stats()["expired"] == 1
+
+
+def test_members_count_has_its_own_ttl(tmp_path):
+    cache = make_cache(tmp_path, members_count_ttl=dt.timedelta(hours=6))
+
+    # чат свежий, а число подписчиков - нет
+    cache["chat"] = ChatCacheItem(
+        make_chat("chat"),
+        members_count=100,
+        fetched_at=NOW - dt.timedelta(hours=1),
+        members_count_fetched_at=NOW - dt.timedelta(hours=7),
+    )
+
+    assert "chat" in cache
+    assert cache.get_members_count("chat") is None
+
+    cache.set_members_count("chat", 200)
+    assert cache.get_members_count("chat") == 200
+
+
+def test_members_count_comes_with_a_fresh_chat(tmp_path):
+    cache = make_cache(tmp_path)
+
+    cache["chat"] = ChatCacheItem(make_chat("chat", members_count=300))
+    assert cache.get_members_count("chat") == 300
+
+    # у загруженного из файла чата число подписчиков берется из записи
+    item = ChatCacheItem(make_chat("other", members_count=300), fetched_at=NOW)
+    assert item.members_count is None
+
+
+def test_members_count_lookup_counts_once(tmp_path):
+    cache = make_cache(tmp_path)
+    cache["chat"] = ChatCacheItem(make_chat("chat"), members_count=100)
+
+    cache.get_members_count("chat")
+    cache.get_members_count("unknown")
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["expired"]) == (1, 1, 0)
+
+
+def test_missing_ttl(tmp_path):
+    cache = make_cache(tmp_path, missing_ttl=dt.timedelta(days=30))
+
+    cache.set_missing("ghost", "UsernameNotOccupied")
+    assert cache.known_missing("@ghost") == "UsernameNotOccupied"
+
+    cache.missing["@ghost"] = ("UsernameNotOccupied", NOW - dt.timedelta(days=31))
+    assert cache.known_missing("ghost") is None
+
+
+def test_lru_eviction(tmp_path):
+    cache = make_cache(tmp_path, max_size=2)
+
+    cache["first"] = ChatCacheItem(make_chat("first"))
+    cache["second"] = ChatCacheItem(make_chat("second"))
+    assert "first" in cache  # теперь давно не запрашивался second
+
+    cache["third"] = ChatCacheItem(make_chat("third"))
+
+    assert "first" in cache
+    assert "second" not in cache
+    assert cache.stats()["evictions"] == 1
+
+
+def test_save_and_load(tmp_path):
+    cache = make_cache(tmp_path)
+    cache["chat"] = ChatCacheItem(make_chat("chat"), members_count=100)
+    cache.set_missing("ghost", "UsernameInvalid")
+    cache.save()
+
+    loaded = make_cache(tmp_path)
+    assert loaded["chat"].chat.title == "Инвестиции"
+    assert loaded["chat"].chat.type == pyrogram.enums.ChatType.CHANNEL
+    assert loaded.get_members_count("chat") == 100
+    assert loaded.known_missing("ghost") == "UsernameInvalid"
+
+
+def test_loads_records_with_members_count_inside_chat(tmp_path):
+    record = ChatCacheItem(make_chat("chat"), members_count=100).to_record("@chat")
+    record["chat"]["members_count"] = 100  # так писали записи раньше
+    (tmp_path / "cache.jsonl").write_bytes(orjson.dumps(record) + b"\n")
+
+    cache = make_cache(tmp_path)
+    assert cache["chat"].chat.username == "chat"
+    assert cache.get_members_count("chat") == 100
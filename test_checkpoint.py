@@ -0,0 +1,165 @@
+import asyncio
+import contextlib
+import datetime as dt
+from types import SimpleNamespace
+
+from fsspec.implementations.local import LocalFileSystem
+
+from checkpoint import DONE, PARTIAL, RUN_ID_FORMAT, RunCheckpoint
+from stats_collector import StatsCollector
+
+POSTS = 250
+
+
+def make_msg(msg_id):
+    return SimpleNamespace(
+        id=msg_id,
+        link=f"https://t.me/chan_a/{msg_id}",
+        views=msg_id * 10,
+        reactions=None,
+        forwards=1,
+        date=dt.datetime(2024, 1, 1) + dt.timedelta(hours=msg_id),
+        text=f"post {msg_id}",
+        caption=None,
+    )
+
+
+class FakeScanner:
+    """Канал из `POSTS` постов. Если задан `fail_after`, история обрывается
+    ошибкой после стольких постов."""
+
+    def __init__(self, fail_after=None):
+        self.fail_after = fail_after
+        self.offsets = []
+
+    @contextlib.asynccontextmanager
+    async def session(self, pbar=None):
+        yield
+
+    def usable_accs(self):
+        return [object(), object()]
+
+    async def get_chat_history(
+        self, channel, min_date=None, min_id=None, offset_id=None
+    ):
+        self.offsets.append(offset_id)
+
+        for count, msg_id in enumerate(range(offset_id or POSTS + 1)[:0:-1]):
+            if self.fail_after is not None and count == self.fail_after:
+                raise ConnectionError("Connection lost")
+            await asyncio.sleep(0)
+            yield make_msg(msg_id)
+
+    async def get_discussion_replies_count(self, channel, msg_id):
+        return 2
+
+    async def get_chat_members_count(self, channel):
+        return 5000
+
+
+def make_checkpoint(tmp_path, run_id=dt.date(2024, 1, 2)) -> RunCheckpoint:
+    return RunCheckpoint(LocalFileSystem(), run_id, prefix=f"{tmp_path}/.run_")
+
+
+def test_save_and_load(tmp_path):
+    checkpoint = make_checkpoint(tmp_path)
+    msg = {"id": 1, "datetime": dt.datetime(2024, 1, 1, 12), "reach": 10}
+
+    checkpoint.save("chan_a", PARTIAL, [msg])
+    assert checkpoint.load("@chan_a") == {
+        "status": PARTIAL,
+        "msgs": [msg],
+        "channel": None,
+    }
+    assert checkpoint.load("@chan_b") is None
+
+    checkpoint.clear()
+    assert checkpoint.load("@chan_a") is None
+
+
+def test_prune_removes_earlier_runs(tmp_path):
+    for day in (1, 2, 3):
+        make_checkpoint(tmp_path, dt.date(2024, 1, day)).save("@chan_a", DONE, [])
+
+    make_checkpoint(tmp_path, dt.date(2024, 1, 2)).prune()
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        ".run_2024-01-02_@chan_a.json",
+        ".run_2024-01-03_@chan_a.json",
+    ]
+
+
+def test_failed_run_resumes_from_checkpoint(tmp_path):
+    checkpoint = make_checkpoint(tmp_path)
+
+    failing = StatsCollector(FakeScanner(fail_after=150), checkpoint=checkpoint)
+    asyncio.run(failing.collect_all_stats(["@chan_a"]))
+
+    assert "@chan_a" in failing.errors
+    saved = checkpoint.load("@chan_a")
+    assert saved["status"] == PARTIAL
+    assert 0 < len(saved["msgs"]) <= 150
+
+    scanner = FakeScanner()
+    resumed = StatsCollector(scanner, checkpoint=checkpoint)
+    asyncio.run(resumed.collect_all_stats(["@chan_a"]))
+
+    # история листается с поста, следующего за последним сохраненным
+    assert scanner.offsets == [saved["msgs"][-1]["id"]]
+    assert not resumed.errors
+    assert list(resumed.msgs_df.reach) == [msg_id * 10 for msg_id in range(250, 0, -1)]
+    assert set(resumed.msgs_df.reactions) == {3}
+    assert resumed.stats.subscribers.tolist() == [5000]
+
+    # сбор закончился без ошибок, и файлы запуска удалены
+    assert checkpoint.load("@chan_a") is None
+
+
+def test_done_channels_are_not_collected_again(tmp_path):
+    checkpoint = make_checkpoint(tmp_path)
+
+    first = StatsCollector(FakeScanner(), checkpoint=checkpoint)
+    first.checkpoint.clear = lambda: None  # как будто другой канал упал
+    asyncio.run(first.collect_all_stats(["@chan_a"]))
+    assert checkpoint.load("@chan_a")["status"] == DONE
+
+    scanner = FakeScanner(fail_after=0)
+    second = StatsCollector(scanner, checkpoint=checkpoint)
+    asyncio.run(second.collect_all_stats(["@chan_a"]))
+
+    assert scanner.offsets == []
+    assert not second.errors
+    assert second.msgs_df.equals(first.msgs_df)
+
+
+def started_checkpoint(tmp_path, hours_ago) -> RunCheckpoint:
+    started = dt.datetime.now(dt.timezone.utc) - dt.timedelta(hours=hours_ago)
+    return make_checkpoint(tmp_path, started.strftime(RUN_ID_FORMAT))
+
+
+def test_resume_continues_a_recent_unfinished_run(tmp_path):
+    failed = started_checkpoint(tmp_path, hours_ago=1)
+    failed.save("@chan_a", DONE, [])
+
+    resumed = RunCheckpoint.resume(LocalFileSystem(), failed.prefix)
+    assert resumed.run_id == failed.run_id
+    assert resumed.load("@chan_a")["status"] == DONE
+
+    # законченный без ошибок запуск не продолжают
+    failed.clear()
+    resumed = RunCheckpoint.resume(LocalFileSystem(), failed.prefix)
+    assert resumed.run_id > failed.run_id
+
+
+def test_resume_starts_over_after_a_stale_run(tmp_path):
+    # готовые каналы давнего упавшего запуска устарели
+    stale = started_checkpoint(tmp_path, hours_ago=7)
+    stale.save("@chan_a", DONE, [])
+    legacy = make_checkpoint(tmp_path, dt.date.today())
+    legacy.save("@chan_b", DONE, [])
+
+    resumed = RunCheckpoint.resume(LocalFileSystem(), stale.prefix)
+    assert resumed.run_id not in (stale.run_id, str(legacy.run_id))
+
+    resumed.prune()
+    assert list(tmp_path.iterdir()) == []
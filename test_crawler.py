@@ -0,0 +1,191 @@
+import asyncio
+import contextlib
+from types import SimpleNamespace
+
+import pyrogram
+from fsspec.implementations.local import LocalFileSystem
+
+from crawler import Crawler
+from progress import CHANNEL, LEASED, SCANNED, USER, ProgressKeeper
+
+CHANNEL_TYPE = pyrogram.enums.ChatType.CHANNEL
+PRIVATE_TYPE = pyrogram.enums.ChatType.PRIVATE
+
+
+def make_chat(username, type=CHANNEL_TYPE, description=None, bio=None):
+    return SimpleNamespace(
+        username=username.lstrip("@"),
+        type=type,
+        title="Инвестиции",
+        description=description,
+        bio=bio,
+    )
+
+
+class FakeScanner:
+    """Телеграм из словаря чатов. Чаты из `errors` отвечают ошибкой."""
+
+    chat_cache = None
+
+    def __init__(self, chats, errors=None, posts=()):
+        self.chats = chats
+        self.errors = errors or {}
+        self.posts = list(posts)
+        self.chat_calls = {}
+        self.read = 0  # сколько постов выдано из истории
+        self.lead = 0  # насколько чтение истории обгоняло чтение комментариев
+
+    @contextlib.asynccontextmanager
+    async def session(self, pbar=None):
+        yield
+
+    def usable_accs(self):
+        return [object()] * 4
+
+    async def get_chat(self, chat_id):
+        self.chat_calls[chat_id] = self.chat_calls.get(chat_id, 0) + 1
+        await asyncio.sleep(0)
+
+        if chat_id in self.errors:
+            raise self.errors[chat_id]
+        if chat_id not in self.chats:
+            raise pyrogram.errors.UsernameNotOccupied()
+        return self.chats[chat_id]
+
+    async def get_chats(self, chat_ids):
+        results = {}
+        for chat_id in chat_ids:
+            try:
+                results[chat_id] = await self.get_chat(chat_id)
+            except pyrogram.errors.RPCError as e:
+                results[chat_id] = e
+        return results
+
+    async def get_chat_members_count(self, chat_id):
+        return 1000
+
+    async def get_chat_history(self, chat_id, limit=None):
+        for msg_id, text in enumerate(self.posts[:limit], 1):
+            await asyncio.sleep(0)
+            self.read = msg_id
+            yield SimpleNamespace(id=msg_id, text=text)
+
+    async def get_discussion_replies(self, chat_id, msg_id, limit=None):
+        self.lead = max(self.lead, self.read - msg_id)
+        await asyncio.sleep(0.001)
+        yield SimpleNamespace(
+            sender_chat=None,
+            from_user=SimpleNamespace(username=f"commenter_{msg_id}", id=msg_id),
+        )
+
+
+def make_progress(tmp_path) -> ProgressKeeper:
+    return ProgressKeeper(LocalFileSystem(), path=str(tmp_path / "frontier.jsonl"))
+
+
+def crawl(scanner, progress, **kwargs) -> Crawler:
+    crawler = Crawler(scanner, progress, min_subscribers=10, **kwargs)
+    asyncio.run(asyncio.wait_for(crawler.run(), 5))
+    return crawler
+
+
+def test_crawl_follows_nicknames_from_bios(tmp_path):
+    scanner = FakeScanner(
+        {
+            "@investor": make_chat(
+                "@investor", PRIVATE_TYPE, bio="мой канал @invest_blog"
+            ),
+            "@invest_blog": make_chat("@invest_blog", description="пишет @analyst"),
+            "@analyst": make_chat("@analyst", PRIVATE_TYPE),
+        }
+    )
+    progress = make_progress(tmp_path)
+    progress.load()
+    progress.schedule([], ["@investor"])
+
+    crawler = crawl(scanner, progress, workers=2)
+
+    assert progress.state(CHANNEL, "@invest_blog") == SCANNED
+    assert progress.state(USER, "@analyst") == SCANNED
+    assert progress.depth(USER, "@analyst") == 2
+    assert crawler.stats()["processed"] == 3
+
+
+def test_missing_usernames_are_not_retried(tmp_path):
+    scanner = FakeScanner({})
+    progress = make_progress(tmp_path)
+    progress.load()
+    progress.schedule(["@ghost"], [])
+
+    crawler = crawl(scanner, progress)
+
+    assert progress.state(CHANNEL, "@ghost") == SCANNED
+    assert scanner.chat_calls["@ghost"] == 1
+    assert crawler.counters["missing"] == 1
+
+
+def test_failing_item_is_retried_up_to_max_attempts(tmp_path):
+    scanner = FakeScanner({}, errors={"@flaky": ConnectionError("Connection lost")})
+    progress = make_progress(tmp_path)
+    progress.load()
+    progress.schedule(["@flaky"], [])
+
+    crawler = crawl(scanner, progress, max_attempts=3)
+
+    # до следующего запуска элемент остается взятым
+    assert progress.state(CHANNEL, "@flaky") == LEASED
+    assert scanner.chat_calls["@flaky"] == 3
+    assert crawler.counters["failed"] == 3
+
+
+def test_batch_limit(tmp_path):
+    scanner = FakeScanner(
+        {f"@user_{i}": make_chat(f"@user_{i}", PRIVATE_TYPE) for i in range(10)}
+    )
+    progress = make_progress(tmp_path)
+    progress.load()
+    progress.schedule([], [f"@user_{i}" for i in range(10)])
+
+    crawler = crawl(scanner, progress, limit_batch=4)
+
+    assert crawler.processed == 4
+    assert sum(progress.state(USER, f"@user_{i}") == SCANNED for i in range(10)) == 4
+
+
+def test_posts_and_comments_feed_the_frontier(tmp_path):
+    scanner = FakeScanner(
+        {
+            "@invest_blog": make_chat("@invest_blog"),
+            "@partner_chan": make_chat("@partner_chan"),
+        },
+        posts=["читайте @partner_chan", "без ников", "и t.me/partner_chan"],
+    )
+    progress = make_progress(tmp_path)
+    progress.load()
+    progress.schedule(["@invest_blog"], [])
+
+    crawler = crawl(scanner, progress, limit_batch=1)
+
+    assert progress.state(CHANNEL, "@partner_chan") is not None
+    assert all(
+        progress.state(USER, f"@commenter_{msg_id}") is not None
+        for msg_id in (1, 2, 3)
+    )
+    assert crawler.counters["replies"] == 3
+    assert scanner.chat_calls["@partner_chan"] == 1
+
+
+def test_history_waits_for_slow_discussions(tmp_path):
+    scanner = FakeScanner(
+        {"@invest_blog": make_chat("@invest_blog")}, posts=["пост"] * 50
+    )
+    progress = make_progress(tmp_path)
+    progress.load()
+    progress.schedule(["@invest_blog"], [])
+
+    crawl(scanner, progress, limit_batch=1, pipeline_size=2, discussion_workers=1)
+
+    # история обгоняет комментарии не больше чем на `pipeline_size` постов
+    # в очереди и по одному посту в руках у каждой стадии
+    assert scanner.read == 50
+    assert scanner.lead <= 4
@@ -0,0 +1,70 @@
+import threading
+
+from fsspec.implementations.local import LocalFileSystem
+from fsspec.implementations.memory import MemoryFileSystem
+
+from lease import Lease, compare_and_swap
+
+
+def test_lease_is_exclusive_until_released(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    fs = LocalFileSystem()
+    first, second = Lease(fs, "1", "first"), Lease(fs, "1", "second")
+
+    assert first.acquire()
+    assert not second.acquire()
+    assert first.holder()["owner"] == "first"
+
+    first.release()
+    assert second.acquire()
+    assert not first.renew()
+
+
+def test_expired_lease_is_taken_over(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    fs = LocalFileSystem()
+    crashed = Lease(fs, "1", "crashed", ttl=-1)
+
+    assert crashed.acquire()
+    assert crashed.holder() is None
+
+    alive = Lease(fs, "1", "alive")
+    assert alive.acquire()
+    assert alive.renew()
+    # упавший процесс, очнувшись, узнает, что аренду перехватили
+    assert not crashed.renew()
+
+
+def test_local_compare_and_swap_has_a_single_winner(tmp_path):
+    fs = LocalFileSystem()
+    path = str(tmp_path / "value")
+    barrier = threading.Barrier(8)
+    winners = []
+
+    def swap(value):
+        barrier.wait()
+        if compare_and_swap(fs, path, None, value):
+            winners.append(value)
+
+    threads = [threading.Thread(target=swap, args=(str(i),)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(winners) == 1
+    assert (tmp_path / "value").read_text() == winners[0]
+
+
+def test_compare_and_swap_on_other_file_systems():
+    fs = MemoryFileSystem()
+    path = "/lease_test/value"
+
+    assert compare_and_swap(fs, path, None, "first")
+    assert not compare_and_swap(fs, path, None, "second")
+    assert not compare_and_swap(fs, path, "second", "third")
+    assert compare_and_swap(fs, path, "first", "third")
+    assert fs.cat_file(path) == b"third"
+
+    assert compare_and_swap(fs, path, "third", None)
+    assert not fs.exists(path)
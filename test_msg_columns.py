@@ -0,0 +1,62 @@
+import datetime as dt
+
+from fsspec.implementations.local import LocalFileSystem
+
+from msg_columns import MsgColumns
+
+
+def make_msgs(channel, count, start=0):
+    return [
+        (
+            channel,
+            f"https://t.me/{channel[1:]}/{i}",
+            i * 10,
+            i,
+            dt.datetime(2024, 1, 1) + dt.timedelta(hours=i),
+            f"post {i}",
+        )
+        for i in range(start, start + count)
+    ]
+
+
+def fill(columns: MsgColumns):
+    # каналы досчитываются вперемешку
+    columns.extend(make_msgs("@chan_b", 3))
+    columns.extend(make_msgs("@chan_a", 4))
+    columns.extend(make_msgs("@chan_b", 2, start=3))
+
+
+def test_spilled_frame_matches_in_memory_one(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    in_memory = MsgColumns(["@chan_a", "@chan_b"])
+    spilling = MsgColumns(
+        ["@chan_a", "@chan_b"], spill_fs=LocalFileSystem(), spill_rows=2
+    )
+    fill(in_memory)
+    fill(spilling)
+
+    assert len(spilling.spilled) == 3
+    assert len(spilling) == 9
+
+    expected = in_memory.to_frame()
+    assert expected.username.tolist() == ["@chan_a"] * 4 + ["@chan_b"] * 5
+    assert expected.reach.tolist()[4:] == [0, 10, 20, 30, 40]
+    assert spilling.to_frame().equals(expected)
+
+    spilling.cleanup()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_concurrent_collections_do_not_share_spill_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    fs = LocalFileSystem()
+
+    first = MsgColumns(["@chan_a"], spill_fs=fs, spill_rows=1)
+    second = MsgColumns(["@chan_b"], spill_fs=fs, spill_rows=1)
+    first.extend(make_msgs("@chan_a", 2))
+    second.extend(make_msgs("@chan_b", 2))
+
+    assert set(first.spilled).isdisjoint(second.spilled)
+    assert first.to_frame().username.tolist() == ["@chan_a"] * 2
+    assert second.to_frame().username.tolist() == ["@chan_b"] * 2
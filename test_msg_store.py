@@ -0,0 +1,49 @@
+import datetime as dt
+
+from fsspec.implementations.local import LocalFileSystem
+
+from msg_store import MessageStore
+
+
+def record(msg_id, days_ago=0):
+    return {
+        "id": msg_id,
+        "reach": msg_id * 10,
+        "datetime": dt.datetime(2024, 1, 31) - dt.timedelta(days=days_ago),
+    }
+
+
+def make_store(tmp_path) -> MessageStore:
+    return MessageStore(LocalFileSystem(), prefix=f"{tmp_path}/.msgs_")
+
+
+def test_update_and_reload(tmp_path):
+    store = make_store(tmp_path)
+    store.update("chan_a", {1: record(1, days_ago=10), 2: record(2, days_ago=1)})
+    store.update("@chan_a", {2: record(2, days_ago=1) | {"reach": 99}})
+
+    loaded = make_store(tmp_path)
+    assert loaded.max_id("chan_a") == 2
+    assert loaded.settled_id("chan_a", dt.datetime(2024, 1, 25)) == 1
+    assert [r["reach"] for r in loaded.messages("@chan_a")] == [99, 10]
+
+
+def test_old_posts_are_dropped(tmp_path):
+    store = make_store(tmp_path)
+    min_date = dt.datetime(2024, 1, 20)
+
+    store.update("chan_a", {1: record(1, days_ago=30), 2: record(2)}, min_date)
+
+    assert [r["id"] for r in make_store(tmp_path).messages("chan_a")] == [2]
+
+
+def test_channel_is_released_after_messages(tmp_path):
+    store = make_store(tmp_path)
+    store.update("chan_a", {1: record(1)})
+    store.update("chan_b", {2: record(2)})
+
+    assert [r["id"] for r in store.messages("chan_a")] == [1]
+    assert list(store.channels) == ["@chan_b"]
+
+    # выгруженный канал снова читается из файла
+    assert store.max_id("chan_a") == 1
@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from posts_index import BY_CHANNEL, BY_POPULARITY, PostsIndex, make_clickable
+
+NOW = pd.Timestamp("2024-03-01 12:00", tz="UTC")
+
+
+@pytest.fixture
+def msgs() -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    size = 2000
+
+    msgs = pd.DataFrame(
+        {
+            "username": pd.Categorical(
+                rng.choice([f"@chan_{i}" for i in range(30)], size)
+            ),
+            "link": [f"https://t.me/c/{i}" for i in range(size)],
+            "reach": rng.integers(1, 1000, size),
+            "reactions": rng.integers(0, 50, size),
+            "datetime": NOW.tz_convert(None)
+            - pd.to_timedelta(rng.uniform(0, 30, size), unit="D"),
+            "text": [f"post {i}" for i in range(size)],
+        }
+    )
+    # у всех постов разная популярность, чтобы порядок был однозначным
+    msgs["popularity"] = rng.permutation(size) / size
+    msgs.loc[:9, "popularity"] = np.nan
+
+    return msgs
+
+
+def old_query(msgs, how_many, min_days, max_days, sort_by):
+    """Прежняя реализация `display_popular_posts`."""
+    filtered_by_date = msgs[
+        (pd.to_datetime(msgs.datetime, utc=True) > NOW - pd.DateOffset(days=max_days))
+        & (pd.to_datetime(msgs.datetime, utc=True) < NOW - pd.DateOffset(days=min_days))
+    ]
+
+    sorted_posts = (
+        filtered_by_date.sort_values("popularity", ascending=False)
+        if sort_by == BY_POPULARITY
+        else filtered_by_date.sort_values("username")
+    )
+
+    popular_posts = sorted_posts.groupby("username", observed=True)[
+        ["username", "text", "link", "popularity"]
+    ].head(how_many)
+
+    popular_posts["link"] = popular_posts["link"].apply(make_clickable)
+    return popular_posts
+
+
+@pytest.mark.parametrize(
+    "how_many, min_days, max_days", [(5, 1, 8), (1, 0, 30), (3, 10, 12)]
+)
+def test_by_popularity_matches_old_query(msgs, how_many, min_days, max_days):
+    expected = old_query(msgs, how_many, min_days, max_days, BY_POPULARITY)
+    actual = PostsIndex(msgs).top(how_many, min_days, max_days, BY_POPULARITY, NOW)
+
+    assert list(actual.index) == list(expected.index)
+    assert actual.link.tolist() == expected.link.tolist()
+    assert actual.username.tolist() == expected.username.astype(str).tolist()
+
+
+def test_by_channel_takes_freshest_posts(msgs):
+    expected = old_query(msgs, 3, 1, 8, BY_CHANNEL)
+    actual = PostsIndex(msgs).top(3, 1, 8, BY_CHANNEL, NOW)
+
+    # те же каналы и столько же постов с каждого, в порядке каналов
+    assert actual.username.tolist() == expected.username.astype(str).tolist()
+
+    in_range = msgs.loc[
+        (msgs.datetime > (NOW - pd.DateOffset(days=8)).tz_convert(None))
+        & (msgs.datetime < (NOW - pd.DateOffset(days=1)).tz_convert(None))
+    ]
+    freshest = (
+        in_range.sort_values("datetime", ascending=False)
+        .groupby("username", observed=True)
+        .head(3)
+    )
+    assert set(actual.index) == set(freshest.index)
+
+
+def test_posts_without_popularity_go_last(msgs):
+    top = PostsIndex(msgs).top(1000, 0, 30, BY_POPULARITY, NOW)
+
+    assert top.popularity.isna().sum() == 10
+    assert top.popularity.tail(10).isna().all()
+
+
+def test_html_is_memoised(msgs):
+    # html берет текущее время, поэтому посты сдвигаем к нему
+    shift = pd.Timestamp("now", tz="UTC") - NOW
+    index = PostsIndex(msgs.assign(datetime=msgs.datetime + shift))
+
+    first = index.html(5, 1, 8)
+    assert index.html(5, 1, 8) is first
+    assert index.html(5, 1, 9) is not first
+    assert "ссылка</a>" in first
@@ -0,0 +1,148 @@
+import asyncio
+
+import orjson
+from fsspec.implementations.local import LocalFileSystem
+
+from progress import CHANNEL, LEASED, NEW, SCANNED, USER, ProgressKeeper
+
+
+def make_progress(tmp_path, **kwargs) -> ProgressKeeper:
+    progress = ProgressKeeper(
+        LocalFileSystem(), path=str(tmp_path / "frontier.jsonl"), **kwargs
+    )
+    progress.load()
+    return progress
+
+
+def journal_lines(tmp_path) -> int:
+    path = tmp_path / "frontier.jsonl"
+    return len(path.read_bytes().splitlines()) if path.exists() else 0
+
+
+def test_priority_then_depth_order(tmp_path):
+    progress = make_progress(tmp_path)
+
+    progress.schedule(["@deep"], [], depth=2)
+    progress.schedule(["@shallow"], [], depth=1)
+    progress.schedule(["@popular"], [], depth=3, priority=10)
+
+    assert [progress.lease(CHANNEL) for _ in range(4)] == [
+        "@popular",
+        "@shallow",
+        "@deep",
+        None,
+    ]
+
+
+def test_prioritize_moves_item_up(tmp_path):
+    progress = make_progress(tmp_path)
+
+    progress.schedule(["@a", "@b"], [])
+    progress.prioritize(CHANNEL, "@B", 5)
+
+    assert progress.lease(CHANNEL) == "@b"
+
+
+def test_known_names_are_not_scheduled_again(tmp_path):
+    progress = make_progress(tmp_path)
+
+    progress.schedule(["@a"], ["@User"])
+    progress.complete(CHANNEL, progress.lease(CHANNEL))
+    progress.schedule(["@A"], ["@user"], priority=100)
+
+    assert progress.state(CHANNEL, "@a") == SCANNED
+    assert progress.lease(CHANNEL) is None
+    assert progress.new_users == {"@user"}
+
+
+def test_journal_survives_restart(tmp_path):
+    progress = make_progress(tmp_path)
+
+    progress.schedule(["@a", "@b"], ["@u"], depth=1)
+    progress.complete(CHANNEL, progress.lease(CHANNEL))
+    progress.save()
+
+    restored = make_progress(tmp_path)
+    assert restored.scanned_channels == progress.scanned_channels
+    assert restored.new_channels == progress.new_channels
+    assert restored.new_users == {"@u"}
+    assert restored.depth(USER, "@u") == 1
+
+
+def test_leased_items_return_to_queue_after_crash(tmp_path):
+    progress = make_progress(tmp_path, flush_records=1)
+
+    progress.schedule(["@a", "@b"], [])
+    leased = progress.lease(CHANNEL)
+    assert progress.state(CHANNEL, leased) == LEASED
+    # процесс упал, не сохранив и не закончив элемент
+
+    restored = make_progress(tmp_path)
+    assert restored.state(CHANNEL, leased) == NEW
+    assert {restored.lease(CHANNEL), restored.lease(CHANNEL)} == {"@a", "@b"}
+
+
+def test_appends_are_batched(tmp_path):
+    progress = make_progress(tmp_path, flush_records=3, flush_interval=3600)
+
+    progress.schedule(["@a", "@b"], [])
+    assert journal_lines(tmp_path) == 0
+
+    progress.schedule(["@c"], [])
+    assert journal_lines(tmp_path) == 3
+
+    progress.complete(CHANNEL, progress.lease(CHANNEL))
+    assert journal_lines(tmp_path) == 3
+
+    # при падении теряется только последняя пачка
+    crashed = make_progress(tmp_path)
+    assert crashed.new_channels == {"@a", "@b", "@c"}
+
+    progress.save()
+    restored = make_progress(tmp_path)
+    assert len(restored.scanned_channels) == 1
+
+
+def test_session_saves_on_exit(tmp_path):
+    progress = ProgressKeeper(LocalFileSystem(), path=str(tmp_path / "frontier.jsonl"))
+
+    async def main():
+        async with progress.session():
+            progress.schedule([], ["@u"])
+
+    asyncio.run(main())
+    assert make_progress(tmp_path).new_users == {"@u"}
+
+
+def test_compaction(tmp_path):
+    progress = make_progress(tmp_path, flush_records=1)
+
+    progress.schedule(["@a"], [])
+    for priority in range(1, 10):
+        progress.prioritize(CHANNEL, "@a", priority)
+    assert journal_lines(tmp_path) == 10
+
+    progress.save()
+    assert journal_lines(tmp_path) == 1
+    assert make_progress(tmp_path).meta[CHANNEL, "@a"] == (9, 0)
+
+
+def test_legacy_file_is_migrated(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / ".chat_lists.json").write_bytes(
+        orjson.dumps(
+            {
+                "new_users": ["@u"],
+                "scanned_users": [],
+                "new_channels": ["@a", "@b"],
+                "scanned_channels": ["@b"],
+            }
+        )
+    )
+
+    progress = make_progress(tmp_path)
+
+    assert progress.new_channels == {"@a"}
+    assert progress.scanned_channels == {"@b"}
+    assert progress.new_users == {"@u"}
+    assert journal_lines(tmp_path) == 3
@@ -0,0 +1,341 @@
+import asyncio
+import datetime as dt
+from types import SimpleNamespace
+
+import pyrogram
+import pytest
+from fsspec.implementations.local import LocalFileSystem
+from fsspec.implementations.memory import MemoryFileSystem
+
+import scanner as scanner_module
+from chat_cache import ChatCache
+from lease import Lease
+from scanner import Scanner
+from scheduler import AccountScheduler
+
+MSGS = [
+    SimpleNamespace(id=i, date=dt.datetime(2024, 1, 1) + dt.timedelta(hours=i))
+    for i in range(1, 251)
+]
+
+
+class FakeApp:
+    is_connected = True
+
+    def __init__(self):
+        self.history_calls = 0
+        self.chat_calls = 0
+        self.count_calls = 0
+        self.chat_errors = {}
+
+    async def get_chat_history(self, chat_id, limit, offset, offset_id):
+        self.history_calls += 1
+        older = [msg for msg in reversed(MSGS) if not offset_id or msg.id < offset_id]
+        for msg in older[: limit or None]:
+            yield msg
+
+    async def get_chat(self, chat_id):
+        self.chat_calls += 1
+        if chat_id in self.chat_errors:
+            raise self.chat_errors[chat_id]
+        return SimpleNamespace(
+            username=chat_id.lstrip("@"),
+            type=None,
+            title="",
+            description="",
+            members_count=500,
+        )
+
+    async def get_chat_members_count(self, chat_id):
+        self.count_calls += 1
+        return 1000
+
+    async def invoke(self, query):
+        raise ConnectionError("Connection lost")
+
+
+class FakeAccount:
+    fail = False
+
+    def __init__(self, phone, fs=None):
+        self.phone = phone
+        self.filename = f"{phone}.session"
+        self.app = FakeApp()
+        self.started = False
+        self.session_str = None
+
+    async def start(self, session_str=None):
+        if self.fail:
+            raise ConnectionError("Cannot start")
+        self.started = True
+
+
+class FakePbar:
+    def __init__(self, postfix=""):
+        self.postfix = postfix
+
+    def set_postfix_str(self, s=""):
+        self.postfix = s
+
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, 5))
+
+
+def make_scanner(*accs) -> Scanner:
+    scanner = Scanner(MemoryFileSystem(), ["1"], chat_cache=False)
+    scanner.accs = list(accs)
+    scanner.scheduler = AccountScheduler(accs, rate_limits={})
+    scanner.quarantined = {}
+    scanner.startup_progress = asyncio.Event()
+    return scanner
+
+
+def started_account(phone="1") -> FakeAccount:
+    acc = FakeAccount(phone)
+    acc.started = True
+    return acc
+
+
+def test_history_is_read_in_pages():
+    async def main():
+        acc = started_account()
+        scanner = make_scanner(acc)
+
+        ids = [msg.id async for msg in scanner.get_chat_history("@chat")]
+        assert ids == list(range(250, 0, -1))
+        assert acc.app.history_calls == 3
+
+        ids = [
+            msg.id
+            async for msg in scanner.get_chat_history("@chat", 120, offset_id=200)
+        ]
+        assert ids == list(range(199, 79, -1))
+
+        ids = [msg.id async for msg in scanner.get_chat_history("@chat", min_id=240)]
+        assert ids == list(range(250, 240, -1))
+
+    run(main())
+
+
+def test_nested_calls_while_reading_history_do_not_deadlock():
+    async def main():
+        scanner = make_scanner(started_account())
+
+        # единственный аккаунт не должен оставаться занятым между страницами
+        counts = [
+            await scanner.process_command("get_chat_members_count", "@chat")
+            async for _ in scanner.get_chat_history("@chat")
+        ]
+        assert len(counts) == len(MSGS)
+
+    run(main())
+
+
+def test_account_that_never_starts_releases_waiters(monkeypatch):
+    monkeypatch.setattr(scanner_module, "ACC_RETRIES", 2)
+    monkeypatch.setattr(scanner_module, "ACC_RETRY_DELAY", 0.01)
+
+    async def main():
+        scanner = make_scanner()
+        acc = FakeAccount("1")
+        acc.fail = True
+
+        startup = asyncio.create_task(scanner.start_account(acc, None, set()))
+        await asyncio.sleep(0)
+
+        with pytest.raises(RuntimeError, match="All accounts unavailable"):
+            await scanner.scheduler.acquire()
+
+        await startup
+        assert "1" in scanner.quarantined
+
+    run(main())
+
+
+def test_no_sleep_after_last_failed_start(monkeypatch):
+    monkeypatch.setattr(scanner_module, "ACC_RETRIES", 1)
+    monkeypatch.setattr(scanner_module, "ACC_RETRY_DELAY", 60)
+
+    async def main():
+        scanner = make_scanner()
+        acc = FakeAccount("1")
+        acc.fail = True
+
+        await scanner.start_account(acc, None, set())
+        assert scanner.scheduler.pending == 0
+
+    run(main())
+
+
+def test_accounts_still_starting_count_for_pools(monkeypatch):
+    monkeypatch.setattr(scanner_module, "ACC_RETRIES", 1)
+
+    class StaggeredAccount(FakeAccount):
+        async def start(self, session_str=None):
+            await asyncio.sleep(int(self.phone) * 0.02)
+            self.fail = self.phone == "3"
+            await super().start(session_str)
+
+    monkeypatch.setattr(scanner_module, "Account", StaggeredAccount)
+
+    async def main():
+        scanner = Scanner(MemoryFileSystem(), ["0", "1", "2", "3"], chat_cache=False)
+        scanner.leases = dict.fromkeys(scanner.phones)
+
+        # start_sessions возвращается после первого подключившегося аккаунта
+        await scanner.start_sessions()
+        assert len(scanner.ready_accs()) == 1
+        assert len(scanner.usable_accs()) == 4
+
+        await asyncio.gather(*scanner.startup_tasks)
+        assert [acc.phone for acc in scanner.usable_accs()] == ["0", "1", "2"]
+
+    run(main())
+
+
+def test_keep_alive_restart_is_not_duplicated_by_stale_release(monkeypatch):
+    monkeypatch.setattr(scanner_module, "Account", FakeAccount)
+
+    async def main():
+        acc = started_account()
+        scanner = make_scanner(acc)
+
+        held = await scanner.scheduler.acquire()
+        await scanner.keep_alive()
+        await asyncio.gather(*scanner.startup_tasks)
+        scanner.scheduler.release(held)
+
+        restarted = scanner.accs[0]
+        assert restarted is not acc and restarted.started
+        assert [item[3] for item in scanner.scheduler.idle] == [restarted]
+
+    run(main())
+
+
+def test_flood_wait_postfix_is_restored():
+    async def main():
+        scanner = make_scanner(started_account())
+        scanner.running = True
+        pbar = FakePbar("@chat")
+
+        async with scanner.session(pbar):
+            scanner.report_flood_wait(0.01)
+            scanner.report_flood_wait(0.02)
+            assert pbar.postfix == "@chat, flood_wait 0.01 secs, flood_wait 0.02 secs"
+
+            await asyncio.sleep(0.05)
+            assert pbar.postfix == "@chat"
+
+        assert scanner.pbar is None
+
+    run(main())
+
+
+def test_concurrent_sessions_keep_their_own_pbar():
+    async def main():
+        scanner = make_scanner(started_account())
+        scanner.running = True
+
+        async def collect(pbar):
+            async with scanner.session(pbar):
+                await asyncio.sleep(0.01)
+                return scanner.pbar
+
+        first, second = FakePbar(), FakePbar()
+        assert await asyncio.gather(collect(first), collect(second)) == [
+            first,
+            second,
+        ]
+
+    run(main())
+
+
+def test_accounts_are_stopped_when_saving_sessions_fails(monkeypatch):
+    class UnsavableAccount(FakeAccount):
+        stopped = False
+
+        async def export_session(self):
+            raise ConnectionError("Connection lost")
+
+        async def stop(self, save=True):
+            self.stopped = True
+
+    monkeypatch.setattr(scanner_module, "Account", UnsavableAccount)
+
+    async def main():
+        fs = MemoryFileSystem()
+        scanner = Scanner(fs, ["unsavable"], chat_cache=False)
+
+        async with scanner.session():
+            (acc,) = scanner.accs
+
+        assert acc.stopped
+        assert Lease(fs, "unsavable", "other owner").acquire()
+
+    run(main())
+
+
+def test_members_count_of_an_uncached_chat_takes_one_request(tmp_path):
+    async def main():
+        acc = started_account()
+        scanner = make_scanner(acc)
+        scanner.chat_cache = ChatCache(
+            LocalFileSystem(), path=str(tmp_path / "cache.jsonl")
+        )
+
+        assert await scanner.get_chat_members_count("@chat") == 500
+        assert (acc.app.chat_calls, acc.app.count_calls) == (1, 0)
+
+        # устаревшее число подписчиков запрашивается отдельно
+        scanner.chat_cache["chat"].members_count_fetched_at = None
+        assert await scanner.get_chat_members_count("@chat") == 1000
+        assert (acc.app.chat_calls, acc.app.count_calls) == (1, 1)
+
+    run(main())
+
+
+def test_sessions_are_found_by_relative_paths(tmp_path, monkeypatch):
+    class RecordingAccount(FakeAccount):
+        async def start(self, session_str=None):
+            self.session_str = session_str
+            await super().start(session_str)
+
+    monkeypatch.setattr(scanner_module, "Account", RecordingAccount)
+    (tmp_path / "1.session").write_text("session 1")
+    monkeypatch.chdir(tmp_path)
+
+    async def main():
+        scanner = Scanner(LocalFileSystem(), ["1", "2"], chat_cache=False)
+        scanner.leases = dict.fromkeys(scanner.phones)
+
+        await scanner.start_sessions()
+        await asyncio.gather(*scanner.startup_tasks)
+
+        assert [acc.session_str for acc in scanner.accs] == ["session 1", None]
+
+    run(main())
+
+
+def test_only_missing_usernames_are_cached_as_missing(tmp_path):
+    async def main():
+        acc = started_account()
+        acc.app.chat_errors = {
+            "@ghost": pyrogram.errors.UsernameNotOccupied(),
+            "@unknown_peer": pyrogram.errors.PeerIdInvalid(),
+        }
+        scanner = make_scanner(acc)
+        scanner.chat_cache = ChatCache(
+            LocalFileSystem(), path=str(tmp_path / "cache.jsonl")
+        )
+
+        for _ in range(2):
+            for chat_id in acc.app.chat_errors:
+                with pytest.raises(pyrogram.errors.RPCError):
+                    await scanner.get_chat(chat_id)
+
+        # несуществующий ник запрошен один раз, а PeerIdInvalid - каждый
+        assert acc.app.chat_calls == 3
+        assert scanner.chat_cache.known_missing("@unknown_peer") is None
+
+    run(main())
@@ -0,0 +1,130 @@
+import asyncio
+
+import pytest
+
+from scheduler import FALLBACK_RATE_LIMIT, AccountScheduler
+
+
+class FakeAccount:
+    def __init__(self, phone):
+        self.phone = phone
+
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, 5))
+
+
+def idle_accs(scheduler: AccountScheduler) -> list[FakeAccount]:
+    return [item[3] for item in scheduler.idle]
+
+
+def test_acquire_and_release():
+    async def main():
+        first, second = FakeAccount("1"), FakeAccount("2")
+        scheduler = AccountScheduler([first, second], rate_limits={})
+
+        taken = {await scheduler.acquire(), await scheduler.acquire()}
+        assert taken == {first, second}
+        assert scheduler.busy == {first, second}
+
+        scheduler.release(first)
+        assert await scheduler.acquire() is first
+
+    run(main())
+
+
+def test_flood_wait_postpones_account():
+    async def main():
+        first, second = FakeAccount("1"), FakeAccount("2")
+        scheduler = AccountScheduler([first, second], rate_limits={})
+
+        acc = await scheduler.acquire("get_chat")
+        scheduler.release(acc, "get_chat", flood_wait=100)
+
+        other = await scheduler.acquire("get_chat")
+        assert other is not acc
+        assert scheduler.stats()["flood_waiting"] == 1
+
+    run(main())
+
+
+def test_unlisted_method_recovers_to_fallback_rate():
+    async def main():
+        acc = FakeAccount("1")
+        scheduler = AccountScheduler([acc], rate_limits={})
+
+        await scheduler.acquire("get_users")
+        scheduler.release(acc, "get_users", flood_wait=1)
+
+        bucket = scheduler.buckets["1", "get_users"]
+        assert bucket.ceiling >= FALLBACK_RATE_LIMIT.rate
+        assert bucket.rate < bucket.ceiling
+
+    run(main())
+
+
+def test_removed_while_held_is_not_released_back():
+    async def main():
+        acc = FakeAccount("1")
+        scheduler = AccountScheduler([acc], rate_limits={})
+
+        held = await scheduler.acquire()
+        scheduler.remove(held)
+        scheduler.release(held)
+
+        assert idle_accs(scheduler) == []
+        with pytest.raises(RuntimeError, match="All accounts unavailable"):
+            await scheduler.acquire()
+
+    run(main())
+
+
+def test_restarted_account_is_not_duplicated_by_stale_release():
+    async def main():
+        stale = FakeAccount("1")
+        scheduler = AccountScheduler([stale], rate_limits={})
+
+        held = await scheduler.acquire()
+        scheduler.remove(held)
+
+        # перезапуск идет новым объектом, а старый возвращают позже
+        restarted = FakeAccount("1")
+        scheduler.add(restarted)
+        scheduler.release(held)
+
+        assert idle_accs(scheduler) == [restarted]
+
+    run(main())
+
+
+def test_waiters_fail_when_last_pending_account_gives_up():
+    async def main():
+        scheduler = AccountScheduler(rate_limits={})
+        scheduler.pending = 1
+
+        waiter = asyncio.create_task(scheduler.acquire())
+        await asyncio.sleep(0)
+        assert not waiter.done()
+
+        scheduler.pending -= 1
+        scheduler.notify()
+
+        with pytest.raises(RuntimeError, match="All accounts unavailable"):
+            await waiter
+
+    run(main())
+
+
+def test_waiter_gets_released_account():
+    async def main():
+        acc = FakeAccount("1")
+        scheduler = AccountScheduler([acc], rate_limits={})
+
+        held = await scheduler.acquire()
+        waiter = asyncio.create_task(scheduler.acquire())
+        await asyncio.sleep(0)
+
+        scheduler.release(held)
+        assert await waiter is acc
+
+    run(main())
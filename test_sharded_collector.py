@@ -0,0 +1,60 @@
+import asyncio
+import datetime as dt
+
+from fsspec.implementations.local import LocalFileSystem
+
+import sharded_collector
+from sharded_collector import DONE, ERROR, RESULT, ShardedStatsCollector
+
+CHANNELS = ["@chan_a", "@chan_b", "@broken", "@crash"]
+
+
+def fake_run_shard(
+    shard, fs_factory, msg_store_fs_factory, phones, channels, options, workers, queue
+):
+    """Процесс без телеграма: по каналу отдает два поста, `@broken` падает,
+    а на `@crash` процесс завершается, не сообщив о конце работы."""
+    for channel in channels:
+        if channel == "@crash":
+            raise SystemExit(1)
+
+        if channel == "@broken":
+            queue.put((ERROR, channel, "ConnectionError()"))
+            continue
+
+        msgs = [
+            (
+                channel,
+                f"https://t.me/{channel[1:]}/{i}",
+                100 * i,
+                i,
+                dt.datetime(2024, 1, 1, i),
+                f"{channel} {phones[0]}",
+            )
+            for i in (2, 1)
+        ]
+        queue.put((RESULT, channel, msgs, (channel, 1000)))
+
+    queue.put((DONE, shard))
+
+
+def test_results_of_all_shards_are_merged(monkeypatch):
+    monkeypatch.setattr(sharded_collector, "run_shard", fake_run_shard)
+    monkeypatch.setattr(sharded_collector, "POLL_INTERVAL", 0.1)
+
+    collector = ShardedStatsCollector(LocalFileSystem, phones=["1", "2"], shards=2)
+    asyncio.run(asyncio.wait_for(collector.collect_all_stats(CHANNELS), 60))
+
+    # каналы и аккаунты разложены по процессам по кругу
+    assert collector.msgs_df.text.tolist() == [
+        "@chan_a 1",
+        "@chan_a 1",
+        "@chan_b 2",
+        "@chan_b 2",
+    ]
+    assert collector.msgs_df.reach.tolist() == [200, 100, 200, 100]
+    assert collector.channels_df.username.tolist() == ["@chan_a", "@chan_b"]
+
+    assert set(collector.errors) == {"@broken", "@crash"}
+    assert str(collector.errors["@broken"]) == "ConnectionError()"
+    assert str(collector.errors["@crash"]) == "Worker process exited"
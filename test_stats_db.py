@@ -0,0 +1,218 @@
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+from fsspec.implementations.local import LocalFileSystem
+
+import stats_db
+from stats_db import StatsDatabase
+
+
+class FakeQuery:
+    """Запрос к таблице в духе PostgREST: фильтры, сортировка и диапазон
+    применяются при `execute`."""
+
+    def __init__(self, table, columns):
+        self.table = table
+        self.columns = columns
+        self.filters = []
+        self.orders = []
+        self.bounds = None
+
+    def gte(self, column, value):
+        self.filters.append(
+            lambda row: pd.Timestamp(row[column]) >= pd.Timestamp(value)
+        )
+        return self
+
+    def order(self, column, desc=False):
+        self.orders.append(column)
+        return self
+
+    def range(self, start, end):
+        self.bounds = (start, end)
+        return self
+
+    def execute(self):
+        self.table.requests += 1
+
+        rows = [row for row in self.table.rows if all(f(row) for f in self.filters)]
+        for column in reversed(self.orders):
+            rows.sort(key=lambda row: row[column])
+        if self.bounds:
+            rows = rows[self.bounds[0] : self.bounds[1] + 1]
+
+        return SimpleNamespace(
+            data=[{column: row.get(column) for column in self.columns} for row in rows]
+        )
+
+
+class FakeUpsert:
+    def __init__(self, table, records, on_conflict):
+        self.table = table
+        self.records = records
+        self.keys = on_conflict.split(",")
+
+    def execute(self):
+        if self.table.failures:
+            self.table.failures -= 1
+            raise ConnectionError("Connection lost")
+
+        self.table.chunks.append(len(self.records))
+        for record in self.records:
+            key = [record[column] for column in self.keys]
+            self.table.rows = [
+                row
+                for row in self.table.rows
+                if [row.get(column) for column in self.keys] != key
+            ] + [record]
+
+
+class FakeTable:
+    def __init__(self, rows=(), failures=0):
+        self.rows = list(rows)
+        self.requests = 0
+        self.failures = failures
+        self.chunks = []
+
+    def select(self, *columns):
+        return FakeQuery(self, columns)
+
+    def upsert(self, records, on_conflict):
+        return FakeUpsert(self, records, on_conflict)
+
+
+class FakeClient:
+    def __init__(self, **tables):
+        self.tables = tables
+
+    def table(self, name):
+        return self.tables.setdefault(name, FakeTable())
+
+
+def stat_row(created_at, username, reach=100, run_id=None):
+    return {
+        "run_id": run_id,
+        "created_at": created_at,
+        "username": username,
+        "reach": reach,
+        "subscribers": 1000,
+    }
+
+
+def make_db(tmp_path, client, **kwargs) -> StatsDatabase:
+    return StatsDatabase(
+        client,
+        LocalFileSystem(),
+        snapshot_path=str(tmp_path / "snapshot.parquet"),
+        **kwargs,
+    )
+
+
+def test_stats_are_fetched_in_pages(tmp_path):
+    rows = [
+        stat_row(f"2024-01-0{day}T10:00:00+00:00", f"@chan_{i}")
+        for day in (1, 2, 3)
+        for i in range(3)
+    ]
+    client = FakeClient(stats=FakeTable(rows))
+
+    db = make_db(tmp_path, client, page_size=4)
+    db.load_stats_dataframe()
+
+    assert len(db.stats_df) == 9
+    assert client.tables["stats"].requests == 3
+    assert str(db.stats_df.created_at.dt.tz) == "Europe/Moscow"
+
+
+def test_only_new_rows_are_fetched_after_snapshot(tmp_path):
+    stats = FakeTable(
+        [stat_row("2024-01-01T10:00:00+00:00", "@chan_a")]
+        + [stat_row("2024-01-02T10:00:00+00:00", f"@chan_{i}") for i in range(5)]
+    )
+    client = FakeClient(stats=stats)
+    make_db(tmp_path, client).load_stats_dataframe()
+
+    stats.rows.append(stat_row("2024-01-03T10:00:00+00:00", "@chan_a", reach=300))
+    stats.requests = 0
+
+    db = make_db(tmp_path, client, page_size=4)
+    db.load_stats_dataframe()
+    db.calc_last_stats_dataframe()
+
+    # из базы перечитывается только последний сбор снимка и новые строки
+    assert stats.requests == 2
+    assert len(db.stats_df) == 7
+    assert db.last_stats_df.reach.tolist() == [300]
+
+
+def test_resumed_run_replaces_its_rows(tmp_path):
+    client = FakeClient(stats=FakeTable())
+    db = make_db(tmp_path, client)
+    stats = pd.DataFrame(
+        {"username": ["@chan_a", "@chan_b"], "reach": [100, 200], "subscribers": 1}
+    )
+
+    db.save_new_stats_to_db(stats, run_id="2024-01-01T100000")
+    db.load_stats_dataframe()
+
+    # продолжение упавшего сбора перезаписывает строки с новым created_at
+    db.save_new_stats_to_db(stats.assign(reach=[150, 250]), run_id="2024-01-01T100000")
+    db.save_new_stats_to_db(stats.assign(reach=[300, 400]), run_id="2024-01-01T180000")
+
+    db = make_db(tmp_path, client)
+    db.load_stats_dataframe()
+    db.calc_last_stats_dataframe()
+
+    assert len(client.tables["stats"].rows) == 4
+    assert sorted(db.stats_df.reach) == [150, 250, 300, 400]
+    assert db.last_stats_df.reach.tolist() == [300, 400]
+
+
+def test_writes_are_chunked_and_retried(tmp_path, monkeypatch):
+    monkeypatch.setattr(stats_db, "CHUNK_SIZE", 2)
+    monkeypatch.setattr(stats_db, "RETRY_DELAY", 0)
+
+    client = FakeClient(stats=FakeTable(failures=2), posts=FakeTable())
+    stats = pd.DataFrame(
+        {
+            "username": [f"@chan_{i}" for i in range(5)],
+            "reach": [1.5, float("nan"), float("inf"), 4, 5],
+            "subscribers": 1000,
+        }
+    )
+    msgs = pd.DataFrame(
+        {
+            "username": ["@chan_0"],
+            "link": ["https://t.me/chan_0/1"],
+            "reach": [10],
+            "reactions": [1],
+            "popularity": [0.5],
+            "datetime": [pd.Timestamp("2024-01-01 10:00")],
+            "text": ["post"],
+        }
+    )
+
+    future = make_db(tmp_path, client).save_new_stats_to_db(
+        stats, msgs, run_id="run", background=True
+    )
+    stats["reach"] = 0  # записи собраны до отправки в фон
+    future.result()
+
+    rows = client.tables["stats"].rows
+    assert client.tables["stats"].chunks == [2, 2, 1]
+    assert [row["reach"] for row in rows] == [1.5, None, None, 4, 5]
+    assert {row["run_id"] for row in rows} == {"run"}
+    assert len({row["created_at"] for row in rows}) == 1
+
+    (post,) = client.tables["posts"].rows
+    assert post["datetime"] == "2024-01-01T10:00:00+00:00"
+
+
+def test_write_gives_up_after_retries(tmp_path, monkeypatch):
+    monkeypatch.setattr(stats_db, "RETRY_DELAY", 0)
+    client = FakeClient(stats=FakeTable(failures=stats_db.WRITE_RETRIES))
+    stats = pd.DataFrame({"username": ["@chan_a"], "reach": [1], "subscribers": 1})
+
+    with pytest.raises(ConnectionError):
+        make_db(tmp_path, client).save_new_stats_to_db(stats)
@@ -0,0 +1,186 @@
+import fnmatch
+from types import SimpleNamespace
+
+import pytest
+from postgrest.exceptions import APIError
+
+from supabasefs import SupabaseTableFileSystem
+
+
+class FakeQuery:
+    """Запрос к таблице `key`/`value` в духе PostgREST: условия копятся
+    цепочкой и применяются при `execute`."""
+
+    def __init__(self, table, action, payload=None):
+        self.table = table
+        self.action = action
+        self.payload = payload
+        self.conditions = []
+
+    def eq(self, column, value):
+        self.conditions.append(lambda row: row[column] == value)
+        return self
+
+    def in_(self, column, values):
+        self.conditions.append(lambda row: row[column] in values)
+        return self
+
+    def filter(self, column, operator, pattern):
+        pattern = pattern.replace("%", "*").replace("_", "?")
+        self.conditions.append(lambda row: fnmatch.fnmatchcase(row[column], pattern))
+        return self
+
+    def limit(self, count):
+        return self
+
+    def execute(self):
+        self.table.requests.append(self.action)
+        rows = self.table.rows
+
+        if self.action == "insert":
+            if self.payload["key"] in rows:
+                raise APIError({"message": "duplicate key"})
+            rows[self.payload["key"]] = self.payload["value"]
+            return SimpleNamespace(data=[self.payload])
+
+        if self.action == "upsert":
+            rows.update({row["key"]: row["value"] for row in self.payload})
+            return SimpleNamespace(data=self.payload)
+
+        matched = [
+            row
+            for row in ({"key": key, "value": value} for key, value in rows.items())
+            if all(condition(row) for condition in self.conditions)
+        ]
+
+        for row in matched:
+            if self.action == "delete":
+                del rows[row["key"]]
+            elif self.action == "update":
+                rows[row["key"]] = self.payload["value"]
+
+        return SimpleNamespace(data=matched)
+
+
+class FakeTable:
+    def __init__(self, rows=None):
+        self.rows = dict(rows or {})
+        self.requests = []
+
+    def select(self, *columns):
+        return FakeQuery(self, "select")
+
+    def insert(self, row):
+        return FakeQuery(self, "insert", row)
+
+    def upsert(self, rows):
+        return FakeQuery(self, "upsert", rows)
+
+    def update(self, values):
+        return FakeQuery(self, "update", values)
+
+    def delete(self):
+        return FakeQuery(self, "delete")
+
+
+def make_fs(rows=None) -> tuple[SupabaseTableFileSystem, FakeTable]:
+    table = FakeTable(rows)
+    client = SimpleNamespace(table=lambda name: table)
+    return SupabaseTableFileSystem(client, "sessions"), table
+
+
+def test_cat_many_reads_in_one_request_and_caches():
+    fs, table = make_fs({"1.session": "one", "2.session": "two"})
+
+    assert fs.cat(["1.session", "2.session", "3.session"], on_error="omit") == {
+        "1.session": b"one",
+        "2.session": b"two",
+    }
+    assert fs.cat_file("1.session") == b"one"
+    assert table.requests == ["select"]
+
+
+def test_pipe_writes_many_keys_in_one_request():
+    fs, table = make_fs()
+
+    fs.pipe({"1.session": "one", "2.session": b"two"})
+
+    assert table.rows == {"1.session": "one", "2.session": "two"}
+    assert table.requests == ["upsert"]
+    assert fs.ls(detail=False) == ["1.session", "2.session"]
+
+
+def test_exists_and_glob_ask_the_table():
+    fs, table = make_fs({"1.session": "one", ".lease_1": "owner"})
+
+    assert fs.exists("1.session")
+    assert not fs.exists("2.session")
+    assert fs.glob("*.session") == ["1.session"]
+
+    # ключ мог записать другой процесс
+    table.rows["2.session"] = "two"
+    assert fs.exists("2.session")
+
+
+def test_rm_forgets_cached_value():
+    fs, table = make_fs({"1.session": "one"})
+    fs.cat_file("1.session")
+
+    fs.rm("1.session")
+
+    assert table.rows == {}
+    assert not fs.exists("1.session")
+
+
+
+def test_read_only_open_does_not_write_back():
+    fs, table = make_fs({"1.session": "one"})
+
+    with fs.open("1.session", "r") as f:
+        assert f.read() == "one"
+
+    assert table.requests == ["select"]
+
+
+def test_binary_values_round_trip():
+    fs, table = make_fs()
+    blob = bytes(range(256))
+
+    with fs.open("cache.jsonl", "wb") as f:
+        f.write(blob)
+    with fs.open("text.json", "w") as f:
+        f.write("текст")
+
+    assert table.rows["text.json"] == "текст"
+    assert table.rows["cache.jsonl"] != blob.decode("latin-1")
+
+    fs.invalidate()
+    assert fs.cat_file("cache.jsonl") == blob
+    with fs.open("text.json") as f:
+        assert f.read() == "текст".encode()
+
+
+def test_append_and_exclusive_modes():
+    fs, table = make_fs({"journal": "first\n"})
+
+    with fs.open("journal", "a") as f:
+        f.write("second\n")
+    assert table.rows["journal"] == "first\nsecond\n"
+
+    with pytest.raises(FileExistsError):
+        fs.open("journal", "x")
+    with pytest.raises(FileNotFoundError):
+        fs.open("missing", "r")
+
+
+def test_compare_and_swap():
+    fs, table = make_fs()
+
+    assert fs.compare_and_swap(".lease_1", None, "first")
+    assert not fs.compare_and_swap(".lease_1", None, "second")
+    assert not fs.compare_and_swap(".lease_1", "second", "third")
+    assert fs.compare_and_swap(".lease_1", "first", "third")
+    assert fs.cat_file(".lease_1") == b"third"
+
+    assert fs.compare_and_swap(".lease_1", "third", None)
+    assert table.rows == {}
@@ -0,0 +1,26 @@
+from utils import find_nicknames, get_nicknames
+
+
+def test_find_nicknames_positions():
+    text = "t.me/fghij, https://telegram.me/Qwerty1 и @nick_1 или zzzzz.t.me"
+
+    assert find_nicknames(["", text]) == {
+        "@fghij": [(1, 0)],
+        "@qwerty1": [(1, text.index("https://"))],
+        "@nick_1": [(1, text.index("@nick_1"))],
+        "@zzzzz": [(1, text.index("zzzzz"))],
+    }
+
+
+def test_invites():
+    text = "вступайте https://t.me/+AbCdEfGhIjKl или t.me/joinchat/ZyXwVuTsRqPo"
+
+    assert get_nicknames(text) == set()
+    assert find_nicknames([text], invites=True) == {
+        "https://t.me/+AbCdEfGhIjKl": [(0, text.index("https://"))],
+        "https://t.me/+ZyXwVuTsRqPo": [(0, text.index("t.me/joinchat"))],
+    }
+
+
+def test_emails_are_not_nicknames():
+    assert get_nicknames("пишите на mail@example.com или @investor") == {"@investor"}
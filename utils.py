@@ -1,4 +1,21 @@
 import re
+from typing import Iterable
+
+INVITE_PREFIX = "https://t.me/+"
+
+# Все виды упоминаний одним выражением, чтобы текст просматривался один раз.
+# Каждая ветка начинается с символа "@" или ".", поэтому движок ищет
+# только эти символы, а не пробует выражение с каждой позиции. По той же
+# причине ник перед ".t.me" ищется отдельно, в `DOMAIN_NAME_PATTERN`.
+NICKNAME_PATTERN = re.compile(
+    r"@(?P<at>[A-Za-z\d_]{5,32})"
+    r"|\.(?:(?<=\bt\.)|(?<=\btelegram\.))me/"
+    r"(?:(?:\+|joinchat/)(?P<invite>[\w-]{10,})|(?P<link>[A-Za-z\d_]{5,32})\b)"
+    r"|\.t\.me\b(?P<domain>)"
+)
+DOMAIN_NAME_PATTERN = re.compile(r"(?<![\w.])[A-Za-z\d_]{5,32}\Z")
+LINK_PREFIXES = ("https://", "http://")
+
 
 def ensure_ats(strs: set[str]) -> set[str]:
     return {ensure_at_single(s) for s in strs}
@@ -12,13 +29,74 @@ def ensure_at_single(s: str) -> str:
     )
 
 
-def get_nicknames(text: str) -> set[str]:
-    if not text:
-        return set()
+def is_invite(name) -> bool:
+    return isinstance(name, str) and name.startswith(INVITE_PREFIX)
+
+
+def iter_nicknames(text: str, invites=False):
+    """Ники в тексте вместе с позициями, в том виде, в каком их отдает
+    `find_nicknames`."""
+    # в большинстве текстов упоминаний нет, а проверить это так быстрее
+    if "@" not in text and ".me" not in text:
+        return
+
+    for match in NICKNAME_PATTERN.finditer(text):
+        kind = match.lastgroup
+        start = match.start()
+
+        if kind == "at":
+            # почта, а не упоминание
+            if start and (text[start - 1].isalnum() or text[start - 1] == "_"):
+                continue
+            yield "@" + match.group(kind).lower(), start
+
+        elif kind == "link":
+            yield "@" + match.group(kind).lower(), link_start(text, start)
+
+        elif kind == "domain":
+            name = DOMAIN_NAME_PATTERN.search(text, max(0, start - 32), start)
+            if name:
+                yield "@" + name.group().lower(), name.start()
+
+        elif invites:
+            yield INVITE_PREFIX + match.group(kind), link_start(text, start)
 
-    at_signs = re.findall(r"@[A-Za-z\d_]{5,32}", text)
-    links = re.findall(r"https://t\.me/([A-Za-z\d_]{5,32})", text)
 
-    # TODO: игнорируются ссылки доменного типа и пригласительные ссылки, нужно добавить
+def link_start(text: str, dot: int) -> int:
+    """Начало ссылки `t.me/...` или `telegram.me/...` вместе со схемой,
+    если она есть, по позиции точки перед `me/`."""
+    start = dot - (8 if text.endswith("telegram", 0, dot) else 1)
+
+    for prefix in LINK_PREFIXES:
+        if text.endswith(prefix, 0, start):
+            return start - len(prefix)
+
+    return start
+
+
+def find_nicknames(
+    texts: Iterable[str], invites=False
+) -> dict[str, list[tuple[int, int]]]:
+    """Ники из всех текстов сразу: для каждого ника в виде `@nick`
+    список мест, где он встретился, - номер текста и позиция в нем.
+
+    Понимает `@nick`, `t.me/nick`, `telegram.me/nick` и `nick.t.me`.
+    Если `invites`, в результат попадают и пригласительные ссылки
+    `t.me/+hash` и `t.me/joinchat/hash` в виде `https://t.me/+hash`."""
+    found = {}
+
+    for index, text in enumerate(texts):
+        if not text:
+            continue
+
+        for name, position in iter_nicknames(text, invites):
+            found.setdefault(name, []).append((index, position))
+
+    return found
+
+
+def get_nicknames(text: str, invites=False) -> set[str]:
+    if not text:
+        return set()
 
-    return ensure_ats(at_signs) | ensure_ats(links)
+    return {name for name, _ in iter_nicknames(text, invites)}